@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Parse a file of bash commands (one per line) with a pool of worker processes.
+
+The input file is sharded into chunks of consecutive lines which are
+normalized in parallel; results are streamed to the output in input order.
+A command that cannot be parsed is recorded together with the class of the
+exception raised by the parser.
+
+Usage: python3 -m bashlint.batch input_file [-o output_file]
+           [--format jsonl|ast|binary] [--processes N] [--chunk_size K]
+
+Output formats:
+    jsonl - one JSON object per input line with the fields "line", "cmd",
+        "normalized" (normalized command), "error" (exception class) and
+        "message".
+    ast - a stream of pickled (line, tree, error, message) tuples, read back
+        with read_ast_file.
+    binary - the trees in the format of flat_nast (None for commands which
+        cannot be parsed), read back with flat_nast.Forest.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import pickle
+import sys
+
+from bashlint import bparser, data_tools, flat_nast, lint
+from bashlint.grammar import get_bash_grammar
+
+DEFAULT_CHUNK_SIZE = 256
+
+
+def parse_line(item):
+    """
+    Normalize a single command in a worker process.
+
+    :param item: (line number, command)
+    :return (line number, command, tree, exception class, message)
+    """
+    i, cmd = item
+    cmd = cmd.rstrip('\n')
+    try:
+        tree, err = lint.normalize_ast_with_error(cmd)
+    except Exception as e:
+        # errors lint does not expect should not abort the batch
+        tree, err = None, e
+    if err is None:
+        return i, cmd, tree, None, None
+    return i, cmd, tree, type(err).__name__, str(err)
+
+
+def batch_parse(lines, num_processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Parse commands in parallel.
+
+    :param lines: iterable of bash commands.
+    :param num_processes: number of worker processes (defaults to the number
+        of CPUs); no pool is created if set to 1.
+    :param chunk_size: number of consecutive commands sent to a worker at a
+        time.
+    :return iterator over parse_line results, in input order.
+    """
+    items = enumerate(lines)
+    if num_processes == 1:
+        for item in items:
+            yield parse_line(item)
+        return
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        for result in pool.imap(parse_line, items, chunksize=chunk_size):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def batch_parse_file(input_file, num_processes=None,
+                     chunk_size=DEFAULT_CHUNK_SIZE):
+    with open(input_file) as f:
+        for result in batch_parse(f, num_processes, chunk_size):
+            yield result
+
+
+def write_jsonl(results, o_f):
+    num_errors = 0
+    for i, cmd, tree, err_class, message in results:
+        record = {
+            'line': i,
+            'cmd': cmd,
+            'normalized': data_tools.ast2command(tree, loose_constraints=True)
+                if tree else None,
+            'error': err_class,
+            'message': message
+        }
+        if tree is None:
+            num_errors += 1
+        o_f.write(json.dumps(record) + '\n')
+    return num_errors
+
+
+def write_ast_file(results, o_f):
+    num_errors = 0
+    for i, cmd, tree, err_class, message in results:
+        if tree is None:
+            num_errors += 1
+        pickle.dump((i, tree, err_class, message), o_f,
+                    pickle.HIGHEST_PROTOCOL)
+    return num_errors
+
+
+def write_binary_file(results, output_file):
+    errors = []
+    def trees():
+        for i, cmd, tree, err_class, message in results:
+            if tree is None:
+                errors.append(i)
+            yield tree
+    flat_nast.write_forest(trees(), output_file)
+    return len(errors)
+
+
+def read_ast_file(input_file):
+    """
+    Iterate over the (line, tree, error, message) records of an ast file.
+    """
+    with open(input_file, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                break
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Normalize a file of bash commands in parallel.')
+    parser.add_argument('input_file')
+    parser.add_argument('-o', '--output_file', default=None,
+                        help='output path (default: stdout, jsonl only)')
+    parser.add_argument('--format', default='jsonl',
+                        choices=['jsonl', 'ast', 'binary'])
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--chunk_size', type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    # load the parsers before the workers are forked; messages printed while
+    # building them must not end up in the jsonl output
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        get_bash_grammar()
+        bparser.get_yaccparser()
+    finally:
+        sys.stdout = stdout
+
+    results = batch_parse_file(args.input_file, args.processes, args.chunk_size)
+    if args.format == 'jsonl':
+        if args.output_file:
+            with open(args.output_file, 'w') as o_f:
+                num_errors = write_jsonl(results, o_f)
+        else:
+            num_errors = write_jsonl(results, sys.stdout)
+    else:
+        if not args.output_file:
+            parser.error('--format {} requires an output file'.format(args.format))
+        if args.format == 'ast':
+            with open(args.output_file, 'wb') as o_f:
+                num_errors = write_ast_file(results, o_f)
+        else:
+            num_errors = write_binary_file(results, args.output_file)
+    sys.stderr.write('{} commands could not be parsed\n'.format(num_errors))
+
+
+if __name__ == '__main__':
+    main()
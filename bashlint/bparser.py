@@ -1,4 +1,4 @@
-import os, copy
+import os, copy, threading
 
 from bashlint import yacc, tokenizer, state, bast, subst, flags, errors, heredoc
 
@@ -538,45 +538,124 @@ def p_error(p):
         raise errors.ParsingError('unexpected token %r' % p.value,
                                   p.lexer.source, p.lexpos)
 
-yaccparser = yacc.yacc(tabmodule='bashlint.parsetab',
-              outputdir=os.path.dirname(__file__),
-              debug=False)
+# the LALR parser is built on first use so that importing bashlint does not
+# pay for loading the parse tables
+yaccparser = None
+_yaccparserlock = threading.Lock()
+
+def get_yaccparser():
+    global yaccparser
+    with _yaccparserlock:
+        if yaccparser is None:
+            parser = yacc.yacc(tabmodule='bashlint.parsetab',
+                               outputdir=os.path.dirname(__file__),
+                               debug=False)
+            fix_correction_states(parser)
+            yaccparser = parser
+    return yaccparser
 
 # some hack to fix yacc's reduction on command substitutions:
 # which state to fix is derived from static transition tables
 # as states are changeable among python versions and architectures
 # the only state that is considered fixed is the initial state: 0
-def get_correction_states():
+def get_correction_states(yaccparser):
     reduce = yaccparser.goto[0]['simple_list'] #~10
     state2 = yaccparser.action[reduce]['NEWLINE'] #63
     state1 = yaccparser.goto[reduce]['simple_list_terminator'] #~10
     return state1, state2
 
-def get_correction_rightparen_states():
+def get_correction_rightparen_states(yaccparser):
     state1 = yaccparser.goto[0]['pipeline_command']
     state2 = yaccparser.goto[0]['simple_list1'] #11
     state_temp = yaccparser.action[state2]['SEMICOLON'] #65
     state3 = yaccparser.goto[state_temp]['simple_list1']
     return state1, state2, state3
 
-for tt in tokenizer.tokentype:
-    states = get_correction_states()
-    yaccparser.action[states[0]][tt.name] = -1
-    yaccparser.action[states[1]][tt.name] = -141
+def fix_correction_states(yaccparser):
+    for tt in tokenizer.tokentype:
+        states = get_correction_states(yaccparser)
+        yaccparser.action[states[0]][tt.name] = -1
+        yaccparser.action[states[1]][tt.name] = -141
 
-states = get_correction_rightparen_states()
-yaccparser.action[states[0]]['RIGHT_PAREN'] = -155
-yaccparser.action[states[1]]['RIGHT_PAREN'] = -148
-yaccparser.action[states[2]]['RIGHT_PAREN'] = -154
+    states = get_correction_rightparen_states(yaccparser)
+    yaccparser.action[states[0]]['RIGHT_PAREN'] = -155
+    yaccparser.action[states[1]]['RIGHT_PAREN'] = -148
+    yaccparser.action[states[2]]['RIGHT_PAREN'] = -154
+
+class parsersession(object):
+    '''
+    a reusable parsing context.
+
+    yacc.yacc returns a parser object that is not reentrant: besides the LR
+    tables it holds the state and symbol stacks of the parse in progress. a
+    session owns a single shallow copy of the global yaccparser, which shares
+    the read-only LR tables and keeps those stacks private to the session, and
+    reuses it for every command it parses (including the nested parses of
+    command substitutions).
+
+    a session may parse any number of commands but must not be used by two
+    threads at the same time. threadsession() returns the session of the
+    calling thread.
+    '''
+    def __init__(self):
+        self.lrparser = copy.copy(get_yaccparser())
+
+    def parsesingle(self, s, strictmode=True, expansionlimit=None,
+                    convertpos=False):
+        '''like parse, but only consumes a single top level node, e.g. parsing
+        'a\nb' will only return a node for 'a', leaving b unparsed'''
+        p = _parser(s, strictmode=strictmode, expansionlimit=expansionlimit,
+                    session=self)
+        tree = p.parse()
+        if convertpos:
+            bast.posconverter(s).visit(tree)
+        return tree
+
+    def parse(self, s, strictmode=True, expansionlimit=None, convertpos=False):
+        '''see parse()'''
+        p = _parser(s, strictmode=strictmode, expansionlimit=expansionlimit,
+                    session=self)
+        parts = [p.parse()]
+
+        # find the 'real' end incase we have a heredoc in there
+        ef = _endfinder()
+        ef.visit(parts[-1])
+        index = max(parts[-1].pos[1], ef.end) + 1
+        while index < len(s):
+            part = _parser(s[index:], strictmode=strictmode,
+                           session=self).parse()
+
+            if not isinstance(part, bast.node):
+                break
+
+            bast.posshifter(index).visit(part)
+            parts.append(part)
+            ef = _endfinder()
+            ef.visit(parts[-1])
+            index = max(parts[-1].pos[1], ef.end) + 1
+
+        if convertpos:
+            for tree in parts:
+                bast.posconverter(s).visit(tree)
+
+        return parts
+
+_threadlocal = threading.local()
+
+def threadsession():
+    '''return the parser session of the calling thread, creating it on first
+    use'''
+    session = getattr(_threadlocal, 'session', None)
+    if session is None:
+        session = _threadlocal.session = parsersession()
+    return session
 
 def parsesingle(s, strictmode=True, expansionlimit=None, convertpos=False):
     '''like parse, but only consumes a single top level node, e.g. parsing
     'a\nb' will only return a node for 'a', leaving b unparsed'''
-    p = _parser(s, strictmode=strictmode, expansionlimit=expansionlimit)
-    tree = p.parse()
-    if convertpos:
-        bast.posconverter(s).visit(tree)
-    return tree
+    return threadsession().parsesingle(s, strictmode=strictmode,
+                                       expansionlimit=expansionlimit,
+                                       convertpos=convertpos)
 
 def parse(s, strictmode=True, expansionlimit=None, convertpos=False):
     '''parse the input string, returning a list of nodes
@@ -591,37 +670,12 @@ def parse(s, strictmode=True, expansionlimit=None, convertpos=False):
     - skip reading a heredoc if we're at the end of the input
     expansionlimit is used to limit the amount of recursive parsing done due to
     command substitutions found during word expansion.
+    the parse runs in the parser session of the calling thread, so parse may
+    be called from several threads concurrently.
     '''
-    p = _parser(s, strictmode=strictmode, expansionlimit=expansionlimit)
-    parts = [p.parse()]
-
-    class endfinder(bast.nodevisitor):
-        def __init__(self):
-            self.end = -1
-        def visitheredoc(self, node, value):
-            self.end = node.pos[1]
-
-    # find the 'real' end incase we have a heredoc in there
-    ef = _endfinder()
-    ef.visit(parts[-1])
-    index = max(parts[-1].pos[1], ef.end) + 1
-    while index < len(s):
-        part = _parser(s[index:], strictmode=strictmode).parse()
-
-        if not isinstance(part, bast.node):
-            break
-
-        bast.posshifter(index).visit(part)
-        parts.append(part)
-        ef = _endfinder()
-        ef.visit(parts[-1])
-        index = max(parts[-1].pos[1], ef.end) + 1
-
-    if convertpos:
-        for tree in parts:
-            bast.posconverter(s).visit(tree)
-
-    return parts
+    return threadsession().parse(s, strictmode=strictmode,
+                                 expansionlimit=expansionlimit,
+                                 convertpos=convertpos)
 
 def split(s):
     '''a utility function that mimics shlex.split but handles more
@@ -650,10 +704,12 @@ class _parser(object):
     when we're in the middle of parsing. as a hack, we shove it into the
     YaccProduction context attribute to make it accessible.
     '''
-    def __init__(self, s, strictmode=True, expansionlimit=None, tokenizerargs=None):
+    def __init__(self, s, strictmode=True, expansionlimit=None, tokenizerargs=None,
+                 session=None):
         assert expansionlimit is None or isinstance(expansionlimit, int)
 
         self.s = s
+        self.session = session
         self._strictmode = strictmode
         self._expansionlimit = expansionlimit
 
@@ -669,11 +725,11 @@ class _parser(object):
         self.redirstack = self.tok.redirstack
 
     def parse(self):
-        # yacc.yacc returns a parser object that is not reentrant, it has
-        # some mutable state. we make a shallow copy of it so no
-        # state spills over to the next call to parse on it
-        theparser = copy.copy(yaccparser)
-        tree = theparser.parse(lexer=self.tok, context=self)
+        # the LR parser of the session keeps the mutable parse state, see
+        # parsersession
+        if self.session is None:
+            self.session = threadsession()
+        tree = self.session.lrparser.parse(lexer=self.tok, context=self)
 
         return tree
 
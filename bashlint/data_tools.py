@@ -12,7 +12,8 @@ import sys
 if sys.version_info > (3, 0):
     from six.moves import xrange
 
-from bashlint import bash, lint, nast
+from bashlint import bash, flat_nast, lint, nast
+from bashlint.parse_cache import parse_cache
 
 flag_suffix = '<FLAG_SUFFIX>'
 
@@ -49,17 +50,29 @@ def bash_tokenizer(cmd, recover_quotation=True, loose_constraints=False,
     """
     Tokenize a bash command.
     """
-    tree = lint.normalize_ast(cmd, recover_quotation, verbose=verbose)
+    tree = bash_parser(cmd, recover_quotation, verbose=verbose)
     return ast2tokens(tree, loose_constraints, ignore_flag_order,
                       arg_type_only, with_flag_head=with_flag_head,
                       with_prefix=with_prefix, with_flag_argtype=with_flag_argtype)
 
 
-def bash_parser(cmd, recover_quotation=True, verbose=False):
+def bash_parser(cmd, recover_quotation=True, verbose=False, flat=False):
     """
     Parse bash command into AST.
+
+    Results are memoized by the parse cache; a verbose call always re-parses
+    so that the parser error messages are printed.
+
+    :param flat: If set, return a read-only flat_nast.FlatNode view of the
+        tree, which takes a fraction of the memory of nast.Node objects.
     """
-    return lint.normalize_ast(cmd, recover_quotation, verbose=verbose)
+    if verbose:
+        tree = lint.normalize_ast(cmd, recover_quotation, verbose=verbose)
+        return flat_nast.flatten(tree) if flat else tree
+    if flat:
+        return parse_cache.get_or_parse_flat(
+            lint.normalize_ast, cmd, recover_quotation)
+    return parse_cache.get_or_parse(lint.normalize_ast, cmd, recover_quotation)
 
 
 def ast2tokens(node, loose_constraints=False, ignore_flag_order=False,
@@ -265,7 +278,7 @@ def cmd2template(cmd, recover_quotation=True, arg_type_only=True,
     Convert a bash command to a template that contains only reserved words
     and argument types flags are alphabetically ordered.
     """
-    tree = lint.normalize_ast(cmd, recover_quotation, verbose=verbose)
+    tree = bash_parser(cmd, recover_quotation, verbose=verbose)
     return ast2template(tree, loose_constraints=loose_constraints, 
                         arg_type_only=arg_type_only)
 
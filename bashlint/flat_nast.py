@@ -0,0 +1,560 @@
+"""
+Array-backed representation of normalized bash ASTs and its binary format.
+
+A tree of n nodes is stored in pre-order as parallel int32 arrays:
+    kind, value, arg_type - ids in the string table of the tree
+    parent, first_child, next_sibling - node positions (-1 if none)
+    index - argument order index (ArgumentNode.index)
+    list_separator, list_members - ids in the string table (-1 if none)
+and a table of (utility, key, arg_type, count) rows which holds the argument
+counters of UtilityNode.arg_dict. Every distinct string is stored once as a
+range of a utf-8 blob.
+
+A serialized tree is a header followed by the arrays and the string blob.
+FlatTree reads the arrays in place from any buffer (bytes, mmap) through
+memoryviews, so loading a tree neither copies nor decodes it. Conversion to
+and from nast.Node is lossless, except that the sibling pointers (lsb, rsb) of
+the restored nodes are rebuilt from the order of the children.
+
+FlatNode exposes the nodes of a FlatTree through the read-only part of the
+nast.Node interface (get_children, get_label, utility, ...), so that read-only
+consumers such as data_tools.ast2tokens and the tree edit distance work on
+either representation. See nast_benchmark for the memory and time trade-offs.
+
+Trees are written in the byte order of the machine; loading a tree written on
+a machine of the other endianness raises a ValueError.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import array
+import collections
+import io
+import mmap
+import struct
+import sys
+
+from bashlint import bash, nast
+
+MAGIC = b'NAST'
+FOREST_MAGIC = b'NASF'
+VERSION = 1
+
+# magic, version, byte order, (reserved), num_nodes, num_counts, num_strings,
+# blob size
+_header = struct.Struct('=4sBBHIIII')
+# magic, version, byte order, (reserved), num_trees, position of the offsets
+_forest_header = struct.Struct('=4sBBHQQ')
+
+_BYTE_ORDER = 0 if sys.byteorder == 'little' else 1
+
+NODE_FIELDS = ['kind', 'value', 'arg_type', 'parent', 'first_child',
+               'next_sibling', 'index', 'list_separator', 'list_members']
+NUM_COUNT_FIELDS = 4
+
+_node_classes = {
+    'utility': lambda value: nast.UtilityNode(value),
+    'flag': lambda value: nast.FlagNode(value),
+    'argument': lambda value: nast.ArgumentNode(value),
+    'operator': lambda value: nast.OperatorNode(value),
+    'unarylogicop': lambda value: nast.UnaryLogicOpNode(value),
+    'binarylogicop': lambda value: nast.BinaryLogicOpNode(value),
+    'bracket': lambda value: nast.BracketNode(),
+    'redirect': lambda value: nast.RedirectNode(value),
+    'pipeline': lambda value: nast.PipelineNode(),
+    'commandsubstitution': lambda value: nast.CommandSubstitutionNode(),
+    'processsubstitution': lambda value: nast.ProcessSubstitutionNode(value)
+}
+
+
+# positions of the node fields in the int32 arrays of a tree
+KIND, VALUE, ARG_TYPE, PARENT, FIRST_CHILD, NEXT_SIBLING, INDEX, \
+    LIST_SEPARATOR, LIST_MEMBERS = range(len(NODE_FIELDS))
+
+
+class FlatTree(object):
+    """
+    Read-only view of a serialized tree.
+
+    All node fields are read through a single int32 memoryview, hence a view
+    costs a few hundred bytes on top of the serialized tree.
+
+    :member buffer: The buffer holding the serialized tree.
+    :member num_nodes: Number of nodes; node 0 is the root.
+    :member ints: int32 memoryview of the node fields (field-major, see
+        NODE_FIELDS), the arg_dict rows and the string offsets.
+    """
+    __slots__ = ('buffer', 'num_nodes', 'num_counts', 'num_strings', 'ints',
+                 'blob_start', 'nbytes')
+
+    def __init__(self, buffer, offset=0):
+        magic, version, byte_order, _, num_nodes, num_counts, num_strings, \
+            blob_size = _header.unpack_from(buffer, offset)
+        if magic != MAGIC:
+            raise ValueError('Not a serialized bash AST')
+        if version != VERSION:
+            raise ValueError('Unsupported AST format version {}'.format(version))
+        if byte_order != _BYTE_ORDER:
+            raise ValueError('AST serialized with a different byte order')
+        self.buffer = buffer
+        self.num_nodes = num_nodes
+        self.num_counts = num_counts
+        self.num_strings = num_strings
+
+        pos = offset + _header.size
+        self.blob_start = pos + 4 * (len(NODE_FIELDS) * num_nodes
+                                     + NUM_COUNT_FIELDS * num_counts
+                                     + num_strings + 1)
+        self.ints = memoryview(buffer)[pos:self.blob_start].cast('i')
+        self.nbytes = self.blob_start + blob_size - offset
+
+    def get(self, field, i):
+        """
+        Return field (one of KIND, VALUE, ...) of the i-th node.
+        """
+        return self.ints[field * self.num_nodes + i]
+
+    def get_count_rows(self):
+        start = len(NODE_FIELDS) * self.num_nodes
+        for j in range(start, start + NUM_COUNT_FIELDS * self.num_counts,
+                       NUM_COUNT_FIELDS):
+            yield tuple(self.ints[j:j + NUM_COUNT_FIELDS])
+
+    def get_string(self, i):
+        if i < 0:
+            return None
+        offsets = len(NODE_FIELDS) * self.num_nodes + \
+                  NUM_COUNT_FIELDS * self.num_counts
+        start = self.blob_start + self.ints[offsets + i]
+        end = self.blob_start + self.ints[offsets + i + 1]
+        return bytes(self.buffer[start:end]).decode('utf-8')
+
+    def get_children(self, i):
+        children = []
+        child = self.get(FIRST_CHILD, i)
+        while child >= 0:
+            children.append(child)
+            child = self.get(NEXT_SIBLING, child)
+        return children
+
+    def get_label(self, i):
+        return self.get_string(self.get(KIND, i)).upper() + '_' + \
+               self.get_string(self.get(VALUE, i))
+
+    def root(self):
+        """
+        Return the FlatNode view of the root.
+        """
+        return FlatNode(self, 0) if self.num_nodes else None
+
+    def to_node(self):
+        """
+        Rebuild the nast.Node tree.
+        """
+        strings = [self.get_string(i) for i in range(self.num_strings)]
+        get = lambda i: strings[i] if i >= 0 else None
+        nodes = []
+        for i in range(self.num_nodes):
+            kind, value = get(self.get(KIND, i)), get(self.get(VALUE, i))
+            if kind in _node_classes:
+                node = _node_classes[kind](value)
+            else:
+                node = nast.Node(kind=kind)
+            node.value = value
+            if kind == 'argument':
+                node.arg_type = get(self.get(ARG_TYPE, i))
+                node.index = self.get(INDEX, i)
+                node.list_separator = get(self.get(LIST_SEPARATOR, i))
+                if self.get(LIST_MEMBERS, i) >= 0:
+                    node.list_members = get(self.get(LIST_MEMBERS, i)) \
+                        .split(node.list_separator)
+            parent = self.get(PARENT, i)
+            if parent >= 0:
+                node.parent = nodes[parent]
+                siblings = nodes[parent].children
+                if siblings:
+                    nast.make_sibling(siblings[-1], node)
+                siblings.append(node)
+            nodes.append(node)
+        for utility, key, arg_type, count in self.get_count_rows():
+            arg_dict = nodes[utility].arg_dict
+            if not get(key) in arg_dict:
+                arg_dict[get(key)] = collections.defaultdict(int)
+            arg_dict[get(key)][get(arg_type)] = count
+        return nodes[0] if nodes else None
+
+
+class FlatNode(object):
+    """
+    Node of a FlatTree with the read-only interface of nast.Node.
+
+    A FlatNode holds nothing but its tree and position: parents, children and
+    strings are looked up on access and the views are created on the fly, so
+    equal views are compared by position rather than by identity. Trees which
+    are only read (evaluation, statistics) can be held in this form instead of
+    as nast.Node objects.
+    """
+    __slots__ = ('tree', 'pos')
+
+    def __init__(self, tree, pos):
+        self.tree = tree
+        self.pos = pos
+
+    def __eq__(self, other):
+        return isinstance(other, FlatNode) and self.tree is other.tree \
+               and self.pos == other.pos
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((id(self.tree), self.pos))
+
+    def __repr__(self):
+        return 'FlatNode({})'.format(self.get_label())
+
+    def _view(self, pos):
+        return FlatNode(self.tree, pos) if pos >= 0 else None
+
+    def _string(self, field):
+        return self.tree.get_string(self.tree.get(field, self.pos))
+
+    @property
+    def kind(self):
+        return self._string(KIND)
+
+    @property
+    def value(self):
+        return self._string(VALUE)
+
+    @property
+    def arg_type(self):
+        return self._string(ARG_TYPE)
+
+    @property
+    def index(self):
+        return self.tree.get(INDEX, self.pos)
+
+    @property
+    def list_separator(self):
+        return self._string(LIST_SEPARATOR)
+
+    @property
+    def list_members(self):
+        members = self._string(LIST_MEMBERS)
+        return members.split(self.list_separator) if members is not None \
+            else None
+
+    @property
+    def associate(self):
+        if self.value in bash.right_associate_unary_logic_operators:
+            return nast.UnaryLogicOpNode.RIGHT
+        return nast.UnaryLogicOpNode.LEFT
+
+    @property
+    def arg_dict(self):
+        arg_dict = {'': collections.defaultdict(int)}
+        tree = self.tree
+        for utility, key, arg_type, count in tree.get_count_rows():
+            if utility == self.pos:
+                key = tree.get_string(key)
+                if not key in arg_dict:
+                    arg_dict[key] = collections.defaultdict(int)
+                arg_dict[key][tree.get_string(arg_type)] = count
+        return arg_dict
+
+    @property
+    def parent(self):
+        return self._view(self.tree.get(PARENT, self.pos))
+
+    @property
+    def children(self):
+        return [FlatNode(self.tree, i) for i in self.tree.get_children(self.pos)]
+
+    @property
+    def lsb(self):
+        parent = self.tree.get(PARENT, self.pos)
+        if parent < 0:
+            return None
+        lsb = -1
+        for i in self.tree.get_children(parent):
+            if i == self.pos:
+                break
+            lsb = i
+        return self._view(lsb)
+
+    @property
+    def rsb(self):
+        return self._view(self.tree.get(NEXT_SIBLING, self.pos))
+
+    @property
+    def prefix(self):
+        return self.kind.upper() + nast.KIND_PREFIX
+
+    @property
+    def symbol(self):
+        return self.prefix + self.value
+
+    @property
+    def utility(self):
+        tree, i = self.tree, self.pos
+        while i >= 0:
+            if tree.get_string(tree.get(KIND, i)) == 'utility':
+                return FlatNode(tree, i)
+            i = tree.get(PARENT, i)
+        raise ValueError('No head utility found!')
+
+    @property
+    def grandparent(self):
+        return self.parent.parent
+
+    def get_children(self):
+        return self.children
+
+    def get_label(self):
+        return self.tree.get_label(self.pos)
+
+    def get_left_child(self):
+        return self._view(self.tree.get(FIRST_CHILD, self.pos))
+
+    def get_right_child(self):
+        children = self.tree.get_children(self.pos)
+        return self._view(children[-1]) if children else None
+
+    def get_2nd_right_child(self):
+        children = self.tree.get_children(self.pos)
+        return self._view(children[-2]) if len(children) >= 2 else None
+
+    def get_num_of_children(self):
+        return len(self.tree.get_children(self.pos))
+
+    def has_children(self):
+        return self.tree.get(FIRST_CHILD, self.pos) >= 0
+
+    def is_reserved(self):
+        if self.kind != 'argument':
+            return True
+        return self.value in bash.reserved_tokens
+
+    def is_command(self, value):
+        return self.kind == 'utility' and self.value == value
+
+    def is_utility(self):
+        return self.kind == 'utility'
+
+    def is_open_vocab(self):
+        if self.kind != 'argument' or self.is_reserved():
+            return False
+        return not self.arg_type in ('Type', 'Option', 'Format')
+
+    def is_option(self):
+        return self.kind == 'flag'
+
+    def is_argument(self):
+        return self.kind == 'argument'
+
+    def is_root(self):
+        return self.kind == 'root'
+
+    def is_bracket(self):
+        return self.value == '(' or self.value == ')'
+
+    def is_long_option(self):
+        return self.value.startswith('--')
+
+    def to_index(self):
+        parent = self.parent
+        key = '' if parent.kind == 'utility' else parent.value
+        return self.utility.arg_dict[key][self.arg_type] > 1
+
+    def get_flags(self):
+        return [child for child in self.children if child.is_option()]
+
+    def get_subcommand(self):
+        for child in self.children:
+            if child.is_utility():
+                return child
+
+    def get_argument(self):
+        for child in self.children:
+            if child.kind == 'argument':
+                return child
+
+
+def dumps(tree):
+    """
+    Serialize a nast.Node tree.
+    """
+    string_ids = {}
+    strings = []
+
+    def sid(s):
+        if s is None:
+            return -1
+        if not s in string_ids:
+            string_ids[s] = len(strings)
+            strings.append(s.encode('utf-8'))
+        return string_ids[s]
+
+    fields = dict((field, array.array('i')) for field in NODE_FIELDS)
+    counts = array.array('i')
+
+    def visit(node, parent):
+        pos = len(fields['kind'])
+        is_argument = node.kind == 'argument'
+        fields['kind'].append(sid(node.kind))
+        fields['value'].append(sid(node.value))
+        fields['arg_type'].append(sid(node.arg_type) if is_argument else -1)
+        fields['parent'].append(parent)
+        fields['first_child'].append(-1)
+        fields['next_sibling'].append(-1)
+        fields['index'].append(node.index if is_argument else 0)
+        if is_argument and node.list_members is not None:
+            fields['list_separator'].append(sid(node.list_separator))
+            fields['list_members'].append(
+                sid(node.list_separator.join(node.list_members)))
+        else:
+            fields['list_separator'].append(
+                sid(node.list_separator) if is_argument else -1)
+            fields['list_members'].append(-1)
+        if node.kind == 'utility':
+            for key, type_counts in node.arg_dict.items():
+                for arg_type, count in type_counts.items():
+                    counts.extend([pos, sid(key), sid(arg_type), count])
+        prev = -1
+        for child in node.children:
+            child_pos = visit(child, pos)
+            if prev < 0:
+                fields['first_child'][pos] = child_pos
+            else:
+                fields['next_sibling'][prev] = child_pos
+            prev = child_pos
+        return pos
+
+    visit(tree, -1)
+
+    string_offsets = array.array('i', [0])
+    for s in strings:
+        string_offsets.append(string_offsets[-1] + len(s))
+    blob = b''.join(strings)
+    num_nodes = len(fields['kind'])
+    header = _header.pack(MAGIC, VERSION, _BYTE_ORDER, 0, num_nodes,
+                          len(counts) // NUM_COUNT_FIELDS, len(strings),
+                          len(blob))
+    return b''.join([header] + [fields[f].tobytes() for f in NODE_FIELDS] +
+                    [counts.tobytes(), string_offsets.tobytes(), blob])
+
+
+def loads(buffer, offset=0):
+    """
+    Deserialize a tree into nast.Node objects.
+    """
+    return FlatTree(buffer, offset).to_node()
+
+
+def flatten(tree):
+    """
+    Return the FlatNode view of the root of a serialized copy of tree.
+    """
+    return FlatTree(dumps(tree)).root() if tree is not None else None
+
+
+# --- Files of multiple trees --- #
+
+def _pad(size):
+    return (-size) % 8
+
+
+def write_forest(trees, output_file):
+    """
+    Save trees (which may include None) to a file, streaming them from any
+    iterable. The table of tree offsets is written after the trees.
+    """
+    with open(output_file, 'wb') as o_f:
+        return _write_forest(trees, o_f)
+
+
+def pack_forest(trees):
+    """
+    Serialize trees (which may include None) into a single in-memory buffer.
+
+    Holding many trees this way costs little more than their serialized size;
+    node views are only created when the trees are accessed.
+
+    :return Forest over the buffer.
+    """
+    o_f = io.BytesIO()
+    _write_forest(trees, o_f)
+    return Forest(buffer=o_f.getvalue())
+
+
+def _write_forest(trees, o_f):
+    offsets = array.array('q', [0])
+    o_f.write(b'\0' * _forest_header.size)
+    for tree in trees:
+        blob = dumps(tree) if tree is not None else b''
+        o_f.write(blob)
+        o_f.write(b'\0' * _pad(len(blob)))
+        offsets.append(offsets[-1] + len(blob) + _pad(len(blob)))
+    o_f.write(offsets.tobytes())
+    o_f.seek(0)
+    o_f.write(_forest_header.pack(
+        FOREST_MAGIC, VERSION, _BYTE_ORDER, 0, len(offsets) - 1,
+        _forest_header.size + offsets[-1]))
+    return len(offsets) - 1
+
+
+class Forest(object):
+    """
+    Trees written by write_forest, memory-mapped from input_file, or held in
+    a buffer produced by pack_forest.
+
+    forest[i] returns the FlatTree view of the i-th tree (None for an empty
+    entry); forest.get_node(i) converts it to nast.Node.
+    """
+    def __init__(self, input_file=None, buffer=None):
+        self.mmap = None
+        if input_file is not None:
+            with open(input_file, 'rb') as f:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            buffer = self.mmap
+        self.buffer = memoryview(buffer)
+        magic, version, byte_order, _, num_trees, offsets_pos = \
+            _forest_header.unpack_from(self.buffer, 0)
+        if magic != FOREST_MAGIC:
+            raise ValueError('Not a serialized bash AST file')
+        if version != VERSION:
+            raise ValueError('Unsupported AST format version {}'.format(version))
+        if byte_order != _BYTE_ORDER:
+            raise ValueError('AST file written with a different byte order')
+        self.num_trees = num_trees
+        self.offsets = self.buffer[
+            offsets_pos:offsets_pos + 8 * (num_trees + 1)].cast('q')
+        self.data_start = _forest_header.size
+
+    def __len__(self):
+        return self.num_trees
+
+    def __getitem__(self, i):
+        if self.offsets[i] == self.offsets[i + 1]:
+            return None
+        return FlatTree(self.buffer, self.data_start + self.offsets[i])
+
+    def get_root(self, i):
+        """
+        Return the FlatNode view of the root of the i-th tree.
+        """
+        flat_tree = self[i]
+        return flat_tree.root() if flat_tree is not None else None
+
+    def get_node(self, i):
+        flat_tree = self[i]
+        return flat_tree.to_node() if flat_tree is not None else None
+
+    def close(self):
+        self.offsets.release()
+        self.buffer.release()
+        if self.mmap is not None:
+            self.mmap.close()
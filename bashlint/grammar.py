@@ -10,7 +10,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import hashlib
 import os, sys
+import pickle
 if sys.version_info > (3, 0):
     from six.moves import xrange
 
@@ -24,6 +26,13 @@ ARG_S = 6
 OPERATOR_S = 7
 EOF_S = 8
 
+GRAMMAR_FILE = os.path.join(os.path.dirname(__file__), 'grammar', 'grammar100.txt')
+COMPILED_GRAMMAR_FILE = os.path.join(
+    os.path.dirname(__file__), 'grammar', 'grammar100.pkl')
+# Increase when the grammar state classes change so that previously compiled
+# grammars are rebuilt.
+COMPILED_GRAMMAR_VERSION = 2
+
 
 class BashGrammarState(object):
     def __init__(self, type):
@@ -64,7 +73,6 @@ class UtilityState(BashGrammarState):
         self.compound_flag = CompoundFlagState(self)
         self.positional_arguments = []
         self.eof = EOFState()
-        self.argument_only = False
 
     def add_flag(self, flag):
         self.compound_flag.add_flag(flag)
@@ -73,13 +81,17 @@ class UtilityState(BashGrammarState):
         self.positional_arguments.append(arg)
         arg.parent = self
 
-    def next_states(self):
-        if self.argument_only:
+    def next_states(self, filled=(), argument_only=False):
+        """
+        :param filled: Positional argument states already consumed.
+        :param argument_only: If set, the end of options ("--") has been seen.
+        """
+        if argument_only:
             next_states = []
         else:
             next_states = [self.compound_flag]
         for arg_state in self.positional_arguments:
-            if not arg_state.filled or (arg_state.is_list
+            if not arg_state in filled or (arg_state.is_list
                     and arg_state.list_separator == ' '):
                 next_states.append(arg_state)
         next_states.append(self.eof)
@@ -150,7 +162,6 @@ class ArgumentState(BashGrammarState):
             the argument.
         :member no_space: No space between the argument and the flag it is
             attached to.
-        :member filled: If set, at least
         :member parent: Parent state.
         :member rsb: Right sibling state.
         """
@@ -162,7 +173,6 @@ class ArgumentState(BashGrammarState):
         self.list_separator = list_separator
         self.regex_format = regex_format
         self.no_space = no_space
-        self.filled = False
         self.parent = None
         self.rsb = None
 
@@ -184,7 +194,6 @@ class ArgCommandState(BashGrammarState):
     def __init__(self):
         super(ArgCommandState, self).__init__(ARG_COMMAND_S)
         self.no_space = False
-        self.filled = False
         self.parent = None
         self.rsb = None
 
@@ -197,7 +206,6 @@ class ExecCommandState(BashGrammarState):
         super(ExecCommandState, self).__init__(EXEC_COMMAND_S)
         self.stop_tokens = stop_tokens
         self.no_space = False
-        self.filled = False
         self.parent = None
         self.rsb = None
 
@@ -208,7 +216,6 @@ class ExecCommandState(BashGrammarState):
 class CommandState(BashGrammarState):
     def __init__(self):
         super(CommandState, self).__init__(COMMAND_S)
-        self.filled = False
         self.parent = None
         self.rsb = None
 
@@ -221,11 +228,24 @@ class EOFState(BashGrammarState):
         super(EOFState, self).__init__(EOF_S)
 
 
-class BashGrammar(object):
-    def __init__(self):
-        self.name2type = {}
-        self.grammar = {}
+class GrammarOverlay(object):
+    """
+    Per-parse state on top of a shared BashGrammar.
+
+    The utility states of the grammar are never modified during parsing. The
+    positional arguments consumed and the end-of-options mark of the command
+    being parsed are recorded in the overlay instead, so parsing a command
+    does not require a copy of its utility grammar.
+    """
+    def __init__(self, grammar):
+        self.grammar = grammar.grammar
         self.next_states = None     # pointer on the current position in the grammar tree
+        self.filled = set()
+        self.argument_only = set()
+
+    def utility_next_states(self, utility_state):
+        return utility_state.next_states(
+            self.filled, utility_state in self.argument_only)
 
     def allow_eof(self):
         for state in self.next_states:
@@ -241,7 +261,7 @@ class BashGrammar(object):
     def consume(self, token):
         if token in self.grammar:
             utility_state = self.grammar[token]
-            self.next_states = utility_state.next_states()
+            self.next_states = self.utility_next_states(utility_state)
             return True
         else:
             return False
@@ -271,7 +291,7 @@ class BashGrammar(object):
                             raise ValueError('Unexpected flag argument "{}"'.format(token))
                 else:
                     if flag_token == '--':
-                        state.parent.argument_only = True
+                        self.argument_only.add(state.parent)
                     else:
                         raise ValueError('Unrecognized long flag "{}"'.format(flag_token))
             elif token in state.flag_index:
@@ -330,31 +350,47 @@ class BashGrammar(object):
                         # Case 5: the token does not match any flag state
                         return None
         elif state_type == COMMAND_S:
-            self.next_states = state.get_utility().next_states()
+            self.next_states = self.utility_next_states(state.get_utility())
         elif state_type == ARG_COMMAND_S:
-            self.next_states = state.get_utility().next_states()
+            self.next_states = self.utility_next_states(state.get_utility())
         elif state_type == EXEC_COMMAND_S:
-            self.next_states = state.get_utility().next_states()
+            self.next_states = self.utility_next_states(state.get_utility())
         elif state_type == OPERATOR_S:
             for i, next_state in enumerate(self.next_states):
                 if next_state.is_compound_flag():
                     del(self.next_states[i])
         elif state.type == ARG_S:
-            state.filled = True
+            self.filled.add(state)
             if state.rsb:
                 # continue interpreting the next argument of the same parent state
                 self.next_states = [state.rsb]
                 return '__SAME_PARENT__'
             else:
-                self.next_states = state.get_utility().next_states()
+                self.next_states = self.utility_next_states(state.get_utility())
                 return '__PARENT_CHANGE__'
 
+
+class BashGrammar(object):
+    def __init__(self):
+        self.name2type = {}
+        self.grammar = {}
+        # hash of the synopsis file the grammar was built from
+        self.source_hash = None
+
+    def overlay(self):
+        """
+        Return a fresh per-parse view of the grammar.
+        """
+        return GrammarOverlay(self)
+
     def make_grammar(self, input_file):
         """
         Build utility grammar from man-page synopsis.
         """
-        with open(input_file) as f:
-            content = f.readlines()
+        with open(input_file, 'rb') as f:
+            data = f.read()
+        self.source_hash = hashlib.sha1(data).hexdigest()
+        content = data.decode('utf-8').splitlines(True)
 
         reading_type = False
         reading_constants = False
@@ -681,5 +717,103 @@ class BashGrammar(object):
         return flag
 
 
-bg = BashGrammar()
-bg.make_grammar(os.path.join(os.path.dirname(__file__), 'grammar', 'grammar100.txt'))
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def compile_grammar(input_file=GRAMMAR_FILE, output_file=COMPILED_GRAMMAR_FILE):
+    """
+    Build the utility grammar from the synopsis file and save it as a binary
+    artifact.
+
+    The artifact consists of a header (format version, hash of the synopsis
+    file) followed by the pickled BashGrammar.
+    """
+    grammar = BashGrammar()
+    grammar.make_grammar(input_file)
+    header = (COMPILED_GRAMMAR_VERSION, file_hash(input_file))
+    tmp_file = '{}.{}.tmp'.format(output_file, os.getpid())
+    with open(tmp_file, 'wb') as o_f:
+        pickle.dump(header, o_f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(grammar, o_f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, output_file)
+    return grammar
+
+
+def load_compiled_grammar(input_file=GRAMMAR_FILE,
+                          compiled_file=COMPILED_GRAMMAR_FILE):
+    """
+    Load a compiled grammar. Return None if the artifact is missing or stale.
+    """
+    try:
+        with open(compiled_file, 'rb') as f:
+            version, source_hash = pickle.load(f)
+            if version != COMPILED_GRAMMAR_VERSION or \
+                    source_hash != file_hash(input_file):
+                return None
+            return pickle.load(f)
+    except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+
+
+def get_compiled_grammar_file(input_file):
+    if input_file == GRAMMAR_FILE:
+        return COMPILED_GRAMMAR_FILE
+    return os.path.splitext(input_file)[0] + '.pkl'
+
+
+_bash_grammar = None
+_bash_grammar_file = GRAMMAR_FILE
+# hash of the synopsis file _bash_grammar was built from
+_bash_grammar_hash = None
+
+def get_bash_grammar():
+    """
+    Return the shared utility grammar, loading it on first use.
+    """
+    global _bash_grammar, _bash_grammar_hash
+    if _bash_grammar is None:
+        input_file = _bash_grammar_file
+        compiled_file = get_compiled_grammar_file(input_file)
+        grammar = load_compiled_grammar(input_file, compiled_file)
+        if grammar is None:
+            try:
+                grammar = compile_grammar(input_file, compiled_file)
+            except (IOError, OSError):
+                # read-only installation: build in memory only
+                grammar = BashGrammar()
+                grammar.make_grammar(input_file)
+        _bash_grammar_hash = grammar.source_hash
+        _bash_grammar = grammar
+    return _bash_grammar
+
+
+def load_bash_grammar(input_file=None):
+    """
+    Reload the shared utility grammar, e.g. after its synopsis file changed.
+
+    :param input_file: if set, the synopsis file used from now on.
+    """
+    global _bash_grammar, _bash_grammar_file
+    if input_file is not None:
+        _bash_grammar_file = input_file
+    _bash_grammar = None
+    return get_bash_grammar()
+
+
+def get_bash_grammar_file():
+    return _bash_grammar_file
+
+
+def get_bash_grammar_hash():
+    """
+    Return the hash of the synopsis file the shared grammar was built from
+    (None if the grammar has not been loaded).
+    """
+    return _bash_grammar_hash if _bash_grammar is not None else None
+
+
+if __name__ == '__main__':
+    from bashlint.grammar import compile_grammar
+    compile_grammar()
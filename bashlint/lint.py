@@ -22,7 +22,6 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import copy
 import os
 import re
 import sys
@@ -146,6 +145,15 @@ def safe_bashlex_parse(cmd, start_pos=0, verbose=False):
     """
     Call bashlex with all exceptions properly catched.
     """
+    return bashlex_parse_with_error(cmd, start_pos=start_pos, verbose=verbose)[0]
+
+def bashlex_parse_with_error(cmd, start_pos=0, verbose=False):
+    """
+    Call bashlex with all exceptions properly catched.
+
+    :return (tree, error) where error is the exception which made parsing
+        fail or None.
+    """
     def increment_bashlex_tree_offset(tree, offset):
         if tree.kind == 'word':
             tree.pos = (tree.pos[0]+offset, tree.pos[1]+offset)
@@ -156,47 +164,27 @@ def safe_bashlex_parse(cmd, start_pos=0, verbose=False):
         tree = bparser.parse(cmd)
         if start_pos > 0:
             increment_bashlex_tree_offset(tree[0], start_pos)
-    except tokenizer.MatchedPairError:
-        if verbose:
-            print("Bashlex cannot parse: %s - MatchedPairError" % cmd)
-        return None
-    except errors.ParsingError:
-        if verbose:
-            print("Bashlex cannot parse: %s - ParsingError" % cmd)
-        return None
-    except NotImplementedError:
+    except (tokenizer.MatchedPairError, errors.ParsingError,
+            NotImplementedError, TypeError) as err:
         if verbose:
-            print("Bashlex cannot parse: %s - NotImplementedError" % cmd)
-        return None
-    except IndexError:
+            print("Bashlex cannot parse: %s - %s" % (cmd, type(err).__name__))
+        return None, err
+    except IndexError as err:
         if verbose:
             print("Bashlex cannot parse: %s - IndexError" % cmd)
         # empty command
-        return None
-    except AttributeError:
+        return None, err
+    except (AttributeError, AssertionError, NameError) as err:
         if verbose:
-            print("Bashlex cannot parse: %s - AttributeError" % cmd)
+            print("Bashlex cannot parse: %s - %s" % (cmd, type(err).__name__))
         # not a bash command
-        return None
-    except AssertionError:
-        if verbose:
-            print("Bashlex cannot parse: %s - AssertionError" % cmd)
-        # not a bash command
-        return None
-    except NameError:
-        if verbose:
-            print("Bashlex cannot parse: %s - NameError" % cmd)
-        # not a bash command
-        return None
-    except TypeError:
-        if verbose:
-            print("Bashlex cannot parse: %s - AssertionError" % cmd)
-        return None
+        return None, err
     if len(tree) > 1:
         if verbose:
             print("Doesn't support command with multiple root nodes: %s" % cmd)
-        return None
-    return tree
+        return None, ValueError(
+            "Unsupported: command with multiple root nodes")
+    return tree, None
 
 def normalize_ast(cmd, recover_quotes=True, verbose=False):
     """
@@ -207,10 +195,19 @@ def normalize_ast(cmd, recover_quotes=True, verbose=False):
     :param verbose: if set, print error message.
     :return normalized_tree
     """
+    return normalize_ast_with_error(cmd, recover_quotes, verbose)[0]
+
+def normalize_ast_with_error(cmd, recover_quotes=True, verbose=False):
+    """
+    Same as normalize_ast, but also report why the command cannot be parsed.
+
+    :return (normalized_tree, error) where error is the exception caught when
+        parsing fails and None otherwise (also when the command is empty).
+    """
     cmd = cmd.replace('\n', ' ').strip()
     cmd = correct_errors_and_normalize_surface(cmd)
     if not cmd:
-        return None
+        return None, None
 
     def is_unary_logic_op(node, parent):
         if node.word == "!":
@@ -260,8 +257,7 @@ def normalize_ast(cmd, recover_quotes=True, verbose=False):
         return norm_node
 
     def normalize_command(node, current=None):
-        bash_grammar = BashGrammar()
-        bash_grammar.name2type = bg.name2type
+        bash_grammar = get_bash_grammar().overlay()
 
         if not node or not node.parts:
             return
@@ -282,7 +278,7 @@ def normalize_ast(cmd, recover_quotes=True, verbose=False):
                 current.add_child(head)
 
             # If utility grammar is not known, parse into a simple two-level tree
-            if not bg.consume(token):
+            if not bash_grammar.consume(token):
                 raise errors.LintParsingError(
                     "Warning: grammar not found - utility {}".format(token), num_tokens, 0)
                 for bast_node in input[1:]:
@@ -301,8 +297,6 @@ def normalize_ast(cmd, recover_quotes=True, verbose=False):
                 return
 
             current, i = head, 1
-            bash_grammar.grammar = {head.value: copy.deepcopy(bg.grammar[head.value])}
-            bash_grammar.consume(head.value)
 
             while i < len(input):
                 bast_node = input[i]
@@ -718,44 +712,25 @@ def normalize_ast(cmd, recover_quotes=True, verbose=False):
             # not supported
             raise ValueError("Unsupported: %s" % node.kind)
 
-    tree = safe_bashlex_parse(cmd, verbose=verbose)
+    tree, err = bashlex_parse_with_error(cmd, verbose=verbose)
     if tree is None:
-        return tree
+        return None, err
 
     normalized_tree = Node(kind="root")
     try:
         normalize(tree[0], normalized_tree)
-    except ValueError as err:
-        if verbose:
-            print("%s - %s" % (err.args[0], cmd))
-        return None
-    except AttributeError as err:
-        if verbose:
-            print("%s - %s" % (err.args[0], cmd))
-        return None
-    except AssertionError as err:
-        if verbose:
-            print("%s - %s" % (err.args[0], cmd))
-        return None
-    except errors.SubCommandError as err:
-        if verbose:
-            print("%s - %s" % (err.args[0], cmd))
-        return None
-    except errors.LintParsingError as err:
-        if verbose:
-            print("%s - %s" % (err.args[0], cmd))
-        return None
-    except errors.FlagError as err:
+    except (ValueError, AttributeError, AssertionError, errors.SubCommandError,
+            errors.LintParsingError, errors.FlagError) as err:
         if verbose:
             print("%s - %s" % (err.args[0], cmd))
-        return None
+        return None, err
 
     if len(normalized_tree.children) == 0:
         # parsing not successful if the normalized tree consists of the root
         # node only
-        return None
+        return None, None
 
-    return normalized_tree
+    return normalized_tree, None
 
 def serialize_ast(node, loose_constraints=False, ignore_flag_order=False):
     if not node:
@@ -868,4 +843,4 @@ def serialize_ast(node, loose_constraints=False, ignore_flag_order=False):
 
 
 def get_utility_statistics(utility):
-    return len(bg.grammar[utility].compound_flag.flag_index)
+    return len(get_bash_grammar().grammar[utility].compound_flag.flag_index)
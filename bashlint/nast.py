@@ -23,6 +23,10 @@ def make_sibling(lsb, rsb):
         rsb.lsb = lsb
 
 class Node(object):
+    # nodes are held by the hundreds of thousands during evaluation, hence
+    # the node classes do not carry per-instance attribute dictionaries
+    __slots__ = ('parent', 'lsb', 'rsb', 'kind', 'value', 'children')
+
     num_child = -1          # number of children taken by node
                             # -1 indicates "any number of"
     children_types = []     # list of compatible types of children
@@ -159,6 +163,7 @@ class Node(object):
         return self.parent.parent
 
 class UtilityNode(Node):
+    __slots__ = ('arg_dict',)
     def __init__(self, value='', parent=None, lsb=None):
         super(UtilityNode, self).__init__(parent, lsb, "utility", value)
         self.arg_dict = {'': collections.defaultdict(int)}
@@ -183,6 +188,7 @@ class UtilityNode(Node):
                 return child
 
 class FlagNode(Node):
+    __slots__ = ()
     def __init__(self, value='', parent=None, lsb=None):
         super(FlagNode, self).__init__(parent, lsb, "flag", value)
 
@@ -205,6 +211,7 @@ class FlagNode(Node):
         return self.value.startswith('--')
 
 class ArgumentNode(Node):
+    __slots__ = ('arg_type', 'index', 'list_separator', 'list_members')
     num_child = 0
 
     def __init__(self, value='', arg_type='', parent=None, lsb=None,
@@ -250,6 +257,7 @@ class ArgumentNode(Node):
         self.index = ind
 
 class OperatorNode(Node):
+    __slots__ = ()
     num_child = 0
 
     def __init__(self, value='', parent=None, lsb=None):
@@ -257,6 +265,7 @@ class OperatorNode(Node):
             parent, lsb, kind='operator', value=value)
 
 class UnaryLogicOpNode(Node):
+    __slots__ = ('associate',)
     num_child = 1
     children_types = [set(['flag', 'bracket', 'unarylogicop', 'binarylogicop'])]
     LEFT = 0
@@ -272,6 +281,7 @@ class UnaryLogicOpNode(Node):
             raise ValueError("Unrecognized unary logic operator: {}".format(value))
 
 class BinaryLogicOpNode(Node):
+    __slots__ = ()
     num_child = -1
     children_types = [set(['flag', 'bracket', 'unarylogicop', 'binarylogicop'])]
 
@@ -279,6 +289,7 @@ class BinaryLogicOpNode(Node):
         super(BinaryLogicOpNode, self).__init__(parent, lsb, 'binarylogicop', value)
 
 class BracketNode(Node):
+    __slots__ = ()
     num_child = -1
     children_types = [set(['flag', 'bracket', 'unarylogicop', 'binarylogicop'])]
 
@@ -286,18 +297,21 @@ class BracketNode(Node):
         super(BracketNode, self).__init__(parent, lsb, 'bracket', '')
 
 class RedirectNode(Node):
+    __slots__ = ()
     num_child = 2
 
     def __init__(self, value='', parent=None, lsb=None):
         super(RedirectNode, self).__init__(parent, lsb, 'redirect', value)
 
 class PipelineNode(Node):
+    __slots__ = ()
     children_types = [set(['utility'])]
 
     def __init__(self, parent=None, lsb=None):
         super(PipelineNode, self).__init__(parent, lsb, 'pipeline')
 
 class CommandSubstitutionNode(Node):
+    __slots__ = ()
     num_child = 1
     children_types = [set(['pipe', 'utility'])]
 
@@ -306,6 +320,7 @@ class CommandSubstitutionNode(Node):
         self.kind = "commandsubstitution"
 
 class ProcessSubstitutionNode(Node):
+    __slots__ = ()
     num_child = 1
     children_types = [set(['pipe', 'utility'])]
 
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Memory and time benchmark of the normalized AST representations.
+
+Parses a file of bash commands (one per line) and holds all trees as
+    node - nast.Node objects
+    flat - flat_nast.FlatNode views of serialized trees (the serialized
+        bytes are counted)
+    forest - a flat_nast.pack_forest buffer of all trees, from which the
+        FlatNode views are created on access
+then measures for each representation the memory held by the trees (with
+tracemalloc) and the time taken to build them, to visit all node labels and
+to tokenize all trees with data_tools.ast2tokens.
+
+Usage: python3 -m bashlint.nast_benchmark data/bash/all.cm
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+from bashlint import data_tools, flat_nast, lint
+
+
+def visit_labels(node):
+    num_nodes = 1
+    node.get_label()
+    for child in node.get_children():
+        num_nodes += visit_labels(child)
+    return num_nodes
+
+
+def measure(build_fun):
+    """
+    :return (result of build_fun, bytes allocated and kept by build_fun,
+        seconds); the time is taken from a separate run without tracing.
+    """
+    start = time.time()
+    build_fun()
+    elapsed = time.time() - start
+    gc.collect()
+    tracemalloc.start()
+    result = build_fun()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def run(cmds):
+    start = time.time()
+    trees = [lint.normalize_ast(cmd) for cmd in cmds]
+    trees = [tree for tree in trees if tree is not None]
+    parse_time = time.time() - start
+    blobs = [flat_nast.dumps(tree) for tree in trees]
+    print('{} commands, {} parsed, parse time {:.2f}s'.format(
+        len(cmds), len(trees), parse_time))
+
+    # (name, build the trees, iterate over the roots of the built trees)
+    backends = [
+        ('node', lambda: [flat_nast.loads(blob) for blob in blobs],
+         iter),
+        # copy the bytes so that the serialized trees are counted
+        ('flat', lambda: [flat_nast.FlatTree(bytes(bytearray(blob))).root()
+                          for blob in blobs],
+         iter),
+        ('forest', lambda: flat_nast.pack_forest(trees),
+         lambda forest: (forest.get_root(i) for i in range(len(forest))))
+    ]
+    print('{:<8}{:>12}{:>12}{:>12}{:>12}'.format(
+        'trees', 'memory(MB)', 'build(s)', 'visit(s)', 'tokens(s)'))
+    for name, build_fun, roots_fun in backends:
+        built, size, build_time = measure(build_fun)
+        start = time.time()
+        num_nodes = sum(visit_labels(root) for root in roots_fun(built))
+        visit_time = time.time() - start
+        start = time.time()
+        for root in roots_fun(built):
+            data_tools.ast2tokens(root, loose_constraints=True)
+        tokens_time = time.time() - start
+        print('{:<8}{:>12.1f}{:>12.2f}{:>12.2f}{:>12.2f}'.format(
+            name, size / 1e6, build_time, visit_time, tokens_time))
+        del built
+    print('{} nodes'.format(num_nodes))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the normalized AST representations.')
+    parser.add_argument('input_file')
+    args = parser.parse_args()
+    with open(args.input_file) as f:
+        cmds = [cmd.rstrip('\n') for cmd in f]
+    run(cmds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+"""
+Content-addressed cache of normalized bash ASTs.
+
+Every distinct (command, parser flags, grammar) combination is parsed once per
+process. Parsed trees are kept serialized in a bounded in-memory LRU and,
+optionally, in an on-disk SQLite store shared across processes and runs.
+Each lookup returns a freshly deserialized tree, so callers may modify it, or
+a read-only flat_nast view of the cached bytes (get_or_parse_flat).
+
+The grammar file hash is part of every key, hence editing grammar100.txt
+invalidates all cached entries; stale rows are dropped when the on-disk store
+is opened. When the grammar file changes while the process runs, the shared
+utility grammar is reloaded before anything is parsed again, and a tree is
+only stored if the grammar it was parsed with has the hash of its key.
+
+The on-disk store is enabled by calling enable_disk_cache() or by setting the
+environment variable BASHLINT_PARSE_CACHE to the path of the store (see
+bashlint/README.md).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import atexit
+import collections
+import hashlib
+import os
+import sqlite3
+import threading
+
+from bashlint import flat_nast, grammar
+
+DEFAULT_MEMORY_SIZE = 100000
+DEFAULT_DISK_SIZE = 2000000
+# part of every key so that entries in an older serialization are not read
+CACHE_FORMAT = 'flat_nast-{}'.format(flat_nast.VERSION)
+
+
+def serialize_tree(tree):
+    return flat_nast.dumps(tree) if tree is not None else b''
+
+
+def deserialize_tree(data):
+    return flat_nast.loads(data) if data else None
+
+
+class DiskStore(object):
+    """
+    SQLite table mapping cache keys to serialized trees.
+
+    The table is bounded to max_size rows; the oldest rows are evicted first.
+    """
+    commit_every = 256
+
+    def __init__(self, path, grammar_hash, max_size=DEFAULT_DISK_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.num_pending = 0
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS asts ('
+                          'key TEXT PRIMARY KEY, grammar TEXT, tree BLOB)')
+        # drop entries produced with a different grammar
+        self.conn.execute('DELETE FROM asts WHERE grammar != ?', (grammar_hash,))
+        self.conn.commit()
+        self.grammar_hash = grammar_hash
+
+    def get(self, key):
+        row = self.conn.execute(
+            'SELECT tree FROM asts WHERE key = ?', (key,)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def put(self, key, data):
+        self.conn.execute('INSERT OR REPLACE INTO asts VALUES (?, ?, ?)',
+                          (key, self.grammar_hash, sqlite3.Binary(data)))
+        self.num_pending += 1
+        if self.num_pending >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        if self.num_pending == 0:
+            return
+        num_rows = self.conn.execute('SELECT COUNT(*) FROM asts').fetchone()[0]
+        if num_rows > self.max_size:
+            self.conn.execute(
+                'DELETE FROM asts WHERE rowid IN (SELECT rowid FROM asts '
+                'ORDER BY rowid LIMIT ?)', (num_rows - self.max_size,))
+        self.conn.commit()
+        self.num_pending = 0
+
+    def clear(self):
+        self.conn.execute('DELETE FROM asts')
+        self.conn.commit()
+        self.num_pending = 0
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+class ParseCache(object):
+    """
+    Two-level (memory, disk) cache of parse results keyed by content.
+
+    :member hits: Number of lookups answered from memory.
+    :member disk_hits: Number of lookups answered from the on-disk store.
+    :member misses: Number of lookups which required parsing.
+    """
+    def __init__(self, grammar_file=None, max_size=DEFAULT_MEMORY_SIZE):
+        """
+        :param grammar_file: synopsis file of the utility grammar (defaults to
+            the file of the shared grammar).
+        """
+        self.grammar_file = grammar_file or grammar.get_bash_grammar_file()
+        self.grammar_hash = grammar.file_hash(self.grammar_file)
+        self.grammar_mtime = os.path.getmtime(self.grammar_file)
+        self.max_size = max_size
+        self.memory = collections.OrderedDict()
+        self.disk = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def make_key(self, cmd, *flags):
+        content = '\t'.join([CACHE_FORMAT, self.grammar_hash] +
+                            [str(f) for f in flags] + [cmd])
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def enable_disk(self, path, max_size=DEFAULT_DISK_SIZE):
+        with self.lock:
+            if self.disk is not None:
+                self.disk.close()
+            self.disk = DiskStore(path, self.grammar_hash, max_size=max_size)
+
+    def get_or_parse(self, parse_fun, cmd, *flags):
+        """
+        Return the tree of cmd, calling parse_fun(cmd, *flags) on a cache miss.
+        """
+        data, tree = self.get_serialized(parse_fun, cmd, *flags)
+        return tree if tree is not None else deserialize_tree(data)
+
+    def get_or_parse_flat(self, parse_fun, cmd, *flags):
+        """
+        Same as get_or_parse, but return the flat_nast.FlatNode view of the
+        root instead of nast.Node objects.
+        """
+        data, _ = self.get_serialized(parse_fun, cmd, *flags)
+        return flat_nast.FlatTree(data).root() if data else None
+
+    def get_serialized(self, parse_fun, cmd, *flags):
+        """
+        :return (serialized tree, parsed tree); the parsed tree is None unless
+            cmd was parsed by this call.
+        """
+        self.check_grammar()
+        key = self.make_key(cmd, *flags)
+        with self.lock:
+            data = self.memory.pop(key, None)
+            if data is not None:
+                self.memory[key] = data
+                self.hits += 1
+                return data, None
+            if self.disk is not None:
+                data = self.disk.get(key)
+                if data is not None:
+                    self.add_to_memory(key, data)
+                    self.disk_hits += 1
+                    return data, None
+            self.misses += 1
+        key_grammar_hash = self.grammar_hash
+        tree = parse_fun(cmd, *flags)
+        data = serialize_tree(tree)
+        with self.lock:
+            # do not store a tree parsed with another grammar than the one
+            # of its key
+            if grammar.get_bash_grammar_hash() in (None, key_grammar_hash) \
+                    and self.grammar_hash == key_grammar_hash:
+                self.add_to_memory(key, data)
+                if self.disk is not None:
+                    self.disk.put(key, data)
+        return data, tree
+
+    def add_to_memory(self, key, data):
+        self.memory[key] = data
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def check_grammar(self):
+        """
+        Invalidate the cache and reload the shared utility grammar if the
+        grammar file has been modified.
+        """
+        mtime = os.path.getmtime(self.grammar_file)
+        if mtime == self.grammar_mtime:
+            return
+        self.grammar_mtime = mtime
+        grammar_hash = grammar.file_hash(self.grammar_file)
+        if grammar_hash != self.grammar_hash:
+            self.invalidate()
+            # the keys use the hash of the grammar the commands are parsed with
+            grammar_hash = grammar.load_bash_grammar(self.grammar_file).source_hash
+            with self.lock:
+                self.grammar_hash = grammar_hash
+                if self.disk is not None:
+                    self.disk.grammar_hash = grammar_hash
+
+    def invalidate(self):
+        """
+        Remove all cached trees from memory and disk.
+        """
+        with self.lock:
+            self.memory.clear()
+            if self.disk is not None:
+                self.disk.clear()
+
+    def flush(self):
+        with self.lock:
+            if self.disk is not None:
+                self.disk.flush()
+
+    def close(self):
+        with self.lock:
+            if self.disk is not None:
+                self.disk.close()
+                self.disk = None
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'size': len(self.memory)
+        }
+
+
+parse_cache = ParseCache()
+if os.environ.get('BASHLINT_PARSE_CACHE'):
+    parse_cache.enable_disk(os.environ['BASHLINT_PARSE_CACHE'])
+atexit.register(parse_cache.flush)
+
+
+def enable_disk_cache(path, max_size=DEFAULT_DISK_SIZE):
+    parse_cache.enable_disk(path, max_size=max_size)
+
+
+def cache_stats():
+    return parse_cache.stats()
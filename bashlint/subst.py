@@ -23,7 +23,7 @@ def _recursiveparse(parserobj, base, sindex, tokenizerargs=None):
     if newlimit is not None:
         newlimit -= 1
     p = bparser._parser(string, tokenizerargs=tokenizerargs,
-                        expansionlimit=newlimit)
+                        expansionlimit=newlimit, session=parserobj.session)
     node = p.parse()
 
     endp = node.pos[1]
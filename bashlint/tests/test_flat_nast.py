@@ -0,0 +1,62 @@
+from __future__ import absolute_import
+
+import os
+
+from bashlint import data_tools, flat_nast, lint
+from bashlint.parse_cache import deserialize_tree, serialize_tree
+
+DATA_FILE = os.path.join(os.path.dirname(__file__), '..', '..', 'data', 'bash',
+                         'all.cm')
+SAMPLE_STEP = 50
+
+
+def sample_commands():
+    with open(DATA_FILE) as f:
+        commands = [line.strip() for line in f]
+    return commands[::SAMPLE_STEP]
+
+
+def argument_indices(node):
+    """
+    Return to_index() of the argument nodes of a tree in pre-order.
+    """
+    indices = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node.kind == 'argument':
+            indices.append(node.to_index())
+        stack.extend(reversed(node.children))
+    return indices
+
+
+def tree_signature(tree):
+    return (data_tools.ast2command(tree),
+            data_tools.ast2command(tree, loose_constraints=True),
+            data_tools.ast2tokens(tree),
+            data_tools.ast2tokens(tree, loose_constraints=True,
+                                  arg_type_only=True, with_arg_type=True),
+            argument_indices(tree))
+
+
+def test_round_trip_preserves_trees():
+    num_trees = 0
+    for cmd in sample_commands():
+        tree = lint.normalize_ast(cmd)
+        if tree is None:
+            continue
+        signature = tree_signature(tree)
+        data = flat_nast.dumps(tree)
+        assert tree_signature(flat_nast.loads(data)) == signature, cmd
+        # the read-only view of the serialized tree
+        assert tree_signature(flat_nast.FlatTree(data).root()) == signature, cmd
+        # the restored tree serializes to the same bytes
+        assert flat_nast.dumps(flat_nast.loads(data)) == data, cmd
+        num_trees += 1
+    assert num_trees > 0
+
+
+def test_round_trip_of_none_tree():
+    assert lint.normalize_ast('') is None
+    assert deserialize_tree(serialize_tree(None)) is None
+    assert flat_nast.flatten(None) is None
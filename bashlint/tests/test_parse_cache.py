@@ -0,0 +1,72 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+
+from bashlint import grammar, lint
+from bashlint.parse_cache import ParseCache
+
+CMD = 'rmdir -p foo'
+
+
+def flag_arguments(tree, flag_name):
+    """
+    Return the argument values of the flag flag_name of the command in tree.
+    """
+    for node in tree.children[0].children:
+        if node.kind == 'flag' and node.value == flag_name:
+            return [child.value for child in node.children]
+    raise KeyError(flag_name)
+
+
+def test_grammar_change_reparses_with_new_grammar():
+    tmp_dir = tempfile.mkdtemp()
+    grammar_file = os.path.join(tmp_dir, 'grammar.txt')
+    shutil.copyfile(grammar.GRAMMAR_FILE, grammar_file)
+    try:
+        grammar.load_bash_grammar(grammar_file)
+        cache = ParseCache()
+        cache.enable_disk(os.path.join(tmp_dir, 'asts.sqlite'))
+        tree = cache.get_or_parse(lint.normalize_ast, CMD, False)
+        assert flag_arguments(tree, '-p') == []
+
+        # -p takes the next argument in the edited grammar
+        with open(grammar_file) as f:
+            content = f.read()
+        with open(grammar_file, 'w') as o_f:
+            o_f.write(content.replace('[-p | --parents]', '[-p DIRECTORY]'))
+        stat = os.stat(grammar_file)
+        os.utime(grammar_file, (stat.st_atime, stat.st_mtime + 10))
+
+        tree = cache.get_or_parse(lint.normalize_ast, CMD, False)
+        assert flag_arguments(tree, '-p') == ['foo']
+        assert grammar.get_bash_grammar_hash() == grammar.file_hash(grammar_file)
+        assert cache.grammar_hash == grammar.get_bash_grammar_hash()
+
+        # the disk store only holds trees of the new grammar
+        cache.close()
+        cache = ParseCache()
+        cache.enable_disk(os.path.join(tmp_dir, 'asts.sqlite'))
+        tree = cache.get_or_parse(lint.normalize_ast, CMD, False)
+        assert flag_arguments(tree, '-p') == ['foo']
+        assert cache.stats()['disk_hits'] == 1
+        cache.close()
+    finally:
+        grammar.load_bash_grammar(grammar.GRAMMAR_FILE)
+        shutil.rmtree(tmp_dir)
+
+
+def test_tree_of_another_grammar_is_not_stored():
+    cache = ParseCache()
+
+    def parse_with_other_grammar(cmd, recover_quotation):
+        tree = lint.normalize_ast(cmd, recover_quotation)
+        # the grammar changes while the command is parsed
+        cache.grammar_hash = 'other'
+        return tree
+
+    grammar_hash = cache.grammar_hash
+    cache.get_or_parse(parse_with_other_grammar, CMD, False)
+    cache.grammar_hash = grammar_hash
+    assert cache.stats()['size'] == 0
@@ -11,7 +11,7 @@ import collections
 import os, sys
 sys.path.append('../../')  # for bashlint
 
-from bashlint import bash, data_tools
+from bashlint import bash, batch, data_tools
 
 data_splits = ['train', 'dev', 'test']
 
@@ -20,14 +20,9 @@ NUM_UTILITIES = 100
 def compute_top_utilities(path, k):
     print('computing top most frequent utilities...') 
     utilities = collections.defaultdict(int)
-    with open(path) as f:
-        while (True):
-            command = f.readline().strip()
-            if not command:
-                break
-            ast = data_tools.bash_parser(command, verbose=False)
-            for u in data_tools.get_utilities(ast):
-                utilities[u] += 1
+    for _, _, ast, _, _ in batch.batch_parse_file(path):
+        for u in data_tools.get_utilities(ast):
+            utilities[u] += 1
     top_utilities = []
 
     freq_threshold = -1   
@@ -62,15 +57,15 @@ def filter_by_most_frequent_utilities(data_dir, num_utilities):
             nls = [nl.strip() for nl in f.readlines()]
         with open(cm_file_path) as f:
             cms = [cm.strip() for cm in f.readlines()]
+        asts = [ast for _, _, ast, _, _ in batch.batch_parse(cms)]
         nl_outfile_path = os.path.join(data_dir, split + '.nl.filtered')
         cm_outfile_path = os.path.join(data_dir, split + '.cm.filtered')
         with open(nl_outfile_path, 'w') as nl_outfile:
             with open(cm_outfile_path, 'w') as cm_outfile:
-                for nl, cm in zip(nls, cms):
+                for nl, cm, ast in zip(nls, cms, asts):
                     if len(nl.split()) > 50:
                         print('lenthy description skipped: {}'.format(nl))
                         continue
-                    ast = data_tools.bash_parser(cm)
                     if ast and select(ast, top_utilities):
                         nl_outfile.write('{}\n'.format(nl))
                         cm_outfile.write('{}\n'.format(cm))
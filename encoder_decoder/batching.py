@@ -0,0 +1,260 @@
+"""
+Length-aware sampling and background preparation of training batches.
+
+TokenBudgetSampler replaces the random draw of a bucket followed by sampling
+with replacement from the bucket (EncoderDecoderModel.get_batch). Every epoch
+visits each training example once:
+
+    1. the examples of each bucket are sorted by (source length, target
+       length) and cut into shards of shard_size examples;
+    2. the examples of a shard are shuffled and cut into batches whose padded
+       size (batch size * (encoder size + decoder size) of the bucket) fits in
+       the token budget, so that the batches of the large buckets hold fewer
+       examples;
+    3. the batches of all shards and buckets are shuffled together.
+
+The batches are still padded to the size of their bucket, as required by the
+bucketed graphs. The training loop reports the batches it trains on to the
+sampler (record_batch), which keeps count of their real and padded positions
+so that the padding efficiency of the buckets can be monitored.
+
+BatchPrefetcher prepares the formatted batches in background threads and
+keeps them in a bounded queue, so that the training loop does not wait for
+the batches to be assembled between two session runs (TensorFlow releases
+the GIL while a step runs). It records how long the training loop waited for
+batches, hence whether training is input-bound.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import threading
+import time
+if sys.version_info > (3, 0):
+    from six.moves import xrange
+from six.moves import queue
+
+import numpy as np
+
+
+class TokenBudgetSampler(object):
+    """
+    :member buckets: list of (encoder size, decoder size) pairs
+    :member token_budget: maximum number of padded source and target
+        positions in a batch
+    :member max_batch_size: maximum number of examples in a batch
+    :member shard_size: number of length-sorted examples shuffled together
+    """
+    def __init__(self, data_points, buckets, token_budget, max_batch_size=None,
+                 shard_size=1024, seed=None):
+        """
+        :param data_points: list of the data points of each bucket
+        """
+        self.buckets = buckets
+        self.token_budget = token_budget
+        self.max_batch_size = max_batch_size
+        self.shard_size = shard_size
+        self.rng = np.random.RandomState(seed)
+
+        # [num_buckets] number of examples per batch
+        self.batch_sizes = []
+        # per bucket, data ids sorted by length and the number of real
+        # positions of each data point
+        self.sorted_ids = []
+        self.num_tokens = []
+        for bucket_id, (encoder_size, decoder_size) in enumerate(buckets):
+            batch_size = max(1, token_budget // (encoder_size + decoder_size))
+            if max_batch_size:
+                batch_size = min(batch_size, max_batch_size)
+            self.batch_sizes.append(batch_size)
+            sc_lengths = np.array([min(len(dp.sc_ids), encoder_size)
+                                   for dp in data_points[bucket_id]],
+                                  dtype=np.int64)
+            tg_lengths = np.array([min(len(dp.tg_ids), decoder_size)
+                                   for dp in data_points[bucket_id]],
+                                  dtype=np.int64)
+            self.sorted_ids.append(np.lexsort((tg_lengths, sc_lengths)))
+            self.num_tokens.append(sc_lengths + tg_lengths)
+
+        # epoch of the batches produced by the iterator
+        self.epoch = 0
+        # epoch and positions of the batches recorded by the consumer
+        self.trained_epoch = 0
+        self.real_positions = 0
+        self.padded_positions = 0
+
+    def epoch_batches(self):
+        """
+        :return: the shuffled list of (bucket_id, data_ids) batches of an epoch.
+        """
+        batches = []
+        for bucket_id, sorted_ids in enumerate(self.sorted_ids):
+            batch_size = self.batch_sizes[bucket_id]
+            for start in xrange(0, len(sorted_ids), self.shard_size):
+                shard = sorted_ids[start:start + self.shard_size].copy()
+                self.rng.shuffle(shard)
+                for i in xrange(0, len(shard), batch_size):
+                    batches.append((bucket_id, shard[i:i + batch_size]))
+        order = self.rng.permutation(len(batches))
+        return [batches[i] for i in order]
+
+    def __iter__(self):
+        """
+        Iterate over the batches of consecutive epochs. self.epoch is the
+        epoch of the last batch produced.
+        """
+        while True:
+            batches = self.epoch_batches()
+            if not batches:
+                return
+            for bucket_id, data_ids in batches:
+                yield bucket_id, data_ids
+            self.epoch += 1
+
+    def count_positions(self, bucket_id, data_ids):
+        """
+        :return: the number of real and padded positions of a batch.
+        """
+        encoder_size, decoder_size = self.buckets[bucket_id]
+        return (int(np.sum(self.num_tokens[bucket_id][data_ids])),
+                len(data_ids) * (encoder_size + decoder_size))
+
+    def record_batch(self, epoch, real_positions, padded_positions):
+        """
+        Count a batch the model has been trained on. Called by the consumer of
+        the batches only, so that the batches produced ahead of time (e.g.
+        queued by BatchPrefetcher) are not counted.
+        """
+        self.trained_epoch = epoch
+        self.real_positions += real_positions
+        self.padded_positions += padded_positions
+
+    def padding_efficiency(self, bucket_id=None):
+        """
+        :return: the proportion of real (non-PAD) positions in the batches of
+            a bucket (of all buckets if bucket_id is None).
+        """
+        if bucket_id is None:
+            bucket_ids = range(len(self.buckets))
+        else:
+            bucket_ids = [bucket_id]
+        real, padded = 0, 0
+        for b in bucket_ids:
+            encoder_size, decoder_size = self.buckets[b]
+            real += int(np.sum(self.num_tokens[b]))
+            padded += len(self.num_tokens[b]) * (encoder_size + decoder_size)
+        return real / padded if padded else 1.0
+
+    def stats(self):
+        """
+        Report and reset the number of real and padded positions of the
+        batches recorded since the last call, and the epoch of the last one.
+        """
+        stats = {
+            'epoch': self.trained_epoch,
+            'real_positions': self.real_positions,
+            'padded_positions': self.padded_positions,
+            'padding_efficiency':
+                self.real_positions / self.padded_positions
+                if self.padded_positions else 1.0
+        }
+        self.real_positions, self.padded_positions = 0, 0
+        return stats
+
+    def print_buckets(self):
+        for bucket_id, bucket in enumerate(self.buckets):
+            print('bucket {}: {} batch size {} padding efficiency {:.3f}'.format(
+                bucket_id, bucket, self.batch_sizes[bucket_id],
+                self.padding_efficiency(bucket_id)))
+        print('padding efficiency {:.3f}'.format(self.padding_efficiency()))
+
+
+class BatchPrefetcher(object):
+    """
+    Producer/consumer pipeline of formatted training batches.
+
+    :member next_batch_fun: function returning the next batch (e.g. a
+        (bucket_id, formatted example) pair), called by the worker threads
+    :member queue_size: maximum number of batches prepared ahead of time
+    :member num_workers: number of worker threads
+    """
+    def __init__(self, next_batch_fun, queue_size=8, num_workers=1):
+        self.next_batch_fun = next_batch_fun
+        self.queue_size = queue_size
+        self.num_workers = num_workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.workers = []
+        self.reset_stats()
+
+    def start(self):
+        for _ in xrange(self.num_workers):
+            worker = threading.Thread(target=self.run)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        return self
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                item = (self.next_batch_fun(), None)
+            except Exception as e:
+                item = (None, e)
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if item[1] is not None:
+                break
+
+    def get(self):
+        """
+        :return: the next batch returned by next_batch_fun. Exceptions
+            raised by next_batch_fun are re-raised here.
+        """
+        queue_size = self.queue.qsize()
+        start_time = time.time()
+        batch, error = self.queue.get()
+        self.wait_time += time.time() - start_time
+        self.num_steps += 1
+        self.total_queue_size += queue_size
+        if queue_size == 0:
+            self.num_starved_steps += 1
+        if error is not None:
+            raise error
+        return batch
+
+    def reset_stats(self):
+        self.num_steps = 0
+        self.num_starved_steps = 0
+        self.wait_time = 0.0
+        self.total_queue_size = 0
+
+    def stats(self):
+        """
+        Report and reset the input pipeline metrics of the steps since the
+        last call:
+            starved_steps: number of steps which found the queue empty
+            wait_time: time (in seconds) spent waiting for batches
+            average_queue_size: average number of batches ready at each step
+        """
+        stats = {
+            'steps': self.num_steps,
+            'starved_steps': self.num_starved_steps,
+            'wait_time': self.wait_time,
+            'average_queue_size':
+                self.total_queue_size / self.num_steps if self.num_steps else 0.0
+        }
+        self.reset_stats()
+        return stats
+
+    def close(self):
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
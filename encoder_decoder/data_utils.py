@@ -8,8 +8,12 @@ from __future__ import print_function
 
 import collections
 import functools
+import hashlib
+import json
+import multiprocessing
 import os
 import pickle
+import shutil
 import sys
 
 import numpy as np
@@ -147,10 +151,109 @@ def load_data(FLAGS, use_buckets=True, load_mappings=False):
 
 def read_data(FLAGS, split, source, target, use_buckets=True, buckets=None,
               add_start_token=False, add_end_token=False):
-    vocab = load_vocabulary(FLAGS)
+    use_copy = FLAGS.use_copy and FLAGS.copy_fun == 'copynet'
+    # use the compiled dataset if it is up to date (see compile_data)
+    dataset = load_compiled_data_points(
+        FLAGS, split, source, target, add_start_token=add_start_token,
+        add_end_token=add_end_token, use_copy=use_copy)
+    if dataset is None:
+        dataset = read_data_points(
+            FLAGS, split, source, target, add_start_token=add_start_token,
+            add_end_token=add_end_token, use_copy=use_copy)
+    max_sc_length = max([len(dp.sc_ids) for dp in dataset] or [0])
+    max_tg_length = max([len(dp.tg_ids) for dp in dataset] or [0])
+
+    print('{} data points read.'.format(len(dataset)))
+    print('max_source_length = {}'.format(max_sc_length))
+    print('max_target_length = {}'.format(max_tg_length))
+
+    data_size = len(dataset)
 
-    def get_data_file_path(data_dir, split, lang, channel):
-        return os.path.join(data_dir, '{}.{}.{}'.format(split, lang, channel))
+    def print_bucket_size(bs):
+        print('bucket size = ({}, {})'.format(bs[0], bs[1]))
+
+    if use_buckets:
+        print('Group data points into buckets...')
+        if split == 'train':
+            # Determine bucket sizes based on the characteristics of the dataset
+            num_buckets = FLAGS.num_buckets
+            bucket_capacity = int(len(dataset) / num_buckets)
+            assert(bucket_capacity > 0)
+            # Excluding outliers (very long sequences)
+            length_cutoff = 0.01
+            # A. Determine maximum source length
+            sorted_dataset = sorted(dataset, key=lambda x:len(x.sc_ids), reverse=True)
+            max_sc_length = len(sorted_dataset[int(len(sorted_dataset) * length_cutoff)].sc_ids)
+            # B. Determine maximum target length
+            sorted_dataset = sorted(dataset, key=lambda x:len(x.tg_ids), reverse=True)
+            max_tg_length = len(sorted_dataset[int(len(sorted_dataset) * length_cutoff)].tg_ids)
+            print('max_source_length after filtering = {}'.format(max_sc_length))
+            print('max_target_length after filtering = {}'.format(max_tg_length))
+            # Determine thresholds for buckets of equal capacity
+            buckets = []
+            sorted_dataset = sorted(dataset, key=lambda x:len(x.sc_ids), reverse=False)
+            max_tg_len_so_far = 0
+            for i, dp in enumerate(sorted_dataset):
+                if len(dp.sc_ids) > max_sc_length:
+                    break
+                if len(dp.tg_ids) > max_tg_len_so_far:
+                    max_tg_len_so_far = len(dp.tg_ids)
+                if i > 0 and i % bucket_capacity == 0:
+                    buckets.append((len(dp.sc_ids)+1, min(max_tg_len_so_far, max_tg_length)+1))
+            if len(buckets) == 0 or buckets[-1][0] < max(max_sc_length, max_tg_length):
+                buckets.append((max_sc_length+1,
+                                min(max_tg_len_so_far, max_tg_length)+1))
+        else:
+            num_buckets = len(buckets)
+            assert(num_buckets >= 1)
+
+        dataset2 = [[] for _ in buckets]
+        for i in range(len(dataset)):
+            data_point = dataset[i]
+            # Compute bucket id
+            bucket_ids = [b for b in xrange(len(buckets))
+                          if buckets[b][0] > len(data_point.sc_ids) and
+                          buckets[b][1] > len(data_point.tg_ids)]
+            if bucket_ids:
+                bucket_id = min(bucket_ids)
+                dataset2[bucket_id].append(data_point)
+            else:
+                if split != 'train':
+                    bucket_id = len(buckets) - 1
+                    dataset2[bucket_id].append(data_point)
+        dataset = dataset2
+        if split != 'train':
+            assert(len(functools.reduce(lambda x, y: x + y, dataset)) == data_size)
+      
+    D = DataSet()
+    D.data_points = dataset
+    if split == 'train':
+        D.max_sc_length = max_sc_length
+        D.max_tg_length = max_tg_length
+        if use_buckets:
+            D.buckets = buckets
+
+    return D
+
+
+def get_data_file_path(data_dir, split, lang, channel):
+    return os.path.join(data_dir, '{}.{}.{}'.format(split, lang, channel))
+
+
+def get_token_ext(FLAGS):
+    return 'normalized.{}'.format(FLAGS.channel) \
+        if FLAGS.normalized else FLAGS.channel
+
+
+def read_data_points(FLAGS, split, source, target, add_start_token=False,
+                     add_end_token=False, use_copy=False):
+    """
+    Read the data points of a dataset split from the text files saved by
+    prepare_data.
+
+    :param use_copy: if set, compute the CopyNet source and target ids.
+    """
+    vocab = load_vocabulary(FLAGS)
 
     def get_source_ids(s):
         source_ids = []
@@ -177,8 +280,7 @@ def read_data(FLAGS, split, source, target, use_buckets=True, buckets=None,
     data_dir = FLAGS.data_dir
     sc_path = get_data_file_path(data_dir, split, source, 'filtered')
     tg_path = get_data_file_path(data_dir, split, target, 'filtered')
-    token_ext = 'normalized.{}'.format(FLAGS.channel) \
-        if FLAGS.normalized else FLAGS.channel
+    token_ext = get_token_ext(FLAGS)
     sc_token_path = get_data_file_path(data_dir, split, source, token_ext)
     tg_token_path = get_data_file_path(data_dir, split, target, token_ext)
     print("source file: {}".format(sc_path))
@@ -187,41 +289,27 @@ def read_data(FLAGS, split, source, target, use_buckets=True, buckets=None,
     print("target tokenized sequence file: {}".format(tg_token_path))
 
     dataset = []
-    num_data = 0
-    max_sc_length = 0
-    max_tg_length = 0
     sc_file = open(sc_path)
     tg_file = open(tg_path)
     sc_token_file = open(sc_token_path)
     tg_token_file = open(tg_token_path)
-    with open(os.path.join(data_dir, '{}.{}.align'.format(split, FLAGS.channel)),
-              'rb') as f:
-        alignments = pickle.load(f)
+    alignments = load_alignments(data_dir, split, FLAGS.channel)
     for i, sc_txt in enumerate(sc_file.readlines()):
         data_point = DataPoint()
         data_point.sc_txt = sc_txt.strip()
         data_point.tg_txt = tg_file.readline().strip()
         data_point.sc_ids = \
             get_source_ids(sc_token_file.readline().strip())
-        if len(data_point.sc_ids) > max_sc_length:
-            max_sc_length = len(data_point.sc_ids)
         data_point.tg_ids = \
             get_target_input_ids(tg_token_file.readline().strip())
         data_point.alignments = alignments[i]
-        if len(data_point.tg_ids) > max_tg_length:
-            max_tg_length = len(data_point.tg_ids)
         dataset.append(data_point)
-        num_data += 1
     sc_file.close()
     tg_file.close()
     sc_token_file.close()
     tg_token_file.close()
 
-    print('{} data points read.'.format(num_data))
-    print('max_source_length = {}'.format(max_sc_length))
-    print('max_target_length = {}'.format(max_tg_length))
-
-    if FLAGS.use_copy and FLAGS.copy_fun == 'copynet':
+    if use_copy:
         copy_token_ext = 'copy.{}'.format(token_ext)
         sc_copy_token_path = get_data_file_path(data_dir, split, source,
                                                 copy_token_ext)
@@ -245,74 +333,254 @@ def read_data(FLAGS, split, source, target, use_buckets=True, buckets=None,
         tg_token_file.close()
         sc_copy_token_file.close()
         tg_copy_token_file.close()
-    
-    data_size = len(dataset)
 
-    def print_bucket_size(bs):
-        print('bucket size = ({}, {})'.format(bs[0], bs[1]))
+    return dataset
 
-    if use_buckets:
-        print('Group data points into buckets...')
-        if split == 'train':
-            # Determine bucket sizes based on the characteristics of the dataset
-            num_buckets = FLAGS.num_buckets
-            bucket_capacity = int(len(dataset) / num_buckets)
-            assert(bucket_capacity > 0)
-            # Excluding outliers (very long sequences)
-            length_cutoff = 0.01
-            # A. Determine maximum source length
-            sorted_dataset = sorted(dataset, key=lambda x:len(x.sc_ids), reverse=True)
-            max_sc_length = len(sorted_dataset[int(len(sorted_dataset) * length_cutoff)].sc_ids)
-            # B. Determine maximum target length
-            sorted_dataset = sorted(dataset, key=lambda x:len(x.tg_ids), reverse=True)
-            max_tg_length = len(sorted_dataset[int(len(sorted_dataset) * length_cutoff)].tg_ids)
-            print('max_source_length after filtering = {}'.format(max_sc_length))
-            print('max_target_length after filtering = {}'.format(max_tg_length))
-            # Determine thresholds for buckets of equal capacity
-            buckets = []
-            sorted_dataset = sorted(dataset, key=lambda x:len(x.sc_ids), reverse=False)
-            max_tg_len_so_far = 0
-            for i, dp in enumerate(sorted_dataset):
-                if len(dp.sc_ids) > max_sc_length:
-                    break
-                if len(dp.tg_ids) > max_tg_len_so_far:
-                    max_tg_len_so_far = len(dp.tg_ids)
-                if i > 0 and i % bucket_capacity == 0:
-                    buckets.append((len(dp.sc_ids)+1, min(max_tg_len_so_far, max_tg_length)+1))
-            if len(buckets) == 0 or buckets[-1][0] < max(max_sc_length, max_tg_length):
-                buckets.append((max_sc_length+1,
-                                min(max_tg_len_so_far, max_tg_length)+1))
+
+# --- Compiled datasets --- #
+
+# Increase when the layout of the compiled datasets changes.
+COMPILED_DATA_VERSION = 1
+
+
+class SparseAlignment(object):
+    """
+    Binary alignment matrix between the tokens of a source and a target
+    sequence, stored as the coordinates of its non-zero entries.
+    """
+    def __init__(self, rows, cols, shape):
+        self.rows = rows
+        self.cols = cols
+        self.shape = shape
+
+    def nonzero(self):
+        return self.rows, self.cols
+
+    def tocsr(self):
+        return ssp.csr_matrix(
+            (np.ones(len(self.rows), dtype=np.int32), (self.rows, self.cols)),
+            shape=self.shape)
+
+    def toarray(self):
+        return self.tocsr().toarray()
+
+
+def get_compiled_data_path(FLAGS, split, source, target, add_start_token=False,
+                           add_end_token=False):
+    return os.path.join(FLAGS.data_dir, '{}.{}-{}.{}.min{}{}{}.compiled'.format(
+        split, source, target, get_token_ext(FLAGS), FLAGS.min_vocab_frequency,
+        '.start' if add_start_token else '', '.end' if add_end_token else ''))
+
+
+def get_compiled_data_inputs(FLAGS, split, source, target):
+    """
+    :return: the files a compiled dataset is computed from, and the CopyNet
+        token files.
+    """
+    data_dir = FLAGS.data_dir
+    token_ext = get_token_ext(FLAGS)
+    vocab_ext = 'vocab.{}'.format(token_ext)
+    alignment_path = get_alignment_path(data_dir, split, FLAGS.channel)
+    if not os.path.exists(alignment_path):
+        alignment_path = os.path.join(
+            data_dir, '{}.{}.align'.format(split, FLAGS.channel))
+    inputs = [
+        get_data_file_path(data_dir, split, source, 'filtered'),
+        get_data_file_path(data_dir, split, target, 'filtered'),
+        get_data_file_path(data_dir, split, source, token_ext),
+        get_data_file_path(data_dir, split, target, token_ext),
+        alignment_path,
+        os.path.join(data_dir, '{}.{}'.format(source, vocab_ext)),
+        os.path.join(data_dir, '{}.{}'.format(target, vocab_ext))
+    ]
+    copy_inputs = [
+        get_data_file_path(data_dir, split, source, 'copy.{}'.format(token_ext)),
+        get_data_file_path(data_dir, split, target, 'copy.{}'.format(token_ext))
+    ]
+    return inputs, copy_inputs
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [os.path.basename(path), stat.st_size, stat.st_mtime]
+
+
+def compile_data_points(FLAGS, split, source, target, add_start_token=False,
+                        add_end_token=False):
+    """
+    Save the data points of a dataset split in the compiled format loaded by
+    load_compiled_data_points:
+        {sc, tg}_ids, {sc, tg}_offsets: flat int32 token ids and the int64
+            offsets of the data points
+        {csc, ctg}_ids, {csc, ctg}_offsets: CopyNet ids (if the copy token
+            files exist)
+        align_rows, align_cols, align_offsets, align_shapes: coordinates of
+            the non-zero alignment entries of each data point and the shapes
+            of the alignment matrices
+        sc.txt, tg.txt: the source and target strings, one per line
+        meta.json: the version, the configuration and the size and
+            modification time of the input files
+    """
+    inputs, copy_inputs = get_compiled_data_inputs(FLAGS, split, source, target)
+    use_copy = all(os.path.exists(path) for path in copy_inputs)
+    dataset = read_data_points(
+        FLAGS, split, source, target, add_start_token=add_start_token,
+        add_end_token=add_end_token, use_copy=use_copy)
+
+    def flatten(sequences):
+        offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(x) for x in sequences])
+        ids = np.fromiter((x for sequence in sequences for x in sequence),
+                          dtype=np.int32, count=int(offsets[-1]))
+        return ids, offsets
+
+    arrays = {}
+    arrays['sc_ids'], arrays['sc_offsets'] = \
+        flatten([dp.sc_ids for dp in dataset])
+    arrays['tg_ids'], arrays['tg_offsets'] = \
+        flatten([dp.tg_ids for dp in dataset])
+    if use_copy:
+        arrays['csc_ids'], arrays['csc_offsets'] = \
+            flatten([dp.csc_ids for dp in dataset])
+        arrays['ctg_ids'], arrays['ctg_offsets'] = \
+            flatten([dp.ctg_ids for dp in dataset])
+    # missing alignments are saved with the shape (-1, -1)
+    nonzeros = [dp.alignments.nonzero() if dp.alignments is not None
+                else ([], []) for dp in dataset]
+    arrays['align_rows'], arrays['align_offsets'] = \
+        flatten([rows for rows, _ in nonzeros])
+    arrays['align_cols'], _ = flatten([cols for _, cols in nonzeros])
+    arrays['align_shapes'] = np.array(
+        [dp.alignments.shape if dp.alignments is not None else (-1, -1)
+         for dp in dataset], dtype=np.int32).reshape([-1, 2])
+
+    path = get_compiled_data_path(FLAGS, split, source, target,
+                                  add_start_token, add_end_token)
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), array)
+    with open(os.path.join(tmp_path, 'sc.txt'), 'w') as o_f:
+        o_f.write('\n'.join(dp.sc_txt for dp in dataset))
+    with open(os.path.join(tmp_path, 'tg.txt'), 'w') as o_f:
+        o_f.write('\n'.join(dp.tg_txt for dp in dataset))
+    meta = {
+        'version': COMPILED_DATA_VERSION,
+        'size': len(dataset),
+        'copy': use_copy,
+        'inputs': [file_signature(x)
+                   for x in inputs + (copy_inputs if use_copy else [])]
+    }
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as o_f:
+        json.dump(meta, o_f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    print('compiled dataset saved to {}'.format(path))
+
+
+def get_compiled_data_meta(FLAGS, split, source, target, add_start_token=False,
+                           add_end_token=False, use_copy=False):
+    """
+    :return: the meta data of a compiled dataset split, or None if the
+        compiled dataset does not exist or is out of date.
+    """
+    path = get_compiled_data_path(FLAGS, split, source, target,
+                                  add_start_token, add_end_token)
+    meta_path = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    inputs, copy_inputs = get_compiled_data_inputs(FLAGS, split, source, target)
+    if use_copy:
+        if not meta['copy']:
+            return None
+        inputs = inputs + copy_inputs
+    try:
+        signatures = [file_signature(x) for x in inputs]
+    except OSError:
+        return None
+    if meta['version'] != COMPILED_DATA_VERSION or \
+            signatures != meta['inputs'][:len(inputs)]:
+        print('compiled dataset {} is out of date'.format(path))
+        return None
+    return meta
+
+
+def load_compiled_data_points(FLAGS, split, source, target,
+                              add_start_token=False, add_end_token=False,
+                              use_copy=False):
+    """
+    Load the data points of a compiled dataset split. The id arrays are
+    memory-mapped: the ids of the data points are read-only views of the
+    files, shared by all processes which load them.
+
+    :return: the list of data points, or None if the compiled dataset does
+        not exist or is out of date.
+    """
+    meta = get_compiled_data_meta(FLAGS, split, source, target, add_start_token,
+                                  add_end_token, use_copy)
+    if meta is None:
+        return None
+    path = get_compiled_data_path(FLAGS, split, source, target,
+                                  add_start_token, add_end_token)
+    print('compiled dataset: {}'.format(path))
+
+    def load(name):
+        return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+    def views(name):
+        ids, offsets = load(name + '_ids'), load(name + '_offsets').tolist()
+        return [ids[offsets[i]:offsets[i+1]] for i in xrange(meta['size'])]
+
+    def read_lines(name):
+        with open(os.path.join(path, name)) as f:
+            lines = f.read().split('\n')
+        return lines if meta['size'] > 0 else []
+
+    sc_txts, tg_txts = read_lines('sc.txt'), read_lines('tg.txt')
+    sc_ids, tg_ids = views('sc'), views('tg')
+    if use_copy:
+        csc_ids, ctg_ids = views('csc'), views('ctg')
+    align_rows, align_cols = load('align_rows'), load('align_cols')
+    align_offsets = load('align_offsets').tolist()
+    align_shapes = [tuple(shape) for shape in load('align_shapes').tolist()]
+
+    dataset = []
+    for i in xrange(meta['size']):
+        data_point = DataPoint()
+        data_point.sc_txt = sc_txts[i]
+        data_point.tg_txt = tg_txts[i]
+        data_point.sc_ids = sc_ids[i]
+        data_point.tg_ids = tg_ids[i]
+        if use_copy:
+            data_point.csc_ids = csc_ids[i]
+            data_point.ctg_ids = ctg_ids[i]
+        if align_shapes[i][0] >= 0:
+            start, end = align_offsets[i], align_offsets[i+1]
+            data_point.alignments = SparseAlignment(
+                align_rows[start:end], align_cols[start:end], align_shapes[i])
         else:
-            num_buckets = len(buckets)
-            assert(num_buckets >= 1)
+            data_point.alignments = None
+        dataset.append(data_point)
+    return dataset
 
-        dataset2 = [[] for _ in buckets]
-        for i in range(len(dataset)):
-            data_point = dataset[i]
-            # Compute bucket id
-            bucket_ids = [b for b in xrange(len(buckets))
-                          if buckets[b][0] > len(data_point.sc_ids) and
-                          buckets[b][1] > len(data_point.tg_ids)]
-            if bucket_ids:
-                bucket_id = min(bucket_ids)
-                dataset2[bucket_id].append(data_point)
-            else:
-                if split != 'train':
-                    bucket_id = len(buckets) - 1
-                    dataset2[bucket_id].append(data_point)
-        dataset = dataset2
-        if split != 'train':
-            assert(len(functools.reduce(lambda x, y: x + y, dataset)) == data_size)
-      
-    D = DataSet()
-    D.data_points = dataset
-    if split == 'train':
-        D.max_sc_length = max_sc_length
-        D.max_tg_length = max_tg_length
-        if use_buckets:
-            D.buckets = buckets
 
-    return D
+def compile_data(FLAGS):
+    """
+    Compile the dataset splits read by load_data which are not up to date.
+    """
+    source, target = ('nl', 'cm') if not FLAGS.explain else ('cm', 'nl')
+    for split in data_splits:
+        _, copy_inputs = get_compiled_data_inputs(FLAGS, split, source, target)
+        use_copy = all(os.path.exists(path) for path in copy_inputs)
+        if get_compiled_data_meta(FLAGS, split, source, target, True, True,
+                                  use_copy=use_copy) is None:
+            compile_data_points(FLAGS, split, source, target,
+                                add_start_token=True, add_end_token=True)
 
 
 def load_vocabulary(FLAGS):
@@ -438,19 +706,38 @@ def prepare_data(FLAGS):
         (2) cm vocabulary
         (3) nl token ids
         (4) cm token ids
+        (5) the compiled dataset splits of the channel (see
+            compile_data_points)
+
+    Every line is tokenized once per tokenizer configuration (see
+    TOKENIZER_CONFIGS) and the tokens are shared by all channels; the features
+    of a (split, channel) pair are only recomputed when its input files or the
+    hash of its tokenizer configurations change.
     """
     data_dir = FLAGS.data_dir
     channel = FLAGS.channel if FLAGS.channel else ''
     if channel and FLAGS.normalized:
         channel = 'normalized.{}'.format(channel)
-    prepare_dataset_split(data_dir, 'train', channel=channel)
-    prepare_dataset_split(data_dir, 'dev', channel=channel)
-    prepare_dataset_split(data_dir, 'test', channel=channel)
-
-
-def prepare_dataset_split(data_dir, split, channel=''):
+    channels = [channel] if channel else list(CHANNEL_CONFIGS.keys())
+    num_processes = FLAGS.num_data_processes or None
+    # the vocabularies used by the dev and test splits are created with the
+    # train split
+    for split in data_splits:
+        prepare_dataset_split(data_dir, split, channels=channels,
+                              num_processes=num_processes)
+    if FLAGS.channel:
+        compile_data(FLAGS)
+
+
+def prepare_dataset_split(data_dir, split, channel='', channels=None,
+                          num_processes=None):
     """
     Process a specific dataset split.
+
+    :param channels: list of channels to process (all channels if channel
+        and channels are not set).
+    :param num_processes: number of tokenization worker processes (defaults
+        to the number of CPUs); no pool is created if set to 1.
     """
     def read_parallel_data(nl_path, cm_path):
         with open(nl_path) as f:
@@ -459,35 +746,71 @@ def prepare_dataset_split(data_dir, split, channel=''):
             cm_list = [cm.strip() for cm in f.readlines()]
         return nl_list, cm_list
 
+    if channels is None:
+        channels = [channel] if channel else list(CHANNEL_CONFIGS.keys())
     print("Split - {}".format(split))
     nl_path = os.path.join(data_dir, split + '.nl.filtered')
     cm_path = os.path.join(data_dir, split + '.cm.filtered')
+
+    stamps = {}
+    for channel in channels:
+        stamps[channel] = get_channel_stamp(data_dir, split, channel)
+        if is_channel_up_to_date(data_dir, split, channel, stamps[channel]):
+            print("    channel - {} (up to date)".format(channel))
+            del stamps[channel]
+    if not stamps:
+        return
+
     nl_list, cm_list = read_parallel_data(nl_path, cm_path)
+    inputs = {'nl': nl_list, 'cm': cm_list}
+    config_names = sorted(set(
+        config_name for channel in stamps
+        for config_name in CHANNEL_CONFIGS[channel][:3] if config_name))
+    tokens = tokenize_with_cache(
+        data_dir, [(x, inputs[TOKENIZER_CONFIGS[x][0]]) for x in config_names],
+        num_processes=num_processes)
 
-    # character based processing
-    if not channel or channel == 'char':
-        prepare_channel(data_dir, nl_list, cm_list, split, channel='char',
-                        parallel_data_to_tokens=parallel_data_to_characters)
-    # partial-token based processing
-    if not channel or channel == 'partial.token':
-        prepare_channel(data_dir, nl_list, cm_list, split, channel='partial.token',
-                        parallel_data_to_tokens=parallel_data_to_partial_tokens)
-    # token based processing
-    if not channel or channel == 'token':
-        prepare_channel(data_dir, nl_list, cm_list, split, channel='token',
-                        parallel_data_to_tokens=parallel_data_to_tokens)
-    # normalized token based processing
-    if not channel or channel == 'normalized.token':
-        prepare_channel(data_dir, nl_list, cm_list, split, channel='normalized.token',
-                        parallel_data_to_tokens=parallel_data_to_normalized_tokens)
+    for channel in channels:
+        if channel in stamps:
+            prepare_channel(data_dir, nl_list, cm_list, split, channel,
+                            tokens=tokens)
+            save_channel_stamp(data_dir, split, channel, stamps[channel])
 
 
 def prepare_channel(data_dir, nl_list, cm_list, split, channel,
-                    parallel_data_to_tokens):
+                    parallel_data_to_tokens=None, tokens=None):
+    """
+    :param parallel_data_to_tokens: function tokenizing the natural language
+        and the command lists.
+    :param tokens: if parallel_data_to_tokens is not set, dictionary mapping
+        the names of the tokenizer configurations of the channel (see
+        CHANNEL_CONFIGS) to the tokens of the lines of the split.
+    """
     print("    channel - {}".format(channel))
-    # Tokenize data
-    nl_tokens, cm_tokens = \
-        parallel_data_to_tokens(nl_list, cm_list)
+    if parallel_data_to_tokens is None:
+        nl_config, cm_config, nl_copy_config, partial_nl = \
+            CHANNEL_CONFIGS[channel]
+        nl_tokens, cm_tokens = tokens[nl_config], tokens[cm_config]
+        nl_copy_tokens = tokens[nl_copy_config] if nl_copy_config else nl_tokens
+        if partial_nl:
+            nl_tokens = [string_to_partial_tokens(x, use_arg_start_end=False)
+                         for x in nl_tokens]
+            nl_copy_tokens = [string_to_partial_tokens(x, use_arg_start_end=False)
+                              for x in nl_copy_tokens]
+    else:
+        # Tokenize data
+        nl_tokens, cm_tokens = \
+            parallel_data_to_tokens(nl_list, cm_list)
+        # For copying
+        if channel == 'char':
+            nl_copy_tokens = nl_tokens
+        elif channel == 'partial.token':
+            nl_copy_tokens = [nl_to_partial_tokens(nl, tokenizer.basic_tokenizer,
+                to_lower_case=False, lemmatization=False) for nl in nl_list]
+        else:
+            nl_copy_tokens = [nl_to_tokens(nl, tokenizer.basic_tokenizer,
+                to_lower_case=False, lemmatization=False) for nl in nl_list]
+    cm_copy_tokens = cm_tokens
     save_channel_features_to_file(data_dir, split, channel, nl_tokens, cm_tokens,
                                   feature_separator=TOKEN_SEPARATOR)
     # Create or load vocabulary
@@ -496,28 +819,15 @@ def prepare_channel(data_dir, nl_list, cm_list, split, channel,
     nl_vocab = create_vocabulary(nl_vocab_path, nl_tokens) \
         if split == 'train' else initialize_vocabulary(nl_vocab_path)[0]
     cm_vocab = create_vocabulary(cm_vocab_path, cm_tokens) \
-        if split == 'train' else initialize_vocabulary(cm_vocab_path)
+        if split == 'train' else initialize_vocabulary(cm_vocab_path)[0]
     nl_ids = [tokens_to_ids(data_point, nl_vocab) for data_point in nl_tokens]
     cm_ids = [tokens_to_ids(data_point, cm_vocab) for data_point in cm_tokens]
     save_channel_features_to_file(data_dir, split, 'ids.{}'.format(channel),
                                   nl_ids, cm_ids, feature_separator=' ')
-    # For copying
-    if channel == 'char':
-        nl_copy_tokens, cm_copy_tokens = nl_tokens, cm_tokens
-    else:
-        if channel == 'partial.token':
-            nl_copy_tokens = [nl_to_partial_tokens(nl, tokenizer.basic_tokenizer,
-                to_lower_case=False, lemmatization=False) for nl in nl_list]
-        else:
-            nl_copy_tokens = [nl_to_tokens(nl, tokenizer.basic_tokenizer,
-                to_lower_case=False, lemmatization=False) for nl in nl_list]
-        cm_copy_tokens = cm_tokens
     save_channel_features_to_file(data_dir, split, 'copy.{}'.format(channel),
         nl_copy_tokens, cm_copy_tokens, feature_separator=TOKEN_SEPARATOR)
     alignments = compute_alignments(data_dir, nl_tokens, cm_tokens, split, channel)
-    with open(os.path.join(data_dir, '{}.{}.align'.format(split, channel)),
-              'wb') as o_f:
-        pickle.dump(alignments, o_f)
+    save_alignments(data_dir, split, channel, alignments)
 
 
 def save_channel_features_to_file(data_dir, split, channel, nl_features,
@@ -730,6 +1040,223 @@ def tokens_to_ids(tokens, vocabulary):
     return token_ids
 
 
+# --- Tokenizer configurations --- #
+
+# Increase when the output of a tokenizer configuration changes (the source
+# code of the tokenizer packages is part of the configuration hashes).
+TOKENIZATION_VERSION = 1
+
+TOKENIZATION_CACHE_DIR = 'tokenization.cache'
+
+
+def nl_to_tokens_cased(nl):
+    return nl_to_tokens(nl, tokenizer.basic_tokenizer, to_lower_case=False,
+                        lemmatization=False)
+
+
+def nl_to_basic_tokens(nl):
+    return nl_to_tokens(nl, tokenizer.basic_tokenizer)
+
+
+def nl_to_ner_tokens(nl):
+    return nl_to_tokens(nl, tokenizer.ner_tokenizer)
+
+
+def cm_to_basic_tokens(cm):
+    return cm_to_tokens(cm, data_tools.bash_tokenizer)
+
+
+def cm_to_basic_partial_tokens(cm):
+    return cm_to_partial_tokens(cm, data_tools.bash_tokenizer)
+
+
+def cm_to_normalized_tokens(cm):
+    return cm_to_tokens(cm, data_tools.bash_tokenizer, arg_type_only=True)
+
+
+# tokenizer configuration -> (input language, tokenization function)
+TOKENIZER_CONFIGS = {
+    'nl.char': ('nl', nl_to_characters),
+    'nl.token': ('nl', nl_to_basic_tokens),
+    'nl.token.cased': ('nl', nl_to_tokens_cased),
+    'nl.normalized.token': ('nl', nl_to_ner_tokens),
+    'cm.char': ('cm', cm_to_characters),
+    'cm.token': ('cm', cm_to_basic_tokens),
+    'cm.partial.token': ('cm', cm_to_basic_partial_tokens),
+    'cm.normalized.token': ('cm', cm_to_normalized_tokens)
+}
+
+# channel -> (nl configuration, cm configuration, nl copy configuration (None
+# if the copy tokens are the nl tokens), split the nl tokens into partial
+# tokens)
+CHANNEL_CONFIGS = collections.OrderedDict([
+    ('char', ('nl.char', 'cm.char', None, False)),
+    ('partial.token', ('nl.token', 'cm.partial.token', 'nl.token.cased', True)),
+    ('token', ('nl.token', 'cm.token', 'nl.token.cased', False)),
+    ('normalized.token',
+     ('nl.normalized.token', 'cm.normalized.token', 'nl.token.cased', False))
+])
+
+tokenizer_config_hashes = {}
+
+
+def package_source_hash(package):
+    """
+    Hash of the Python source files and the grammar files of a package.
+    """
+    package_dir = os.path.dirname(package.__file__)
+    sha1 = hashlib.sha1()
+    for root, dirs, file_names in os.walk(package_dir):
+        dirs[:] = sorted(x for x in dirs if x != '__pycache__')
+        for file_name in sorted(file_names):
+            # parsetab.py is generated by the parser
+            if not file_name.endswith(('.py', '.txt')) or \
+                    file_name == 'parsetab.py':
+                continue
+            path = os.path.join(root, file_name)
+            sha1.update(os.path.relpath(path, package_dir).encode('utf-8'))
+            with open(path, 'rb') as f:
+                sha1.update(f.read())
+    return sha1.hexdigest()
+
+
+def get_tokenizer_config_hash(config_name):
+    if config_name not in tokenizer_config_hashes:
+        import bashlint
+        import nlp_tools
+        lang, tokenize_fun = TOKENIZER_CONFIGS[config_name]
+        # the command tokenizers also normalize natural language constants
+        packages = [nlp_tools] if lang == 'nl' else [bashlint, nlp_tools]
+        content = '\t'.join([str(TOKENIZATION_VERSION), config_name,
+                             tokenize_fun.__name__] +
+                            [package_source_hash(x) for x in packages])
+        tokenizer_config_hashes[config_name] = \
+            hashlib.sha1(content.encode('utf-8')).hexdigest()
+    return tokenizer_config_hashes[config_name]
+
+
+def tokenize_item(item):
+    """
+    Tokenize a line in a worker process.
+
+    :param item: (tokenizer configuration, line)
+    """
+    config_name, line = item
+    return TOKENIZER_CONFIGS[config_name][1](line)
+
+
+def tokenize_with_cache(data_dir, jobs, num_processes=None, chunk_size=64):
+    """
+    Tokenize lists of lines with tokenizer configurations. The tokens of each
+    distinct line are cached on disk per configuration hash, hence only the
+    lines which have not been tokenized with the current version of a
+    configuration are sent to the pool of worker processes.
+
+    :param jobs: list of (tokenizer configuration, list of lines) pairs.
+    :param num_processes: number of worker processes (defaults to the number
+        of CPUs); no pool is created if set to 1.
+    :return: dictionary mapping the configurations to the token lists of
+        their lines.
+    """
+    caches, items = {}, []
+    for config_name, lines in jobs:
+        cache_dir = os.path.join(data_dir, TOKENIZATION_CACHE_DIR, config_name)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        cache_path = os.path.join(cache_dir, '{}.pkl'.format(
+            get_tokenizer_config_hash(config_name)))
+        cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                cache = pickle.load(f)
+        caches[config_name] = (cache_path, cache)
+        for line in set(lines):
+            if line not in cache:
+                items.append((config_name, line))
+
+    if items:
+        print('tokenizing {} lines'.format(len(items)))
+        if num_processes == 1:
+            results = [tokenize_item(item) for item in items]
+        else:
+            pool = multiprocessing.Pool(num_processes)
+            try:
+                results = pool.map(tokenize_item, items, chunksize=chunk_size)
+            finally:
+                pool.terminate()
+        new_configs = set()
+        for (config_name, line), tokens in zip(items, results):
+            caches[config_name][1][line] = tokens
+            new_configs.add(config_name)
+        for config_name in new_configs:
+            cache_path, cache = caches[config_name]
+            # remove the caches of the previous versions of the configuration
+            cache_dir = os.path.dirname(cache_path)
+            for file_name in os.listdir(cache_dir):
+                os.remove(os.path.join(cache_dir, file_name))
+            with open(cache_path + '.tmp', 'wb') as o_f:
+                pickle.dump(cache, o_f)
+            os.rename(cache_path + '.tmp', cache_path)
+
+    return dict((config_name, [caches[config_name][1][line] for line in lines])
+                for config_name, lines in jobs)
+
+
+def get_channel_stamp(data_dir, split, channel):
+    """
+    Summary of the inputs of the features of a (split, channel) pair: the
+    hashes of the dataset files, of the tokenizer configurations and of the
+    vocabularies of the dev and test splits.
+    """
+    inputs = [os.path.join(data_dir, split + '.nl.filtered'),
+              os.path.join(data_dir, split + '.cm.filtered')]
+    if split != 'train':
+        inputs += [os.path.join(data_dir, 'nl.vocab.{}'.format(channel)),
+                   os.path.join(data_dir, 'cm.vocab.{}'.format(channel))]
+    return {
+        'inputs': [[os.path.basename(path),
+                    file_hash(path) if os.path.exists(path) else None]
+                   for path in inputs],
+        'tokenizers': [[config_name, get_tokenizer_config_hash(config_name)]
+                       for config_name in CHANNEL_CONFIGS[channel][:3]
+                       if config_name]
+    }
+
+
+def get_channel_outputs(data_dir, split, channel):
+    outputs = [get_alignment_path(data_dir, split, channel)]
+    for ext in [channel, 'ids.{}'.format(channel), 'copy.{}'.format(channel)]:
+        outputs.append(os.path.join(data_dir, '{}.nl.{}'.format(split, ext)))
+        outputs.append(os.path.join(data_dir, '{}.cm.{}'.format(split, ext)))
+    if split == 'train':
+        outputs.append(os.path.join(data_dir, 'nl.vocab.{}'.format(channel)))
+        outputs.append(os.path.join(data_dir, 'cm.vocab.{}'.format(channel)))
+    return outputs
+
+
+def get_channel_stamp_path(data_dir, split, channel):
+    return os.path.join(data_dir, '{}.{}.prepared'.format(split, channel))
+
+
+def is_channel_up_to_date(data_dir, split, channel, stamp):
+    stamp_path = get_channel_stamp_path(data_dir, split, channel)
+    if not os.path.exists(stamp_path) or not all(
+            os.path.exists(x) for x in get_channel_outputs(data_dir, split, channel)):
+        return False
+    with open(stamp_path) as f:
+        return json.load(f) == stamp
+
+
+def save_channel_stamp(data_dir, split, channel, stamp):
+    with open(get_channel_stamp_path(data_dir, split, channel), 'w') as o_f:
+        json.dump(stamp, o_f)
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
 def compute_copy_indices(sc_tokens, tg_tokens, sc_copy_tokens, tg_copy_tokens,
                          tg_vocab, channel):
     assert(len(sc_tokens) == len(sc_copy_tokens))
@@ -762,33 +1289,97 @@ def compute_copy_indices(sc_tokens, tg_tokens, sc_copy_tokens, tg_copy_tokens,
     return csc_ids, ctg_ids
 
 
+# tokens which are never aligned
+ALIGNMENT_INIT_VOCAB = set(TOKEN_INIT_VOCAB + CHAR_INIT_VOCAB)
+
+
+def get_alignment_path(data_dir, split, channel):
+    return os.path.join(data_dir, '{}.{}.align.npz'.format(split, channel))
+
+
 def compute_alignments(data_dir, nl_list, cm_list, split, channel):
-    alignments = []
+    """
+    Compute the alignments between the parallel sequences of a dataset split.
+
+    :return: dictionary of flat arrays
+        rows, cols: coordinates of the aligned (nl, cm) token pairs of all
+            sequence pairs
+        offsets: [num_pairs + 1] offsets of the coordinates of each pair
+        shapes: [num_pairs, 2] (nl length, cm length) of each pair
+    """
+    rows, cols, offsets = [], [], [0]
     output_path = os.path.join(data_dir, '{}.{}.align.readable'.format(split, channel))
     with open(output_path, 'w') as o_f:
         for nl_tokens, cm_tokens in zip(nl_list, cm_list):
-            alignments.append(compute_pair_alignment(nl_tokens, cm_tokens, o_f))
-    return alignments
+            pair_rows, pair_cols = \
+                compute_pair_alignment(nl_tokens, cm_tokens, o_f)
+            rows.extend(pair_rows)
+            cols.extend(pair_cols)
+            offsets.append(len(rows))
+    return {
+        'rows': np.array(rows, dtype=np.int32),
+        'cols': np.array(cols, dtype=np.int32),
+        'offsets': np.array(offsets, dtype=np.int64),
+        'shapes': np.array([(len(nl_tokens), len(cm_tokens)) for
+                            nl_tokens, cm_tokens in zip(nl_list, cm_list)],
+                           dtype=np.int32).reshape([-1, 2])
+    }
+
+
+def compute_pair_alignment(nl_tokens, cm_tokens, out_file=None):
+    """
+    Compute the alignments between two parallel sequences: the command
+    tokens are indexed by value, hence the cost is linear in the length of
+    the sequences and the number of aligned pairs.
+
+    :return: the (nl positions, cm positions) of the aligned token pairs,
+        ordered by nl position and cm position.
+    """
+    cm_positions = collections.defaultdict(list)
+    for j, y in enumerate(cm_tokens):
+        cm_positions[y].append(j)
+
+    rows, cols = [], []
+    for i, x in enumerate(nl_tokens):
+        if x in cm_positions and not x in ALIGNMENT_INIT_VOCAB:
+            for j in cm_positions[x]:
+                rows.append(i)
+                cols.append(j)
+    if out_file is not None:
+        out_file.write(''.join('{}-{} '.format(i, j) for i, j in zip(rows, cols)))
+        out_file.write('\n')
+
+    return rows, cols
 
 
-def compute_pair_alignment(nl_tokens, cm_tokens, out_file):
+def save_alignments(data_dir, split, channel, alignments):
     """
-    Compute the alignments between two parallel sequences.
+    :param alignments: flat arrays returned by compute_alignments.
     """
-    init_vocab = set(TOKEN_INIT_VOCAB + CHAR_INIT_VOCAB)
-    m = len(nl_tokens)
-    n = len(cm_tokens)
+    path = get_alignment_path(data_dir, split, channel)
+    with open(path + '.tmp', 'wb') as o_f:
+        np.savez(o_f, **alignments)
+    os.rename(path + '.tmp', path)
 
-    A = np.zeros([m, n], dtype=np.int32)
 
-    for i, x in enumerate(nl_tokens):
-        for j, y in enumerate(cm_tokens):
-            if not x in init_vocab and x == y:
-                A[i, j] = 1
-                out_file.write('{}-{} '.format(i, j))
-    out_file.write('\n')
-
-    return ssp.lil_matrix(A)
+def load_alignments(data_dir, split, channel):
+    """
+    :return: the list of the alignments (SparseAlignment) of the sequence
+        pairs of a dataset split. Falls back to the pickled list of matrices
+        saved by earlier versions.
+    """
+    path = get_alignment_path(data_dir, split, channel)
+    if not os.path.exists(path):
+        with open(os.path.join(data_dir, '{}.{}.align'.format(split, channel)),
+                  'rb') as f:
+            return pickle.load(f)
+    with np.load(path) as arrays:
+        rows, cols = arrays['rows'], arrays['cols']
+        offsets = arrays['offsets'].tolist()
+        shapes = [tuple(shape) for shape in arrays['shapes'].tolist()]
+    return [SparseAlignment(rows[offsets[i]:offsets[i+1]],
+                            cols[offsets[i]:offsets[i+1]], shapes[i])
+            for i in xrange(len(shapes))]
 
 
 def create_vocabulary(vocab_path, dataset, min_word_frequency=1,
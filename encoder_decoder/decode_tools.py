@@ -2,6 +2,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import copy
 import os
 import sys
 
@@ -12,8 +14,6 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
-import numpy as np
-
 import datetime, time
 import re
 import shutil
@@ -69,6 +69,71 @@ def demo(sess, model, FLAGS):
 
 def translate_fun(data_point, sess, model, vocabs, FLAGS,
                   slot_filling_classifier=None):
+    return translate_batch([data_point], sess, model, vocabs, FLAGS,
+                           slot_filling_classifier=slot_filling_classifier)[0]
+
+
+def translate_batch(data_points, sess, model, vocabs, FLAGS,
+                    slot_filling_classifier=None):
+    """
+    Translate a list of natural language queries or grouped examples.
+
+    Examples which fall in the same bucket are packed into batches of
+    model.batch_size examples, each decoded with one model.step. The last
+    batch of a bucket is padded with copies of its last example.
+
+    :return: list of (decoded outputs, sequence logits) of each data point,
+        as returned by translate_fun.
+    """
+    features = [query_features(data_point, vocabs, FLAGS)
+                for data_point in data_points]
+    bucketed_ids = collections.defaultdict(list)
+    for i, (encoder_features, _, _, _) in enumerate(features):
+        bucketed_ids[get_bucket_id(model, encoder_features)].append(i)
+
+    results = [None] * len(data_points)
+    for bucket_id in sorted(bucketed_ids):
+        example_ids = bucketed_ids[bucket_id]
+        for start in xrange(0, len(example_ids), model.batch_size):
+            batch_ids = example_ids[start:start+model.batch_size]
+            padded_ids = batch_ids + \
+                [batch_ids[-1]] * (model.batch_size - len(batch_ids))
+            encoder_features = [
+                [features[i][0][channel][0] for i in padded_ids]
+                for channel in xrange(len(features[batch_ids[0]][0]))]
+            decoder_features = [
+                [features[i][1][channel][0] for i in padded_ids]
+                for channel in xrange(len(features[batch_ids[0]][1]))]
+
+            formatted_example = model.format_batch(
+                encoder_features, decoder_features, bucket_id=bucket_id)
+
+            # Compute neural network decoding output
+            model_outputs = model.step(sess, formatted_example, bucket_id,
+                                       forward_only=True)
+
+            for batch_id, i in enumerate(batch_ids):
+                _, _, copy_tokens, sc_fillers = features[i]
+                example_outputs = select_example_outputs(
+                    model_outputs, batch_id, len(padded_ids))
+                decoded_outputs = decode(
+                    example_outputs, FLAGS, vocabs,
+                    sc_fillers=[sc_fillers] if sc_fillers is not None else None,
+                    slot_filling_classifier=slot_filling_classifier,
+                    copy_tokens=[copy_tokens] if copy_tokens is not None else None)
+                results[i] = (decoded_outputs, example_outputs.sequence_logits)
+    return results
+
+
+def query_features(data_point, vocabs, FLAGS):
+    """
+    Compute the input features of a natural language query or a grouped
+    example.
+
+    :return: (encoder features, decoder features, copy tokens, source fillers)
+        of a 1-element batch; the copy tokens and the source fillers are None
+        if not used by the model.
+    """
     tg_ids = [data_utils.ROOT_ID]
     decoder_features = [[tg_ids]]
     if type(data_point) is str:
@@ -86,34 +151,49 @@ def translate_fun(data_point, sess, model, vocabs, FLAGS,
         ctg_ids = [data_utils.ROOT_ID]
         decoder_features.append([ctg_ids])
         # tokenize the source string with minimal changes on the token form
-        copy_tokens = [query_to_copy_tokens(source_str, FLAGS)]
+        copy_tokens = query_to_copy_tokens(source_str, FLAGS)
     else:
         copy_tokens = None
     if FLAGS.normalized:
         _, entities = tokenizer.ner_tokenizer(source_str)
-        sc_fillers = [entities[0]]
+        sc_fillers = entities[0]
     else:
         sc_fillers = None
+    return encoder_features, decoder_features, copy_tokens, sc_fillers
+
 
-    # Which bucket does it belong to?
+def get_bucket_id(model, encoder_features):
+    """
+    Which bucket does a query belong to?
+    """
     bucket_ids = [b for b in xrange(len(model.buckets))
                   if model.buckets[b][0] > len(encoder_features[0][0])]
-    bucket_id = min(bucket_ids) if bucket_ids else (len(model.buckets) - 1)
-    
-    # Get a 1-element batch to feed the sentence to the model.
-    formatted_example = model.format_batch(
-        encoder_features, decoder_features, bucket_id=bucket_id)
-
-    # Compute neural network decoding output
-    model_outputs = model.step(sess, formatted_example, bucket_id,
-                               forward_only=True)
-    sequence_logits = model_outputs.sequence_logits
+    return min(bucket_ids) if bucket_ids else (len(model.buckets) - 1)
 
-    decoded_outputs = decode(model_outputs, FLAGS, vocabs, sc_fillers=sc_fillers,
-                             slot_filling_classifier=slot_filling_classifier,
-                             copy_tokens=copy_tokens)
 
-    return decoded_outputs, sequence_logits
+def select_example_outputs(model_outputs, batch_id, batch_size):
+    """
+    Get the outputs used by decode of the batch_id-th example of a batch.
+    """
+    if batch_size == 1:
+        return model_outputs
+
+    def select(batch_outputs):
+        # batch-major outputs with the same number of rows (e.g. one per beam)
+        # for each example
+        if batch_outputs is None:
+            return None
+        num_rows = len(batch_outputs) // batch_size
+        return batch_outputs[batch_id*num_rows:(batch_id+1)*num_rows]
+
+    example_outputs = copy.copy(model_outputs)
+    example_outputs.output_symbols = select(model_outputs.output_symbols)
+    example_outputs.sequence_logits = select(model_outputs.sequence_logits)
+    example_outputs.encoder_hidden_states = \
+        select(model_outputs.encoder_hidden_states)
+    example_outputs.decoder_hidden_states = \
+        select(model_outputs.decoder_hidden_states)
+    return example_outputs
 
 
 def decode(model_outputs, FLAGS, vocabs, sc_fillers=None,
@@ -166,11 +246,11 @@ def decode(model_outputs, FLAGS, vocabs, sc_fillers=None,
         top_k_predictions = output_symbols[batch_id]
         if FLAGS.token_decoding_algorithm == 'beam_search':
             assert(len(top_k_predictions) == FLAGS.beam_size)
-            beam_outputs = []
         else:
             # pack greedy decoding results into size-1 beam
             top_k_predictions = [top_k_predictions]
 
+        beam_candidates = []
         for beam_id in xrange(len(top_k_predictions)):
             # Step 1: transform the neural network output into readable strings
             prediction = top_k_predictions[beam_id]
@@ -246,42 +326,48 @@ def decode(model_outputs, FLAGS, vocabs, sc_fillers=None,
             else:
                 target_ast = '__DUMMY_TREE__'
 
-            # Step 3: check if the predicted command templates have enough
-            # slots to hold the fillers (to rule out templates that are
-            # trivially unqualified)
-            output_example = False
-            if FLAGS.explain or not FLAGS.dataset.startswith('bash') \
-                    or not FLAGS.normalized:
-                output_example = True
-            else:
-                # Step 3: match the fillers to the argument slots
-                batch_sc_fillers = sc_fillers[batch_id]
-                if len(tg_slots) >= len(batch_sc_fillers):
-                    if FLAGS.fill_argument_slots:
-                        target_ast, target, _ = slot_filling.stable_slot_filling(
-                            output_tokens, batch_sc_fillers, tg_slots, None,
-                            encoder_outputs[batch_id],
-                            decoder_outputs[batch_id*FLAGS.beam_size+beam_id],
-                            slot_filling_classifier, verbose=False)
-                    else:
-                        output_example = True
-                    if not output_example and (target_ast is not None):
-                        output_example = True
+            beam_candidates.append((beam_id, output_tokens, tg_slots,
+                                    target_ast, target))
 
-            if output_example:
-                if FLAGS.token_decoding_algorithm == 'greedy':
-                    batch_outputs.append((target_ast, target))
-                else:
-                    beam_outputs.append((target_ast, target))
-                num_output_examples += 1
-
-            # The threshold is used to increase decoding speed
-            if num_output_examples == 20:
-                break
+        # Step 3: check if the predicted command templates have enough
+        # slots to hold the fillers (to rule out templates that are
+        # trivially unqualified)
+        if FLAGS.explain or not FLAGS.dataset.startswith('bash') \
+                or not FLAGS.normalized:
+            fill_slots = False
+        else:
+            batch_sc_fillers = sc_fillers[batch_id]
+            beam_candidates = [candidate for candidate in beam_candidates
+                               if len(candidate[2]) >= len(batch_sc_fillers)]
+            fill_slots = FLAGS.fill_argument_slots
+
+        beam_outputs = []
+        while beam_candidates and num_output_examples < 20:
+            # The threshold is used to increase decoding speed: only the
+            # candidates which may be output are processed
+            candidates = beam_candidates[:20 - num_output_examples]
+            beam_candidates = beam_candidates[len(candidates):]
+            if fill_slots:
+                # Step 3: match the fillers to the argument slots of all
+                # candidates at once
+                filled = slot_filling.batch_stable_slot_filling(
+                    [(output_tokens, tg_slots,
+                      decoder_outputs[batch_id*FLAGS.beam_size+beam_id])
+                     for beam_id, output_tokens, tg_slots, _, _ in candidates],
+                    batch_sc_fillers, encoder_outputs[batch_id],
+                    slot_filling_classifier, verbose=False)
+                candidates = [(target_ast, target) for target_ast, target, _
+                              in filled if target_ast is not None]
+            else:
+                candidates = [(target_ast, target) for _, _, _, target_ast, target
+                              in candidates]
+            beam_outputs.extend(candidates)
+            num_output_examples += len(candidates)
 
-        if FLAGS.token_decoding_algorithm == 'beam_search':
-            if beam_outputs:
-                batch_outputs.append(beam_outputs)
+        if FLAGS.token_decoding_algorithm == 'greedy':
+            batch_outputs.extend(beam_outputs)
+        elif beam_outputs:
+            batch_outputs.append(beam_outputs)
 
     return batch_outputs
 
@@ -289,7 +375,8 @@ def decode(model_outputs, FLAGS, vocabs, sc_fillers=None,
 def decode_set(sess, model, dataset, top_k, FLAGS, verbose=False):
     """
     Compute top-k predictions on the dev/test dataset and write the predictions
-    to disk.
+    to disk. The examples are decoded in batches of up to model.batch_size
+    (--decode_batch_size) examples of the same bucket.
 
     :param sess: A TensorFlow session.
     :param model: Prediction model object.
@@ -314,6 +401,15 @@ def decode_set(sess, model, dataset, top_k, FLAGS, verbose=False):
     eval_file = open(eval_file_path, 'w')
     eval_file.write('example_id, description, ground_truth, prediction, ' +
                     'correct template, correct command\n')
+
+    if FLAGS.fill_argument_slots:
+        slot_filling_classifier = get_slot_filling_classifer(FLAGS)
+    else:
+        slot_filling_classifier = None
+    translations = translate_batch(
+        [data_group for _, data_group in grouped_dataset], sess, model, vocabs,
+        FLAGS, slot_filling_classifier=slot_filling_classifier)
+
     for example_id in xrange(len(grouped_dataset)):
         key, data_group = grouped_dataset[example_id]
 
@@ -333,13 +429,7 @@ def decode_set(sess, model, dataset, top_k, FLAGS, verbose=False):
             for j in xrange(len(data_group)):
                 print('GT Target {}: {}'.format(j+1, data_group[j].tg_txt))
 
-        if FLAGS.fill_argument_slots:
-            slot_filling_classifier = get_slot_filling_classifer(FLAGS)
-            batch_outputs, sequence_logits = translate_fun(data_group, sess, model,
-                vocabs, FLAGS, slot_filling_classifier=slot_filling_classifier)
-        else:
-            batch_outputs, sequence_logits = translate_fun(data_group, sess, model,
-                vocabs, FLAGS)
+        batch_outputs, sequence_logits = translations[example_id]
         if FLAGS.tg_char:
             batch_outputs, batch_char_outputs = batch_outputs
 
@@ -406,16 +496,13 @@ def decode_set(sess, model, dataset, top_k, FLAGS, verbose=False):
 
 
 def get_slot_filling_classifer(FLAGS):
-    # create slot filling classifier
+    # the classifier is loaded once per process and reloaded when the
+    # mapping file changes
     mapping_param_dir = os.path.join(
         FLAGS.model_dir, 'train.mappings.X.Y.npz')
-    npz = np.load(mapping_param_dir)
-    train_X = npz['arr_0']
-    train_Y = npz['arr_1']
-    slot_filling_classifier = slot_filling.KNearestNeighborModel(
-        FLAGS.num_nn_slot_filling, train_X, train_Y)
-    print('Slot filling classifier parameters loaded.')
-    return slot_filling_classifier
+    return slot_filling.load_slot_filling_classifier(
+        mapping_param_dir, FLAGS.num_nn_slot_filling,
+        index_type=FLAGS.slot_filling_index)
 
 
 # --- Compute query features
@@ -34,7 +34,8 @@ class Decoder(graph_utils.NNModel):
         """
         super(Decoder, self).__init__(hyperparameters)
         if self.forward_only:
-            self.hyperparams['batch_size'] = 1
+            self.hyperparams['batch_size'] = \
+                self.hyperparams.get('decode_batch_size', 1)
 
         self.scope = scope
         self.dim = dim
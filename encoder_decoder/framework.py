@@ -4,7 +4,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import itertools
 import sys
+import threading
 if sys.version_info > (3, 0):
     from six.moves import xrange
 
@@ -51,6 +53,8 @@ class EncoderDecoderModel(graph_utils.NNModel):
 
         self.global_epoch = tf.Variable(0, trainable=False)
 
+        self.batch_builder = BatchBuilder()
+
         # Encoder.
         self.define_encoder(self.sc_input_keep, self.sc_output_keep)
 
@@ -112,6 +116,14 @@ class EncoderDecoderModel(graph_utils.NNModel):
                     tf.placeholder(
                         tf.int32, shape=[None], name="copy_target{0}".format(i)))
 
+        # Placeholder names, used as the keys of the input feeds.
+        self.encoder_input_names = [x.name for x in self.encoder_inputs]
+        self.encoder_attn_mask_names = [x.name for x in self.encoder_attn_masks]
+        self.decoder_input_names = [x.name for x in self.decoder_inputs]
+        self.target_weight_names = [x.name for x in self.target_weights]
+        self.encoder_copy_input_names = [x.name for x in self.encoder_copy_inputs]
+        self.target_names = [x.name for x in self.targets]
+
         # Compute training outputs and losses in the forward direction.
         if self.buckets:
             self.output_symbols = []
@@ -402,7 +414,8 @@ class EncoderDecoderModel(graph_utils.NNModel):
 
     # --- Graph Operations --- #
 
-    def format_batch(self, encoder_input_channels, decoder_input_channels, bucket_id=-1):
+    def format_batch(self, encoder_input_channels, decoder_input_channels, bucket_id=-1,
+                     batch_builder=None):
         """
         Convert the feature vectors into the dimensions required by the neural
         network.
@@ -412,83 +425,48 @@ class EncoderDecoderModel(graph_utils.NNModel):
         :param decoder_input_channels:
             channel 0 - seq2seq decoder inputs
             channel 1 - copynet decoder targets
+        :param batch_builder: the BatchBuilder whose buffers hold the batch,
+            self.batch_builder by default
+        :return: an Example whose fields are [length, batch_size] arrays built
+            by the batch builder (row l holds the inputs of time step l).
         """
-        def load_channel(inputs, output_length, reversed_output=True):
-            """
-            Convert a batch of feature vectors into a batched feature vector.
-            """
-            padded_inputs = []
-            batch_inputs = []
-            for batch_idx in xrange(batch_size):
-                input = inputs[batch_idx]
-                paddings = [data_utils.PAD_ID] * (output_length - len(input))
-                if reversed_output:
-                    padded_inputs.append(list(reversed(input + paddings)))
-                else:
-                    padded_inputs.append(input + paddings)
-            for length_idx in xrange(output_length):
-                batched_dim = np.array([padded_inputs[batch_idx][length_idx]
-                        for batch_idx in xrange(batch_size)], dtype=np.int32)
-                batch_inputs.append(batched_dim)
-            return batch_inputs
-
         if bucket_id != -1:
             encoder_size, decoder_size = self.buckets[bucket_id]
         else:
             encoder_size, decoder_size = \
                 self.max_source_length, self.max_target_length
-        batch_size = len(encoder_input_channels[0])
-
-        # create batch-major vectors
-        batch_encoder_inputs = load_channel(
-            encoder_input_channels[0], encoder_size, reversed_output=True)
-        batch_decoder_inputs = load_channel(
-            decoder_input_channels[0], decoder_size, reversed_output=False)
-        if self.copynet:
-            batch_encoder_copy_inputs = load_channel(
-                encoder_input_channels[1], encoder_size, reversed_output=True)
-            batch_copy_targets = load_channel(
-                decoder_input_channels[1], decoder_size, reversed_output=False)
-
-        batch_encoder_input_masks = []
-        batch_decoder_input_masks = []
-        for length_idx in xrange(encoder_size):
-            batch_encoder_input_mask = np.ones(batch_size, dtype=np.float32)
-            for batch_idx in xrange(batch_size):
-                source = batch_encoder_inputs[length_idx][batch_idx]
-                if source == data_utils.PAD_ID:
-                    batch_encoder_input_mask[batch_idx] = 0.0
-            batch_encoder_input_masks.append(batch_encoder_input_mask)
-
-        for length_idx in xrange(decoder_size):
-            # Create target_weights to be 0 for targets that are padding.
-            batch_decoder_input_mask = np.ones(batch_size, dtype=np.float32)
-            for batch_idx in xrange(batch_size):
-                # We set weight to 0 if the corresponding target is a PAD symbol.
-                # The corresponding target is decoder_input shifted by 1 forward.
-                if length_idx < decoder_size - 1:
-                    target = batch_decoder_inputs[length_idx+1][batch_idx]
-                if length_idx == decoder_size - 1 or target == data_utils.PAD_ID:
-                    batch_decoder_input_mask[batch_idx] = 0.0
-            batch_decoder_input_masks.append(batch_decoder_input_mask)
+        builder = batch_builder or self.batch_builder
 
         E = Example()
-        E.encoder_inputs = batch_encoder_inputs
-        E.encoder_attn_masks = batch_encoder_input_masks
-        E.decoder_inputs = batch_decoder_inputs
-        E.target_weights = batch_decoder_input_masks
-        if self.use_copy:
-            E.encoder_copy_inputs = batch_encoder_copy_inputs
-            E.copy_targets = batch_copy_targets
+        E.encoder_inputs = builder.pad(
+            'encoder_inputs', encoder_input_channels[0], encoder_size,
+            reversed_output=True)
+        E.decoder_inputs = builder.pad(
+            'decoder_inputs', decoder_input_channels[0], decoder_size,
+            reversed_output=False)
+        E.encoder_attn_masks = builder.encoder_attn_masks(E.encoder_inputs)
+        E.target_weights = builder.target_weights(E.decoder_inputs)
+        if self.copynet:
+            E.encoder_copy_inputs = builder.pad(
+                'encoder_copy_inputs', encoder_input_channels[1], encoder_size,
+                reversed_output=True)
+            E.copy_targets = builder.pad(
+                'copy_targets', decoder_input_channels[1], decoder_size,
+                reversed_output=False)
 
         return E
 
 
-    def get_batch(self, data, bucket_id=-1, use_all=False):
+    def get_batch(self, data, bucket_id=-1, use_all=False, data_ids=None,
+                  batch_builder=None):
         """
         Randomly sample a batch of examples from the specified bucket and
         convert the feature vectors into the dimensions required by the neural
         network.
+
+        :param data_ids: if given, the indices of the examples of the batch
+            in the bucket (e.g. chosen by batching.TokenBudgetSampler)
+        :param batch_builder: see format_batch
         """
         encoder_inputs, decoder_inputs = [], []
         if self.copynet:
@@ -500,9 +478,10 @@ class EncoderDecoderModel(graph_utils.NNModel):
             sample_pool = data[bucket_id]
 
         # Randomly sample a batch of encoder and decoder inputs from data
-        data_ids = list(xrange(len(sample_pool)))
-        if not use_all:
-            data_ids = np.random.choice(data_ids, self.batch_size)
+        if data_ids is None:
+            data_ids = list(xrange(len(sample_pool)))
+            if not use_all:
+                data_ids = np.random.choice(data_ids, self.batch_size)
         for i in data_ids:
             data_point = sample_pool[i]
             encoder_inputs.append(data_point.sc_ids)
@@ -518,7 +497,8 @@ class EncoderDecoderModel(graph_utils.NNModel):
             decoder_input_channels.append(copy_targets)
 
         return self.format_batch(
-            encoder_input_channels, decoder_input_channels, bucket_id=bucket_id)
+            encoder_input_channels, decoder_input_channels, bucket_id=bucket_id,
+            batch_builder=batch_builder)
 
 
     def feed_input(self, E):
@@ -526,38 +506,33 @@ class EncoderDecoderModel(graph_utils.NNModel):
         Assign the data vectors to the corresponding neural network variables.
         """
         encoder_size, decoder_size = len(E.encoder_inputs), len(E.decoder_inputs)
-        input_feed = {}
-        for l in xrange(encoder_size):
-            input_feed[self.encoder_inputs[l].name] = E.encoder_inputs[l]
-            input_feed[self.encoder_attn_masks[l].name] = E.encoder_attn_masks[l]
-        for l in xrange(decoder_size):
-            input_feed[self.decoder_inputs[l].name] = E.decoder_inputs[l]
-            input_feed[self.target_weights[l].name] = E.target_weights[l]
+        # iterating over the rows of the [length, batch_size] arrays yields
+        # per-time-step views
+        input_feed = dict(zip(self.encoder_input_names[:encoder_size],
+                              E.encoder_inputs))
+        input_feed.update(zip(self.encoder_attn_mask_names[:encoder_size],
+                              E.encoder_attn_masks))
+        input_feed.update(zip(self.decoder_input_names[:decoder_size],
+                              E.decoder_inputs))
+        input_feed.update(zip(self.target_weight_names[:decoder_size],
+                              E.target_weights))
         if self.copynet:
-            for l in xrange(encoder_size):
-                input_feed[self.encoder_copy_inputs[l].name] = \
-                    E.encoder_copy_inputs[l]
-            for l in xrange(decoder_size-1):
-                input_feed[self.targets[l].name] = E.copy_targets[l]
+            input_feed.update(zip(self.encoder_copy_input_names[:encoder_size],
+                                  E.encoder_copy_inputs))
+            input_feed.update(zip(self.target_names[:decoder_size-1],
+                                  E.copy_targets))
 
         # Apply dummy values to encoder and decoder inputs
-        for l in xrange(encoder_size, self.max_source_length):
-            input_feed[self.encoder_inputs[l].name] = np.zeros(
-                E.encoder_inputs[-1].shape, dtype=np.int32)
-            input_feed[self.encoder_attn_masks[l].name] = np.zeros(
-                E.encoder_attn_masks[-1].shape, dtype=np.int32)
-            if self.copynet:
-                input_feed[self.encoder_copy_inputs[l].name] = \
-                    np.zeros(E.encoder_copy_inputs[-1].shape, dtype=np.int32)
-        for l in xrange(decoder_size, self.max_target_length + 1):
-            input_feed[self.decoder_inputs[l].name] = np.zeros(
-                E.decoder_inputs[-1].shape, dtype=np.int32)
-            input_feed[self.target_weights[l].name] = np.zeros(
-                E.target_weights[-1].shape, dtype=np.int32)
-            if self.copynet:
-                input_feed[self.targets[l-1].name] = np.zeros(
-                    E.copy_targets[-1].shape, dtype=np.int32)
-        
+        zeros = self.batch_builder.zeros(len(E.encoder_inputs[-1]))
+        dummy_names = self.encoder_input_names[encoder_size:] + \
+            self.encoder_attn_mask_names[encoder_size:] + \
+            self.decoder_input_names[decoder_size:] + \
+            self.target_weight_names[decoder_size:]
+        if self.copynet:
+            dummy_names += self.encoder_copy_input_names[encoder_size:] + \
+                self.target_names[decoder_size-1:]
+        input_feed.update((name, zeros) for name in dummy_names)
+
         return input_feed
 
 
@@ -666,6 +641,99 @@ class Example(object):
         self.copy_targets = None            # Copynet
 
 
+class BatchBuilder(object):
+    """
+    Builds the padded input arrays of a batch with a few numpy operations.
+
+    The arrays are time-major ([length, batch_size]), hence the input of a
+    time step is a contiguous row and the [batch_size, length] matrix is the
+    transpose, both views of the same buffer. The buffers of each array shape
+    are preallocated and reused: an array stays valid until num_buffers more
+    batches of the same shape have been built. Threads building batches
+    concurrently should use builders of their own, since this bound does not
+    hold per thread for a shared builder.
+    """
+    def __init__(self, num_buffers=2):
+        self.num_buffers = num_buffers
+        self.buffers = {}
+        self.zero_vectors = {}
+        self.lock = threading.Lock()
+
+    def get_buffer(self, name, shape, dtype):
+        key = (name, shape)
+        with self.lock:
+            if key not in self.buffers:
+                self.buffers[key] = [
+                    [np.empty(shape, dtype=dtype)
+                     for _ in xrange(self.num_buffers)], 0]
+            ring = self.buffers[key]
+            buffer = ring[0][ring[1]]
+            ring[1] = (ring[1] + 1) % self.num_buffers
+        return buffer
+
+    def pad(self, name, inputs, output_length, reversed_output=True):
+        """
+        Convert a batch of feature vectors into a batched feature vector.
+
+        :param inputs: list of sequences of token ids
+        :param output_length: length of the padded sequences; longer
+            sequences are truncated
+        :param reversed_output: if set, reverse the padded sequences (the
+            padding comes first)
+        :return: [output_length, batch_size] int32 array
+        """
+        batch_size = len(inputs)
+        batch = self.get_buffer(name, (output_length, batch_size), np.int32)
+        batch.fill(data_utils.PAD_ID)
+        lengths = np.fromiter((min(len(input), output_length)
+                               for input in inputs), dtype=np.int64,
+                              count=batch_size)
+        positions = np.arange(output_length)
+        if reversed_output:
+            mask = positions >= (output_length - lengths)[:, None]
+            values = (input[::-1][:output_length] for input in inputs)
+        else:
+            mask = positions < lengths[:, None]
+            values = (input[:output_length] for input in inputs)
+        # boolean assignment fills the batch-major view row by row
+        batch.T[mask] = np.fromiter(itertools.chain.from_iterable(values),
+                                    dtype=np.int32, count=int(np.sum(lengths)))
+        return batch
+
+    def encoder_attn_masks(self, encoder_inputs):
+        """
+        :return: [encoder_size, batch_size] float32 array which is 0 at the
+            PAD symbols and 1 elsewhere.
+        """
+        masks = self.get_buffer('encoder_attn_masks', encoder_inputs.shape,
+                                np.float32)
+        np.not_equal(encoder_inputs, data_utils.PAD_ID, out=masks)
+        return masks
+
+    def target_weights(self, decoder_inputs):
+        """
+        :return: [decoder_size, batch_size] float32 array which is 0 where
+            the target (the decoder input shifted by 1 forward) is a PAD symbol
+            and at the last time step, and 1 elsewhere.
+        """
+        weights = self.get_buffer('target_weights', decoder_inputs.shape,
+                                  np.float32)
+        np.not_equal(decoder_inputs[1:], data_utils.PAD_ID, out=weights[:-1])
+        weights[-1] = 0.0
+        return weights
+
+    def zeros(self, batch_size):
+        """
+        :return: read-only [batch_size] int32 vector of zeros, used as the
+            input of the time steps beyond the bucket.
+        """
+        if batch_size not in self.zero_vectors:
+            zeros = np.zeros(batch_size, dtype=np.int32)
+            zeros.setflags(write=False)
+            self.zero_vectors[batch_size] = zeros
+        return self.zero_vectors[batch_size]
+
+
 class Output(object):
     """
     Data output from the neural network (batched when mini-batch training is used).
@@ -117,8 +117,9 @@ def define_model(FLAGS, session, model_constructor, buckets, forward_only):
     print("decode_sig={}".format(decode_sig))
 
     if forward_only:
-        # Set batch_size to 1 for decoding.
-        params["batch_size"] = 1
+        # Set batch_size to the decoding batch size (1 by default).
+        params["batch_size"] = FLAGS.decode_batch_size
+        params["decode_batch_size"] = FLAGS.decode_batch_size
         # Reset dropout probabilities for decoding.
         params["attention_input_keep"] = 1.0
         params["attention_output_keep"] = 1.0
@@ -130,6 +131,7 @@ def define_model(FLAGS, session, model_constructor, buckets, forward_only):
     if FLAGS.gen_slot_filling_training_data:
         FLAGS.batch_size = 1
         params["batch_size"] = 1
+        params["decode_batch_size"] = 1
         FLAGS.beam_size = 1
         params["beam_size"] = 1
         FLAGS.learning_rate = 0
@@ -0,0 +1,248 @@
+"""
+Local inference service for the translation model (Python 3 only).
+
+The model, the vocabularies and the slot-filling classifier are loaded once.
+Queries are received by an asyncio HTTP server and collected by a
+micro-batcher: the queries which arrive within --serve_max_wait_ms of the
+first query of a batch (up to --serve_max_batch_size queries) are translated
+together by decode_tools.translate_batch, which packs the queries of the same
+bucket into model steps of --decode_batch_size examples. Translation runs in a
+worker thread, so that new queries are collected while a batch is decoded.
+
+Endpoints:
+    GET /translate?q=<natural language description>
+    POST /translate (the request body is the description)
+        {"query": ..., "predictions": [{"command": ..., "score": ...}, ...]}
+    GET /stats
+        number of queries and batches, recent latency percentiles
+    GET /health
+
+Usage:
+    python3 -m encoder_decoder.translate --serve --decode_batch_size 16 ...
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import json
+import time
+import urllib.parse
+
+import numpy as np
+
+from bashlint import data_tools
+from encoder_decoder import data_utils, decode_tools
+
+NUM_LATENCY_SAMPLES = 10000
+
+
+class MicroBatcher(object):
+    """
+    Collect concurrent queries into batches translated by translate_batch_fun.
+
+    :member max_batch_size: maximum number of queries in a batch.
+    :member max_wait: maximum time (in seconds) a query waits for other
+        queries to join its batch.
+    """
+    def __init__(self, translate_batch_fun, max_batch_size=64, max_wait=0.005):
+        self.translate_batch_fun = translate_batch_fun
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.num_queries = 0
+        self.num_batches = 0
+        self.latencies = collections.deque(maxlen=NUM_LATENCY_SAMPLES)
+
+    def start(self, loop):
+        self.queue = asyncio.Queue()
+        return loop.create_task(self.run(loop))
+
+    async def translate(self, query):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        start_time = time.time()
+        await self.queue.put((query, future))
+        result = await future
+        self.latencies.append(time.time() - start_time)
+        return result
+
+    async def next_batch(self, loop):
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self, loop):
+        while True:
+            batch = await self.next_batch(loop)
+            queries = [query for query, _ in batch]
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.translate_batch_fun, queries)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.num_queries += len(batch)
+            self.num_batches += 1
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000
+        stats = {
+            'queries': self.num_queries,
+            'batches': self.num_batches,
+            'average_batch_size': self.num_queries / max(self.num_batches, 1)
+        }
+        if len(latencies):
+            stats['latency_ms'] = {
+                'p50': float(np.percentile(latencies, 50)),
+                'p90': float(np.percentile(latencies, 90)),
+                'p99': float(np.percentile(latencies, 99)),
+                'max': float(latencies.max())
+            }
+        return stats
+
+
+class InferenceServer(object):
+    """
+    Minimal HTTP/1.1 server (with keep-alive) in front of a MicroBatcher.
+    """
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    def start(self, host, port, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        self.batcher.start(loop)
+        return loop.run_until_complete(
+            asyncio.start_server(self.handle_connection, host, port))
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = \
+                    request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = b''
+                if 'content-length' in headers:
+                    body = await reader.readexactly(
+                        int(headers['content-length']))
+                status, response = await self.handle_request(
+                    method, target, body)
+                keep_alive = headers.get('connection', '').lower() != 'close' \
+                    and not version.startswith('HTTP/1.0')
+                data = json.dumps(response).encode('utf-8')
+                writer.write(
+                    'HTTP/1.1 {}\r\nContent-Type: application/json\r\n'
+                    'Content-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                        status, len(data),
+                        'keep-alive' if keep_alive else 'close')
+                    .encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, method, target, body):
+        url = urllib.parse.urlsplit(target)
+        if url.path == '/health':
+            return '200 OK', {'status': 'ok'}
+        if url.path == '/stats':
+            return '200 OK', self.batcher.stats()
+        if url.path != '/translate':
+            return '404 Not Found', {'error': 'unknown path {}'.format(url.path)}
+        if method == 'POST':
+            query = body.decode('utf-8')
+        else:
+            query = urllib.parse.parse_qs(url.query).get('q', [''])[0]
+        query = query.strip()
+        if not query:
+            return '400 Bad Request', {'error': 'empty query'}
+        try:
+            predictions = await self.batcher.translate(query)
+        except Exception as e:
+            return '500 Internal Server Error', {'error': repr(e)}
+        return '200 OK', {'query': query, 'predictions': predictions}
+
+
+def format_predictions(batch_outputs, sequence_logits, FLAGS):
+    """
+    Convert the translate_fun output of a query into a list of
+    {"command": ..., "score": ...} dictionaries.
+    """
+    nl2bash = FLAGS.dataset.startswith('bash') and not FLAGS.explain
+    predictions = []
+    if not batch_outputs:
+        return predictions
+    if FLAGS.token_decoding_algorithm == 'greedy':
+        top_k_predictions = [batch_outputs[0]]
+        top_k_scores = [sequence_logits[0]]
+    else:
+        top_k_predictions = batch_outputs[0][:min(FLAGS.beam_size, 10)]
+        top_k_scores = sequence_logits[0]
+    for (pred_tree, pred_cmd), score in zip(top_k_predictions, top_k_scores):
+        if nl2bash:
+            pred_cmd = data_tools.ast2command(pred_tree, loose_constraints=True)
+        predictions.append({'command': pred_cmd, 'score': float(score)})
+    return predictions
+
+
+def serve(sess, model, FLAGS):
+    """
+    Serve the model until the process is interrupted.
+    """
+    vocabs = data_utils.load_vocabulary(FLAGS)
+    if FLAGS.fill_argument_slots:
+        slot_filling_classifier = decode_tools.get_slot_filling_classifer(FLAGS)
+    else:
+        slot_filling_classifier = None
+
+    def translate_queries(queries):
+        results = decode_tools.translate_batch(
+            queries, sess, model, vocabs, FLAGS,
+            slot_filling_classifier=slot_filling_classifier)
+        return [format_predictions(batch_outputs, sequence_logits, FLAGS)
+                for batch_outputs, sequence_logits in results]
+
+    batcher = MicroBatcher(translate_queries,
+                           max_batch_size=FLAGS.serve_max_batch_size,
+                           max_wait=FLAGS.serve_max_wait_ms / 1000.0)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = InferenceServer(batcher).start(
+        FLAGS.serve_host, FLAGS.serve_port, loop)
+    print('Serving translations on http://{}:{}/translate'.format(
+        FLAGS.serve_host, FLAGS.serve_port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
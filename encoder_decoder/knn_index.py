@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Nearest neighbor indices over the slot-filling feature mappings.
+
+The feature vectors are L2-normalized, hence the neighbors of a query are the
+training vectors with the largest inner products with it. Three indices are
+provided:
+
+    exact: blocked exact top-k search in float32. The training matrix is
+        scanned in blocks of block_size rows and the running top-k of every
+        query is merged with the top-k of each block, so the memory used does
+        not grow with the number of training vectors.
+    lsh: random-projection locality sensitive hashing. The candidates of a
+        query are the training vectors which share its signature in at least
+        one of num_tables hash tables of num_bits random hyperplanes each.
+    ivf: inverted file over spherical k-means clusters. The candidates of a
+        query are the training vectors of its num_probes closest clusters.
+
+The approximate indices rank their candidates exactly and fall back to an
+exact search for the queries with fewer than k candidates.
+
+Usage (recall versus speed benchmark):
+    python -m encoder_decoder.knn_index [train.mappings.X.Y.npz] [num_queries]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+
+if sys.version_info > (3, 0):
+    from six.moves import xrange
+
+import numpy as np
+
+INDEX_TYPES = ('exact', 'lsh', 'ivf')
+
+
+def top_k(sim_scores, k):
+    """
+    :param sim_scores: [size, n] similarity scores
+    :return: ([size, k] scores, [size, k] column indices) of the k highest
+        scores of each row, in no particular order.
+    """
+    if k >= sim_scores.shape[1]:
+        ids = np.tile(np.arange(sim_scores.shape[1]), (len(sim_scores), 1))
+        return sim_scores, ids
+    ids = np.argpartition(sim_scores, -k, axis=1)[:, -k:]
+    return np.take_along_axis(sim_scores, ids, axis=1), ids
+
+
+class ExactIndex(object):
+    """
+    Exact maximum inner product search.
+
+    :member train_X: [size, dim] float32 training feature matrix
+    :member block_size: number of training vectors scored at once
+    """
+    index_type = 'exact'
+
+    def __init__(self, train_X, block_size=65536):
+        self.train_X = np.ascontiguousarray(train_X, dtype=np.float32)
+        self.block_size = block_size
+
+    def search(self, X, k):
+        """
+        :param X: [size, dim] queries
+        :return: ([size, k] similarity scores, [size, k] training indices) of
+            the k nearest neighbors of each query, in no particular order.
+        """
+        X = np.asarray(X, dtype=np.float32)
+        k = min(k, len(self.train_X))
+        best_scores, best_ids = None, None
+        for start in xrange(0, len(self.train_X), self.block_size):
+            block = self.train_X[start:start + self.block_size]
+            scores, ids = top_k(np.dot(X, block.T), k)
+            ids += start
+            if best_scores is not None:
+                scores = np.concatenate([best_scores, scores], axis=1)
+                ids = np.concatenate([best_ids, ids], axis=1)
+                scores, columns = top_k(scores, k)
+                ids = np.take_along_axis(ids, columns, axis=1)
+            best_scores, best_ids = scores, ids
+        return best_scores, best_ids
+
+    def params(self):
+        return {'block_size': self.block_size}
+
+    def save(self, path):
+        """
+        Save the index (without the training matrix) to an .npz file.
+        """
+        arrays = self.arrays()
+        arrays['index_type'] = np.array(self.index_type)
+        for key, value in self.params().items():
+            arrays['param_' + key] = np.array(value)
+        np.savez(path, **arrays)
+
+    def arrays(self):
+        return {}
+
+    def restore(self, arrays):
+        pass
+
+
+class CandidateIndex(ExactIndex):
+    """
+    Base class of the approximate indices, which rank exactly a subset of the
+    training vectors selected by candidates.
+    """
+    def search(self, X, k):
+        X = np.asarray(X, dtype=np.float32)
+        k = min(k, len(self.train_X))
+        scores = np.empty([len(X), k], dtype=np.float32)
+        ids = np.empty([len(X), k], dtype=np.int64)
+        fallback = []
+        for i, candidate_ids in enumerate(self.candidates(X)):
+            if len(candidate_ids) < k:
+                fallback.append(i)
+                continue
+            candidate_scores = np.dot(self.train_X[candidate_ids], X[i])
+            s, columns = top_k(candidate_scores[None, :], k)
+            scores[i] = s[0]
+            ids[i] = candidate_ids[columns[0]]
+        if fallback:
+            scores[fallback], ids[fallback] = \
+                ExactIndex.search(self, X[fallback], k)
+        return scores, ids
+
+
+class RandomProjectionIndex(CandidateIndex):
+    """
+    Random-projection LSH index.
+
+    :member num_tables: number of hash tables
+    :member num_bits: number of random hyperplanes of each hash table
+    """
+    index_type = 'lsh'
+
+    def __init__(self, train_X, num_tables=8, num_bits=12, seed=0,
+                 block_size=65536):
+        super(RandomProjectionIndex, self).__init__(train_X, block_size)
+        self.num_tables = num_tables
+        self.num_bits = num_bits
+        self.seed = seed
+
+    def build(self):
+        rng = np.random.RandomState(self.seed)
+        dim = self.train_X.shape[1]
+        # [dim, num_tables * num_bits]
+        self.planes = rng.randn(dim, self.num_tables * self.num_bits) \
+            .astype(np.float32)
+        # [num_tables, size]
+        codes = self.hash(self.train_X).T
+        self.orders = np.argsort(codes, axis=1, kind='stable')
+        self.sorted_codes = np.take_along_axis(codes, self.orders, axis=1)
+        return self
+
+    def hash(self, X):
+        """
+        :return: [size, num_tables] hash codes of X
+        """
+        bits = (np.dot(X, self.planes) > 0).reshape(
+            [len(X), self.num_tables, self.num_bits])
+        return np.dot(bits, 1 << np.arange(self.num_bits, dtype=np.int64))
+
+    def candidates(self, X):
+        codes = self.hash(X)
+        starts = np.empty_like(codes)
+        ends = np.empty_like(codes)
+        for t in xrange(self.num_tables):
+            starts[:, t] = np.searchsorted(
+                self.sorted_codes[t], codes[:, t], side='left')
+            ends[:, t] = np.searchsorted(
+                self.sorted_codes[t], codes[:, t], side='right')
+        for i in xrange(len(X)):
+            yield np.unique(np.concatenate(
+                [self.orders[t, starts[i, t]:ends[i, t]]
+                 for t in xrange(self.num_tables)]))
+
+    def params(self):
+        return {'num_tables': self.num_tables, 'num_bits': self.num_bits,
+                'seed': self.seed, 'block_size': self.block_size}
+
+    def arrays(self):
+        return {'planes': self.planes, 'orders': self.orders,
+                'sorted_codes': self.sorted_codes}
+
+    def restore(self, arrays):
+        self.planes = arrays['planes']
+        self.orders = arrays['orders']
+        self.sorted_codes = arrays['sorted_codes']
+
+
+class ClusterIndex(CandidateIndex):
+    """
+    IVF index over spherical k-means clusters of the training vectors.
+
+    :member num_clusters: number of clusters (defaults to sqrt(size))
+    :member num_probes: number of clusters searched per query
+    """
+    index_type = 'ivf'
+
+    def __init__(self, train_X, num_clusters=None, num_probes=8,
+                 num_iterations=10, seed=0, block_size=65536):
+        super(ClusterIndex, self).__init__(train_X, block_size)
+        if not num_clusters:
+            num_clusters = int(np.sqrt(len(self.train_X)))
+        self.num_clusters = max(1, min(num_clusters, len(self.train_X)))
+        self.num_probes = num_probes
+        self.num_iterations = num_iterations
+        self.seed = seed
+
+    def build(self):
+        rng = np.random.RandomState(self.seed)
+        self.centroids = self.train_X[rng.choice(
+            len(self.train_X), self.num_clusters, replace=False)]
+        for _ in xrange(self.num_iterations):
+            assignments = self.assign(self.train_X)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignments, self.train_X)
+            norms = np.linalg.norm(sums, axis=1)
+            # keep the previous centroid of an empty cluster
+            non_empty = norms > 0
+            self.centroids[non_empty] = \
+                sums[non_empty] / norms[non_empty][:, None]
+        assignments = self.assign(self.train_X)
+        self.order = np.argsort(assignments, kind='stable')
+        self.offsets = np.searchsorted(
+            assignments[self.order], np.arange(self.num_clusters + 1))
+        return self
+
+    def assign(self, X):
+        assignments = np.empty(len(X), dtype=np.int64)
+        for start in xrange(0, len(X), self.block_size):
+            assignments[start:start + self.block_size] = np.argmax(
+                np.dot(X[start:start + self.block_size], self.centroids.T),
+                axis=1)
+        return assignments
+
+    def candidates(self, X):
+        _, clusters = top_k(np.dot(X, self.centroids.T), self.num_probes)
+        for i in xrange(len(X)):
+            yield np.concatenate(
+                [self.order[self.offsets[c]:self.offsets[c + 1]]
+                 for c in clusters[i]])
+
+    def params(self):
+        return {'num_clusters': self.num_clusters,
+                'num_probes': self.num_probes,
+                'num_iterations': self.num_iterations, 'seed': self.seed,
+                'block_size': self.block_size}
+
+    def arrays(self):
+        return {'centroids': self.centroids, 'order': self.order,
+                'offsets': self.offsets}
+
+    def restore(self, arrays):
+        self.centroids = arrays['centroids']
+        self.order = arrays['order']
+        self.offsets = arrays['offsets']
+
+
+index_classes = {
+    'exact': ExactIndex,
+    'lsh': RandomProjectionIndex,
+    'ivf': ClusterIndex
+}
+
+
+def build_index(train_X, index_type='exact', **params):
+    """
+    Build a nearest neighbor index over the rows of train_X.
+
+    :param index_type: one of INDEX_TYPES
+    :param params: parameters of the index class
+    """
+    if index_type not in index_classes:
+        raise ValueError('Unrecognized nearest neighbor index type: {}'.format(
+            index_type))
+    index = index_classes[index_type](train_X, **params)
+    if index_type != 'exact':
+        index.build()
+    return index
+
+
+def load_index(path, train_X):
+    """
+    Load an index saved by ExactIndex.save. The training matrix is not part
+    of the saved index and must be the one the index was built on.
+    """
+    with np.load(path) as npz:
+        index_type = str(npz['index_type'])
+        params = dict((key[len('param_'):], npz[key].item())
+                      for key in npz.files if key.startswith('param_'))
+        index = index_classes[index_type](train_X, **params)
+        index.restore(dict((key, npz[key]) for key in npz.files))
+    return index
+
+
+# --- Benchmark --- #
+
+def benchmark(train_X, X, k, configs):
+    """
+    Print the build time, the query time and the recall (with respect to the
+    exact search) of each index configuration.
+
+    :param configs: list of (index type, parameters) pairs
+    """
+    exact = build_index(train_X)
+    start = time.time()
+    _, exact_ids = exact.search(X, k)
+    exact_time = time.time() - start
+    # reference: dense float64 similarity matrix
+    start = time.time()
+    sim_scores = np.matmul(X.astype(np.float64), train_X.astype(np.float64).T)
+    np.argpartition(sim_scores, -k, axis=1)
+    np.partition(sim_scores, -k, axis=1)
+    dense_time = time.time() - start
+    print('{} training vectors, {} queries, k = {}'.format(
+        len(train_X), len(X), k))
+    print('{:<40}{:>10}{:>12}{:>10}'.format('index', 'build (s)', 'query (ms)',
+                                            'recall'))
+    print('{:<40}{:>10}{:>12.3f}{:>10.3f}'.format(
+        'dense (float64)', '-', dense_time * 1000 / len(X), 1.0))
+    print('{:<40}{:>10}{:>12.3f}{:>10.3f}'.format(
+        'exact', '-', exact_time * 1000 / len(X), 1.0))
+    for index_type, params in configs:
+        start = time.time()
+        index = build_index(train_X, index_type, **params)
+        build_time = time.time() - start
+        start = time.time()
+        _, ids = index.search(X, k)
+        query_time = time.time() - start
+        recall = np.mean([len(set(ids[i]) & set(exact_ids[i])) / len(ids[i])
+                          for i in xrange(len(X))])
+        name = '{} {}'.format(index_type, ' '.join(
+            '{}={}'.format(key, value) for key, value in sorted(params.items())))
+        print('{:<40}{:>10.2f}{:>12.3f}{:>10.3f}'.format(
+            name, build_time, query_time * 1000 / len(X), recall))
+
+
+def synthetic_features(size, dim=400, num_centers=200, seed=0):
+    """
+    Clustered unit vectors resembling the slot-filling feature mappings.
+    """
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(num_centers, dim)
+    X = centers[rng.randint(num_centers, size=size)] + \
+        0.5 * rng.randn(size, dim)
+    X = X / np.linalg.norm(X, axis=1)[:, None]
+    return X.astype(np.float32)
+
+
+def main():
+    num_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    if len(sys.argv) > 1 and sys.argv[1] != '-':
+        with np.load(sys.argv[1]) as npz:
+            train_X = npz['arr_0']
+        rng = np.random.RandomState(1)
+        X = train_X[rng.choice(len(train_X), num_queries)]
+        X = X + 0.1 * rng.randn(*X.shape) / np.sqrt(X.shape[1])
+        X = X / np.linalg.norm(X, axis=1)[:, None]
+    else:
+        all_X = synthetic_features(200000 + num_queries)
+        train_X, X = all_X[num_queries:], all_X[:num_queries]
+    configs = [
+        ('lsh', {'num_tables': 8, 'num_bits': 12}),
+        ('lsh', {'num_tables': 16, 'num_bits': 10}),
+        ('ivf', {'num_probes': 4}),
+        ('ivf', {'num_probes': 16})
+    ]
+    for k in [1, 10]:
+        benchmark(train_X, X.astype(np.float32), k, configs)
+        print()
+
+
+if __name__ == '__main__':
+    main()
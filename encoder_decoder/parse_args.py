@@ -44,12 +44,31 @@ def define_input_flags():
                                 'Set to True for quantitive evaluation.')
     tf.app.flags.DEFINE_boolean('process_data', False,
                                 'Set to True for data preprocessing.')
+    tf.app.flags.DEFINE_integer('num_data_processes', 0,
+                                'Number of processes tokenizing the dataset during data preprocessing ' +
+                                '(0: one per CPU).')
+    tf.app.flags.DEFINE_integer('num_eval_processes', 1,
+                                'Number of processes parsing the ground truths and predictions during ' +
+                                'evaluation (0: one per CPU). The processes are forked from the main ' +
+                                'process, which may have TensorFlow loaded.')
+    tf.app.flags.DEFINE_string('metric_cache', '',
+                               'SQLite store of the automatic metrics of evaluated predictions, reused by ' +
+                               'later evaluations (default: <model_root_dir>/metric_cache.sqlite; ' +
+                               '"none": do not keep the metrics across runs).')
     tf.app.flags.DEFINE_boolean('decode', False,
                                 'Set to True for decoding.')
     tf.app.flags.DEFINE_boolean('test', False,
                                 'Set to True to decode and evaluate on the test set.')
     tf.app.flags.DEFINE_boolean('demo', False,
                                 'Set to True for interactive demo.')
+    tf.app.flags.DEFINE_boolean('serve', False,
+                                'Set to True to serve translations over HTTP.')
+    tf.app.flags.DEFINE_string('serve_host', '127.0.0.1', 'Address the inference server listens on.')
+    tf.app.flags.DEFINE_integer('serve_port', 8080, 'Port the inference server listens on.')
+    tf.app.flags.DEFINE_integer('serve_max_batch_size', 64,
+                                'Maximum number of queries translated together by the inference server.')
+    tf.app.flags.DEFINE_float('serve_max_wait_ms', 5,
+                              'Maximum time a query waits for other queries to join its batch.')
     tf.app.flags.DEFINE_boolean('self_test', False,
                                 'Run a self-test if this is set to True.')
 
@@ -108,6 +127,16 @@ def define_input_flags():
                               'Clip gradients to this norm.')
     tf.app.flags.DEFINE_integer('batch_size', 128,
                                 'Batch size to use during training.')
+    tf.app.flags.DEFINE_integer('token_budget', 0,
+                                'If set, train on epochs of length-sorted batches with at most this number of ' +
+                                'padded source and target positions (and at most batch_size examples) per batch.')
+    tf.app.flags.DEFINE_integer('prefetch_batches', 8,
+                                'Number of training batches prepared ahead of time by background threads ' +
+                                '(0: prepare the batches in the training loop).')
+    tf.app.flags.DEFINE_integer('prefetch_workers', 1,
+                                'Number of background threads preparing training batches.')
+    tf.app.flags.DEFINE_integer('shard_size', 1024,
+                                'Number of length-sorted training examples shuffled together when token_budget is set.')
     tf.app.flags.DEFINE_integer('num_layers', 1,
                                 'Number of layers in the encoder-decoder.')
     tf.app.flags.DEFINE_integer('num_samples', -1,
@@ -158,6 +187,8 @@ def define_input_flags():
     tf.app.flags.DEFINE_string('char_decoding_algorithm', 'greedy',
                                'decoding algorithm used for character generation.')
     tf.app.flags.DEFINE_integer('beam_size', -1, 'Size of beam for beam search.')
+    tf.app.flags.DEFINE_integer('decode_batch_size', 1,
+                                'Number of examples decoded together by each model step.')
     tf.app.flags.DEFINE_integer('beam_order', -1, 'Order for beam search.')
     tf.app.flags.DEFINE_float('alpha', 0.5, 'Beam search length normalization parameter.')
     tf.app.flags.DEFINE_integer('top_k', 5, 'Top-k highest-scoring structures to output.')
@@ -169,6 +200,9 @@ def define_input_flags():
     # slot-filling experiments
     tf.app.flags.DEFINE_integer('num_nn_slot_filling', 1, 'Number of nearest neighbors to use in '
                                 'the nearest neighbor slot-filling classifier.')
+    tf.app.flags.DEFINE_string('slot_filling_index', 'exact', 'Nearest neighbor index searched by the '
+                               'slot-filling classifier: exact, lsh (random-projection hashing) or ivf '
+                               '(k-means inverted file).')
     tf.app.flags.DEFINE_boolean('induce_slot_filling_mapping', False,
                                 'Set to True for slot-filling mapping induction.')
     tf.app.flags.DEFINE_boolean('gen_slot_filling_training_data', False,
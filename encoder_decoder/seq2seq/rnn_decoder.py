@@ -160,9 +160,14 @@ class RNNDecoder(decoder.Decoder):
                     attn_dim = attention_states.get_shape()[2]
                     if i == 0:
                         # Append dummy zero vector to the <START> token
-                        selective_reads = tf.zeros([self.batch_size, attn_dim])
                         if bs_decoding:
+                            selective_reads = tf.zeros([self.batch_size, attn_dim])
                             selective_reads = beam_decoder.wrap_input(selective_reads)
+                        else:
+                            # training batches may hold fewer than batch_size
+                            # examples (see batching.TokenBudgetSampler)
+                            selective_reads = tf.zeros(tf.stack(
+                                [tf.shape(input_embedding)[0], int(attn_dim)]))
                     else:
                         encoder_copy_inputs_2d = tf.concat(
                             [tf.expand_dims(x, 1) for x in encoder_copy_inputs], axis=1)
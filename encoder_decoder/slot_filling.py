@@ -10,37 +10,39 @@ import os, sys
 if sys.version_info > (3, 0):
     from six.moves import xrange
 
-import collections, copy, re
+import collections, copy, re, threading
 import numpy as np
 from numpy.linalg import norm
 
 from bashlint import bash, data_tools
+from encoder_decoder import knn_index
 from nlp_tools import constants, format_args, tokenizer
 
 
 # --- Classifiers for estimating likelihood of local matches --- #
 
 class KNearestNeighborModel():
-    def __init__(self, k, train_X, train_Y):
+    def __init__(self, k, train_X, train_Y, index=None):
         """
         :member k: number of neighboring examples to use
         :member train_X: [size, dim] training feature matrix
         :member train_Y: [size, label_dim] training label matrix
+        :member index: nearest neighbor index over train_X (see knn_index),
+            defaults to the exact index
         """
         self.k = k
         self.train_X = train_X
         self.train_Y = train_Y
+        if index is None:
+            index = knn_index.build_index(train_X)
+        self.index = index
 
     def predict(self, X):
         """
         :param X: [size, dim]
         """
-        # [size, size]
-        sim_scores = np.matmul(X, self.train_X.T)
         # [size, self.k]
-        nn = np.argpartition(sim_scores, -self.k, axis=1)[:, -self.k:]
-        # [size, self.k]
-        nn_weights = np.partition(sim_scores, -self.k, axis=1)[:, -self.k:]
+        nn_weights, nn = self.index.search(X, self.k)
 
         nn_prediction = np.sum(
             np.expand_dims(nn_weights, 2) * self.train_Y[nn], axis=1)[:, 0]
@@ -63,6 +65,94 @@ class KNearestNeighborModel():
         print("Accuracy: ", num_correct / num_total)
 
 
+class ClassifierRegistry(object):
+    """
+    Process-wide cache of the slot-filling classifiers loaded from disk.
+
+    A classifier is loaded once per (mapping file, number of neighbors, index
+    type) and reloaded when the size or the modification time of the mapping
+    file changes.
+    """
+    def __init__(self):
+        self.classifiers = {}
+        self.lock = threading.Lock()
+
+    def get(self, mapping_path, k, index_type='exact', verbose=True):
+        stat = os.stat(mapping_path)
+        signature = (stat.st_mtime, stat.st_size)
+        key = (os.path.abspath(mapping_path), k, index_type)
+        with self.lock:
+            if key in self.classifiers:
+                cached_signature, classifier = self.classifiers[key]
+                if cached_signature == signature:
+                    return classifier
+            with np.load(mapping_path) as npz:
+                train_X = npz['arr_0']
+                train_Y = npz['arr_1']
+            index = load_slot_filling_index(mapping_path, train_X, index_type)
+            classifier = KNearestNeighborModel(k, train_X, train_Y, index)
+            self.classifiers[key] = (signature, classifier)
+        if verbose:
+            print('Slot filling classifier parameters loaded.')
+        return classifier
+
+    def clear(self):
+        with self.lock:
+            self.classifiers.clear()
+
+
+classifier_registry = ClassifierRegistry()
+
+
+def load_slot_filling_classifier(mapping_path, k, index_type='exact',
+                                 verbose=True):
+    """
+    Get the k-nearest-neighbor slot-filling classifier trained on the feature
+    mappings saved in mapping_path (see gen_slot_filling_training_data).
+
+    :param index_type: type of the nearest neighbor index searched by the
+        classifier (see knn_index).
+    """
+    return classifier_registry.get(mapping_path, k, index_type=index_type,
+                                   verbose=verbose)
+
+
+def get_slot_filling_index_path(mapping_path, index_type):
+    return '{}.{}.index.npz'.format(
+        re.sub(r'\.npz$', '', mapping_path), index_type)
+
+
+def build_slot_filling_index(mapping_path, index_type, train_X=None, **params):
+    """
+    Build a nearest neighbor index over the feature mappings saved in
+    mapping_path and save it next to them.
+    """
+    if train_X is None:
+        with np.load(mapping_path) as npz:
+            train_X = npz['arr_0']
+    index = knn_index.build_index(train_X, index_type, **params)
+    if index_type != 'exact':
+        index_path = get_slot_filling_index_path(mapping_path, index_type)
+        index.save(index_path)
+        print('Slot filling {} index saved to {}'.format(index_type, index_path))
+    return index
+
+
+def load_slot_filling_index(mapping_path, train_X, index_type):
+    """
+    Load the index of type index_type built over the feature mappings saved
+    in mapping_path, building it if it does not exist or is older than the
+    mappings.
+    """
+    if index_type == 'exact':
+        return knn_index.build_index(train_X)
+    index_path = get_slot_filling_index_path(mapping_path, index_type)
+    if os.path.exists(index_path) and \
+            os.path.getmtime(index_path) >= os.path.getmtime(mapping_path):
+        return knn_index.load_index(index_path, train_X)
+    return build_slot_filling_index(mapping_path, index_type, train_X)
+
+
 def gen_slot_filling_training_data(sess, FLAGS, model, dataset, output_file):
     print("saving slot filling mappings to {}".format(output_file))
 
@@ -144,18 +234,104 @@ def stable_slot_filling(template_tokens, sc_fillers, tg_slots, pointer_targets,
         alignment scores
     :param verbose: print all local alignment scores if set to true
     """
+    if pointer_targets is None:
+        # Steps a) and b) are shared with the batched version
+        return batch_stable_slot_filling(
+            [(template_tokens, tg_slots, decoder_outputs)], sc_fillers,
+            encoder_outputs, slot_filling_classifier, verbose=verbose)[0]
 
     # Step a): prepare (binary) type alignment matrix based on type info
-    M = np.zeros([len(encoder_outputs), len(decoder_outputs)], dtype=np.int32)
+    M = type_match_matrix(sc_fillers, tg_slots, len(encoder_outputs),
+                          len(decoder_outputs), template_tokens)
+    if M is None:
+        return None, None, None
+
+    return align_and_fill(template_tokens, sc_fillers, tg_slots,
+                          M + M * pointer_targets)
+
+
+def batch_stable_slot_filling(beams, sc_fillers, encoder_outputs,
+        slot_filling_classifier, verbose=False):
+    """
+    Fills the argument slots of several command templates decoded from the
+    same source sequence (e.g. the outputs of a beam). The local alignment
+    scores of all (filler, slot) pairs of all templates are computed with a
+    single classifier call.
+
+    :param beams: list of (template_tokens, tg_slots, decoder_outputs) tuples,
+        see stable_slot_filling
+    :param sc_fillers: the slot fillers extracted from the source sequence,
+        indexed by token id
+    :param encoder_outputs: [encoder_length, dim] sequence of encoder hidden states
+    :param slot_filling_classifier: the classifier that produces the local
+        alignment scores
+    :return: list of (tree, temp, mappings) tuples, one per template
+    """
+    encoder_length = len(encoder_outputs)
+    # filler features, shared by all templates
+    # use reversed index for the encoder embeddings matrix
+    filler_features = encoder_outputs[::-1]
+
+    # Step a): prepare (binary) type alignment matrices based on type info
+    Ms = []
+    # (beam index, filler, slot) of the pairs to be scored
+    pair_beams, pair_fillers, pair_slots = [], [], []
+    for i, (template_tokens, tg_slots, decoder_outputs) in enumerate(beams):
+        M = type_match_matrix(sc_fillers, tg_slots, encoder_length,
+                              len(decoder_outputs), template_tokens)
+        Ms.append(M)
+        if M is None:
+            continue
+        # only the scores of fillers which can be aligned to multiple slots
+        # matter
+        fillers, slots = (M * (np.sum(M, axis=1) > 1)[:, None]).nonzero()
+        pair_beams.extend([i] * len(fillers))
+        pair_fillers.extend(fillers)
+        pair_slots.extend(slots)
+
+    # Step b): compute the local alignment scores of all templates
+    scores = []
+    if pair_fillers:
+        X = np.concatenate([
+            filler_features[pair_fillers],
+            np.stack([beams[i][2][s] for i, s in zip(pair_beams, pair_slots)])
+        ], axis=1)
+        X = X / norm(X, axis=1)[:, None]
+        scores = slot_filling_classifier.predict(X)
+    pointer_targets = [None if M is None else np.zeros(M.shape) for M in Ms]
+    for i, f, s, score in zip(pair_beams, pair_fillers, pair_slots, scores):
+        pointer_targets[i][f, s] = score
+        if verbose:
+            print('• alignment ({}, {}): {}\t{}\t{}'.format(
+                f, s, sc_fillers[f], beams[i][1][s], score))
+
+    results = []
+    for (template_tokens, tg_slots, _), M, P in zip(beams, Ms, pointer_targets):
+        if M is None:
+            results.append((None, None, None))
+        else:
+            results.append(align_and_fill(
+                template_tokens, sc_fillers, tg_slots, M + M * P))
+    return results
+
+
+def type_match_matrix(sc_fillers, tg_slots, encoder_length, decoder_length,
+                      template_tokens=None):
+    """
+    :return: [encoder_length, decoder_length] binary matrix of the (filler,
+        slot) pairs of matching types, or None if a filler cannot be held by
+        any slot.
+    """
+    M = np.zeros([encoder_length, decoder_length], dtype=np.int32)
     for f in sc_fillers:
-        if f >= len(encoder_outputs):
-            print(template_tokens, f, len(encoder_outputs))
+        if f >= encoder_length:
+            print(template_tokens, f, encoder_length)
             continue
         surface, filler_type = sc_fillers[f]
         matched = False
         for s in tg_slots:
-            if s >= len(decoder_outputs):
-                print(tg_slots, s, len(decoder_outputs))
+            if s >= decoder_length:
+                print(tg_slots, s, decoder_length)
                 continue
             slot_value, slot_type = tg_slots[s]
             if slot_filler_type_match(slot_type, filler_type):
@@ -163,44 +339,20 @@ def stable_slot_filling(template_tokens, sc_fillers, tg_slots, pointer_targets,
                 matched = True
         if not matched:
             # If no target slot can hold a source filler, skip the alignment
-            # step and return None
-            return None, None, None
+            # step
+            return None
+    return M
 
-    # Step b): compute local alignment scores if they are not provided already
-    if pointer_targets is None:
-        assert(encoder_outputs is not None)
-        assert(decoder_outputs is not None)
-        assert(slot_filling_classifier is not None)
-        pointer_targets = np.zeros([len(encoder_outputs), len(decoder_outputs)])
-        for f in xrange(M.shape[0]):
-            if np.sum(M[f]) > 1:
-                X = []
-                # use reversed index for the encoder embeddings matrix
-                ff = len(encoder_outputs) - f - 1
-                cm_slots_keys = list(tg_slots.keys())
-                for s in cm_slots_keys:
-                    X.append(np.concatenate([encoder_outputs[ff:ff+1],
-                                             decoder_outputs[s:s+1]], axis=1))
-                X = np.concatenate(X, axis=0)
-                X = X / norm(X, axis=1)[:, None]
-                raw_scores = slot_filling_classifier.predict(X)
-                for ii in xrange(len(raw_scores)):
-                    s = cm_slots_keys[ii]
-                    pointer_targets[f, s] = raw_scores[ii]
-                    if verbose:
-                        print('• alignment ({}, {}): {}\t{}\t{}'.format(
-                            f, s, sc_fillers[f], tg_slots[s], raw_scores[ii]))
-
-    M = M + M * pointer_targets
-    # convert M into a dictinary representation of a sparse matrix
-    M_dict = collections.defaultdict(dict)
-    for i in xrange(M.shape[0]):
-        if np.sum(M[i]) > 0:
-            for j in xrange(M.shape[1]):
-                if M[i, j] > 0:
-                    M_dict[i][j] = M[i, j]
-    
-    mappings, remained_fillers = stable_marriage_alignment(M_dict)
+
+def align_and_fill(template_tokens, sc_fillers, tg_slots, M):
+    """
+    Align the fillers and the slots with the stable marriage algorithm and
+    fill the slots of the template.
+
+    :param M: [encoder_length, decoder_length] alignment scores, non-positive
+        scores mark incompatible pairs
+    """
+    mappings, remained_fillers = stable_marriage_alignment_array(M)
 
     if not remained_fillers:
         for f, s in mappings:
@@ -334,6 +486,48 @@ def stable_marriage_alignment(M):
             key=lambda x:x[1][1], reverse=True)], remained_rows
 
 
+def stable_marriage_alignment_array(M):
+    """
+    stable_marriage_alignment on a dense score matrix.
+
+    :param M: [num_rows, num_cols] match scores, i and j are incompatible if
+        M[i, j] <= 0.
+    """
+    # preferred columns of each row, the highest score first (ties in column
+    # order)
+    preferred_list_by_row = {}
+    remained_rows = []
+    for i in np.nonzero(np.any(M > 0, axis=1))[0]:
+        i = int(i)
+        cols = np.argsort(-M[i], kind='stable')
+        cols = cols[M[i, cols] > 0]
+        preferred_list_by_row[i] = collections.deque(
+            (int(j), M[i, j]) for j in cols)
+        remained_rows.append(i)
+    matched_cols = {}
+
+    while (remained_rows):
+        preferred_list_changed = False
+        for i in remained_rows:
+            if len(preferred_list_by_row[i]) > 0:
+                j, match_score = preferred_list_by_row[i].popleft()
+                preferred_list_changed = True
+                if not j in matched_cols:
+                    matched_cols[j] = (i, match_score)
+                    remained_rows.remove(i)
+                else:
+                    if match_score > matched_cols[j][1]:
+                        k, _ = matched_cols[j]
+                        matched_cols[j] = (i, match_score)
+                        remained_rows.remove(i)
+                        remained_rows.append(k)
+        if not preferred_list_changed:
+            break
+
+    return [(y, x) for (x, (y, score)) in sorted(matched_cols.items(),
+            key=lambda x:x[1][1], reverse=True)], remained_rows
+
+
 def fill_default_value(node):
     """
     Fill empty slot in the bash ast with default value.
@@ -466,6 +660,46 @@ def slot_filler_value_match(slot_value, filler_value, slot_type):
                     return 1
         return 0
 
+# (filler type, slot type) pairs of matching types
+SLOT_FILLER_TYPE_MATCHES = {
+    ('_NUMBER', 'Number'),
+    ('_NUMBER', '+Number'),
+    ('_NUMBER', '-Number'),
+    ('_NUMBER', 'Regex'),
+    ('_NUMBER', 'Quantity'),
+    ('_NUMBER', '+Quantity'),
+    ('_NUMBER', '-Quantity'),
+    ('_SIZE', 'Size'),
+    ('_SIZE', '+Size'),
+    ('_SIZE', '-Size'),
+    ('_TIMESPAN', 'Timespan'),
+    ('_TIMESPAN', '+Timespan'),
+    ('_TIMESPAN', '-Timespan'),
+    ('_DATETIME', 'DateTime'),
+    ('_DATETIME', '+DateTime'),
+    ('_DATETIME', '-DateTime'),
+    ('_NUMBER', 'Permission'),
+    ('_NUMBER', '+Permission'),
+    ('_NUMBER', '-Permission'),
+    ('_PERMISSION', 'Permission'),
+    ('_PERMISSION', '+Permission'),
+    ('_PERMISSION', '-Permission'),
+    ('_PATH', 'Path'),
+    ('_DIRECTORY', 'Directory'),
+    ('_DIRECTORY', 'Path'),
+    ('_FILE', 'Path'),
+    ('_FILE', 'File'),
+    ('_FILE', 'Directory'),
+    ('_FILE', 'Regex'),
+    ('_REGEX', 'Username'),
+    ('_REGEX', 'Groupname'),
+    ('_REGEX', 'Directory'),
+    ('_REGEX', 'File'),
+    ('_REGEX', 'Path'),
+    ('_REGEX', 'Regex')
+}
+
+
 def slot_filler_type_match(slot_type, filler_type):
     """'
     Check if the category of a slot in the command matches that of the slot
@@ -475,41 +709,4 @@ def slot_filler_type_match(slot_type, filler_type):
     :param slot_type: slot category in the bash command
     :param filler_type: slot filler category extracted from the natural language.
     """
-    c_matches = {
-        '_NUMBER, Number',
-        '_NUMBER, +Number',
-        '_NUMBER, -Number',
-        '_NUMBER, Regex',
-        '_NUMBER, Quantity',
-        '_NUMBER, +Quantity',
-        '_NUMBER, -Quantity',
-        '_SIZE, Size',
-        '_SIZE, +Size',
-        '_SIZE, -Size',
-        '_TIMESPAN, Timespan',
-        '_TIMESPAN, +Timespan',
-        '_TIMESPAN, -Timespan',
-        '_DATETIME, DateTime',
-        '_DATETIME, +DateTime',
-        '_DATETIME, -DateTime',
-        '_NUMBER, Permission',
-        '_NUMBER, +Permission',
-        '_NUMBER, -Permission',
-        '_PERMISSION, Permission',
-        '_PERMISSION, +Permission',
-        '_PERMISSION, -Permission',
-        '_PATH, Path',
-        '_DIRECTORY, Directory',
-        '_DIRECTORY, Path',
-        '_FILE, Path',
-        '_FILE, File',
-        '_FILE, Directory',
-        '_FILE, Regex',
-        '_REGEX, Username',
-        '_REGEX, Groupname',
-        '_REGEX, Directory',
-        '_REGEX, File',
-        '_REGEX, Path',
-        '_REGEX, Regex'
-    }
-    return '{}, {}'.format(filler_type, slot_type) in c_matches
+    return (filler_type, slot_type) in SLOT_FILLER_TYPE_MATCHES
@@ -0,0 +1,47 @@
+"""
+Random bucketed training data shared by the tests.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+
+BUCKETS = [(5, 6), (10, 11)]
+SOURCE_VOCAB_SIZE = 30
+TARGET_VOCAB_SIZE = 30
+
+# the fields of data_utils.DataPoint read by the sampler and get_batch
+DataPoint = collections.namedtuple(
+    'DataPoint', ['sc_ids', 'tg_ids', 'csc_ids', 'ctg_ids'])
+
+
+def make_data_points(rng, num_data_points, with_copy=False):
+    """
+    :param rng: numpy RandomState
+    :param with_copy: if set, the targets start with ROOT and end with EOS as
+        in the training data, and the CopyNet targets copy the first source
+        token.
+    :return: the list of the data points of each bucket of BUCKETS
+    """
+    if with_copy:
+        # data_utils imports TensorFlow
+        from encoder_decoder import data_utils
+    data_points = [[] for _ in BUCKETS]
+    for _ in range(num_data_points):
+        bucket_id = rng.randint(len(BUCKETS))
+        encoder_size, decoder_size = BUCKETS[bucket_id]
+        sc_ids = list(rng.randint(
+            4, SOURCE_VOCAB_SIZE, size=rng.randint(1, encoder_size)))
+        tg_ids = list(rng.randint(
+            4, TARGET_VOCAB_SIZE, size=rng.randint(1, decoder_size - 1)))
+        if with_copy:
+            tg_ids = [data_utils.ROOT_ID] + tg_ids + [data_utils.EOS_ID]
+            ctg_ids = tg_ids[1:]
+            ctg_ids[0] = TARGET_VOCAB_SIZE
+            data_point = DataPoint(sc_ids, tg_ids, list(sc_ids), ctg_ids)
+        else:
+            data_point = DataPoint(sc_ids, tg_ids, None, None)
+        data_points[bucket_id].append(data_point)
+    return data_points
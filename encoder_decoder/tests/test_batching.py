@@ -0,0 +1,58 @@
+"""
+Count the positions of the batches consumed from BatchPrefetcher, not of the
+batches queued ahead of time.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+import numpy as np
+
+from encoder_decoder import batching
+from encoder_decoder.tests.fixtures import BUCKETS, make_data_points
+
+
+def test_sampler_counts_consumed_batches():
+    data_points = make_data_points(np.random.RandomState(0), 40)
+    sampler = batching.TokenBudgetSampler(
+        data_points, BUCKETS, token_budget=60, shard_size=8, seed=0)
+    num_epoch_batches = len(batching.TokenBudgetSampler(
+        data_points, BUCKETS, token_budget=60, shard_size=8).epoch_batches())
+    # same sequence of batches as sampler
+    reference = batching.TokenBudgetSampler(
+        data_points, BUCKETS, token_budget=60, shard_size=8, seed=0)
+    # consume the first epoch and one batch of the second one
+    reference_batches = iter(reference)
+    expected_real, expected_padded = 0, 0
+    for _ in range(num_epoch_batches + 1):
+        real, padded = reference.count_positions(*next(reference_batches))
+        expected_real += real
+        expected_padded += padded
+
+    train_batches = iter(sampler)
+    sampler_lock = threading.Lock()
+
+    def next_batch():
+        with sampler_lock:
+            bucket_id, data_ids = next(train_batches)
+            epoch = sampler.epoch
+        return (epoch,) + sampler.count_positions(bucket_id, data_ids)
+
+    prefetcher = batching.BatchPrefetcher(next_batch, queue_size=4).start()
+    try:
+        for _ in range(num_epoch_batches + 1):
+            sampler.record_batch(*prefetcher.get())
+        # let the worker fill the queue with batches which are not trained on
+        time.sleep(0.2)
+        stats = sampler.stats()
+    finally:
+        prefetcher.close()
+
+    assert stats['epoch'] == 1
+    assert stats['real_positions'] == expected_real
+    assert stats['padded_positions'] == expected_padded
+    assert sampler.stats()['padded_positions'] == 0
@@ -0,0 +1,98 @@
+"""
+Train a small CopyNet model on the batches of TokenBudgetSampler, whose
+batches may hold fewer than batch_size examples.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+import tempfile
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from encoder_decoder import batching
+from encoder_decoder.seq2seq.seq2seq_model import Seq2SeqModel
+from encoder_decoder.tests.fixtures import BUCKETS, SOURCE_VOCAB_SIZE, \
+    TARGET_VOCAB_SIZE, make_data_points
+
+BATCH_SIZE = 8
+
+
+def make_hyperparams(model_dir):
+    return {
+        'source_vocab_size': SOURCE_VOCAB_SIZE,
+        'target_vocab_size': TARGET_VOCAB_SIZE,
+        'max_source_length': BUCKETS[-1][0],
+        'max_target_length': BUCKETS[-1][1],
+        'max_source_token_size': 10,
+        'max_target_token_size': 10,
+        'rnn_cell': 'gru',
+        'batch_size': BATCH_SIZE,
+        'num_layers': 1,
+        'num_samples': -1,
+        'max_gradient_norm': 5.0,
+        'variational_recurrent_dropout': False,
+        'recurrent_batch_normalization': False,
+        'gamma_c': .1, 'beta_c': .1,
+        'gamma_h': .1, 'beta_h': .1,
+        'gamma_x': .1, 'beta_x': .1,
+        'tg_token_use_attention': True,
+        'sc_token': True,
+        'sc_token_dim': 16,
+        'sc_char': False,
+        'tg_token': True,
+        'tg_char': False,
+        'gamma': 5,
+        'optimizer': 'adam',
+        'learning_rate': 0.001,
+        'learning_rate_decay_factor': 0.99,
+        'adam_epsilon': 1e-8,
+        'steps_per_epoch': 10,
+        'num_epochs': 1,
+        'training_algorithm': 'standard',
+        'margin': 1.0,
+        'use_copy': True,
+        'copy_fun': 'copynet',
+        'chi': 1,
+        'tg_token_attn_fun': 'inner_product',
+        'beta': 0,
+        'encoder_topology': 'rnn',
+        'decoder_topology': 'rnn',
+        'sc_input_keep': 1.0, 'sc_output_keep': 1.0,
+        'tg_input_keep': 1.0, 'tg_output_keep': 1.0,
+        'attention_input_keep': 1.0, 'attention_output_keep': 1.0,
+        'token_decoding_algorithm': 'greedy',
+        'char_decoding_algorithm': 'greedy',
+        'beam_size': 1,
+        'alpha': 0.5,
+        'top_k': 1,
+        'forward_only': False,
+        'force_reading_input': False,
+        'model_dir': model_dir,
+        'decode_sig': 'test'
+    }
+
+
+def test_copynet_trains_on_token_budget_batches():
+    rng = np.random.RandomState(0)
+    data_points = make_data_points(rng, 50, with_copy=True)
+    # the batches of the large bucket hold fewer than BATCH_SIZE examples
+    sampler = batching.TokenBudgetSampler(
+        data_points, BUCKETS, token_budget=60, max_batch_size=BATCH_SIZE,
+        shard_size=16, seed=0)
+    assert min(sampler.batch_sizes) < BATCH_SIZE
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        model = Seq2SeqModel(make_hyperparams(tempfile.mkdtemp()), BUCKETS)
+        sess.run(tf.global_variables_initializer())
+        for bucket_id, data_ids in sampler.epoch_batches():
+            formatted_example = model.get_batch(
+                data_points, bucket_id, data_ids=data_ids)
+            model_outputs = model.step(
+                sess, formatted_example, bucket_id, forward_only=False)
+            assert not math.isnan(model_outputs.losses)
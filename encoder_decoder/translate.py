@@ -19,13 +19,16 @@ if sys.version_info > (3, 0):
 import math
 import numpy as np
 import pickle
+import threading
 import time
 from tqdm import tqdm
 
 import tensorflow as tf
 
+from encoder_decoder import batching
 from encoder_decoder import data_utils
 from encoder_decoder import decode_tools
+from encoder_decoder import framework
 from encoder_decoder import graph_utils
 from encoder_decoder import meta_experiments
 from encoder_decoder import parse_args
@@ -74,6 +77,60 @@ def train(train_set, test_set):
         train_buckets_scale = [sum(train_bucket_sizes[:i+1]) / train_total_size
                                for i in xrange(len(train_bucket_sizes))]
 
+        if FLAGS.token_budget > 0:
+            if FLAGS.decoder_topology in ['basic_tree']:
+                raise ValueError('token_budget requires the rnn decoder: the '
+                                 'tree decoder only accepts batches of '
+                                 'batch_size examples.')
+            # Length-aware batches covering the training set once per epoch
+            sampler = batching.TokenBudgetSampler(
+                train_set.data_points, train_set.buckets, FLAGS.token_budget,
+                max_batch_size=FLAGS.batch_size, shard_size=FLAGS.shard_size)
+            sampler.print_buckets()
+            train_batches = iter(sampler)
+            sampler_lock = threading.Lock()
+
+        def next_batch(batch_builder=None):
+            """
+            :return (bucket_id, formatted example, (epoch, real positions,
+                padded positions) of the batch or None without token budget)
+            """
+            if FLAGS.token_budget > 0:
+                with sampler_lock:
+                    bucket_id, data_ids = next(train_batches)
+                    epoch = sampler.epoch
+                formatted_example = model.get_batch(
+                    train_set.data_points, bucket_id, data_ids=data_ids,
+                    batch_builder=batch_builder)
+                batch_stats = (epoch,) + \
+                    sampler.count_positions(bucket_id, data_ids)
+            else:
+                random_number_01 = np.random.random_sample()
+                bucket_id = min([i for i in xrange(len(train_buckets_scale))
+                                 if train_buckets_scale[i] > random_number_01])
+                formatted_example = model.get_batch(
+                    train_set.data_points, bucket_id, batch_builder=batch_builder)
+                batch_stats = None
+            return bucket_id, formatted_example, batch_stats
+
+        if FLAGS.prefetch_batches > 0:
+            # Assemble the training batches in background threads. Each worker
+            # builds its batches in buffers of its own: a buffer is reused
+            # after the worker has built queue size + 2 more batches of its
+            # shape, which are queued after the batch it held, so the queue
+            # and the current step have released that batch
+            worker_state = threading.local()
+
+            def prefetch_batch():
+                if not hasattr(worker_state, 'batch_builder'):
+                    worker_state.batch_builder = framework.BatchBuilder(
+                        num_buffers=FLAGS.prefetch_batches + 3)
+                return next_batch(worker_state.batch_builder)
+
+            prefetcher = batching.BatchPrefetcher(
+                prefetch_batch, queue_size=FLAGS.prefetch_batches,
+                num_workers=FLAGS.prefetch_workers).start()
+
         loss, dev_loss, epoch_time = 0.0, 0.0, 0.0
         current_step = 0
         previous_losses = []
@@ -85,16 +142,25 @@ def train(train_set, test_set):
             # progress bar
             start_time = time.time()
             for _ in tqdm(xrange(FLAGS.steps_per_epoch)):
-                time.sleep(0.01)
-                random_number_01 = np.random.random_sample()
-                bucket_id = min([i for i in xrange(len(train_buckets_scale))
-                                 if train_buckets_scale[i] > random_number_01])
-                formatted_example = model.get_batch(train_set.data_points, bucket_id)
+                if FLAGS.prefetch_batches > 0:
+                    bucket_id, formatted_example, batch_stats = prefetcher.get()
+                else:
+                    bucket_id, formatted_example, batch_stats = next_batch()
                 model_outputs = model.step(
                     sess, formatted_example, bucket_id, forward_only=False)
                 loss += model_outputs.losses
                 current_step += 1
+                if batch_stats is not None:
+                    sampler.record_batch(*batch_stats)
             epoch_time = time.time() - start_time
+            if FLAGS.prefetch_batches > 0:
+                prefetch_stats = prefetcher.stats()
+                print("input pipeline: waited %.2fs (%.1f%% of epoch-time), "
+                      "starved %d/%d steps, average queue size %.1f" % (
+                    prefetch_stats['wait_time'],
+                    100 * prefetch_stats['wait_time'] / epoch_time,
+                    prefetch_stats['starved_steps'], prefetch_stats['steps'],
+                    prefetch_stats['average_queue_size']))
 
             # Once in a while, we save checkpoint, print statistics, and run evals.
             if t % FLAGS.epochs_per_checkpoint == 0:
@@ -107,9 +173,17 @@ def train(train_set, test_set):
                     if t > 1:
                         break
                     else:
+                        if FLAGS.prefetch_batches > 0:
+                            prefetcher.close()
                         raise graph_utils.InfPerplexityError
                 print("learning rate %.4f epoch-time %.4f perplexity %.2f" % (
                     model.learning_rate.eval(), epoch_time, ppx))
+                if FLAGS.token_budget > 0:
+                    sampler_stats = sampler.stats()
+                    print("data epoch %d padding efficiency %.3f (%d/%d positions)" % (
+                        sampler_stats['epoch'], sampler_stats['padding_efficiency'],
+                        sampler_stats['real_positions'],
+                        sampler_stats['padded_positions']))
 
                 # Decrease learning rate if no improvement of loss was seen
                 # over last 3 times.
@@ -151,6 +225,9 @@ def train(train_set, test_set):
 
                 sys.stdout.flush()
 
+        if FLAGS.prefetch_batches > 0:
+            prefetcher.close()
+
         return model
 
 
@@ -181,6 +258,16 @@ def demo(buckets=None):
         decode_tools.demo(sess, model, FLAGS)
 
 
+def serve(buckets=None):
+    # asyncio is only available in Python 3
+    from encoder_decoder import inference_server
+    with tf.Session(config=tf.ConfigProto(allow_soft_placement=True,
+        log_device_placement=FLAGS.log_device_placement)) as sess:
+        # Initialize model parameters.
+        model = define_model(sess, forward_only=True, buckets=buckets)
+        inference_server.serve(sess, model, FLAGS)
+
+
 def save_hyperparameters():
     model_subdir, decode_sig = graph_utils.get_decode_signature(FLAGS)
     with open(os.path.join(FLAGS.model_root_dir, model_subdir, 'hyperparameters.pkl'), 'wb') as o_f:
@@ -205,6 +292,10 @@ def gen_slot_filling_training_data(FLAGS, datasets):
             os.path.join(FLAGS.model_dir, 'dev.mappings.X.Y.npz'))
         slot_filling.gen_slot_filling_training_data(sess, FLAGS, model, test_set,
             os.path.join(FLAGS.model_dir, 'test.mappings.X.Y.npz'))
+    if FLAGS.slot_filling_index != 'exact':
+        slot_filling.build_slot_filling_index(
+            os.path.join(FLAGS.model_dir, 'train.mappings.X.Y.npz'),
+            FLAGS.slot_filling_index)
 
     # Restore hyperparameters
     FLAGS.token_decoding_algorithm = token_decoding_algorithm
@@ -331,6 +422,9 @@ def main(_):
         elif FLAGS.demo:
             demo(buckets=train_set.buckets)
 
+        elif FLAGS.serve:
+            serve(buckets=train_set.buckets)
+
         elif FLAGS.grid_search:
             meta_experiments.grid_search(
                 train, decode, eval, train_set, dataset, FLAGS)
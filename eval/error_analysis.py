@@ -17,12 +17,13 @@ if sys.version_info > (3, 0):
 
 from bashlint import bash, data_tools
 from encoder_decoder import data_utils, graph_utils
-from eval import tree_dist
+from eval import metric_cache, tree_dist
 from eval.eval_tools import load_predictions
 from eval.eval_tools import load_all_model_predictions
 from eval.eval_tools import load_cached_evaluations
 from eval.eval_tools import load_cached_correct_translations
 from eval.eval_tools import get_example_nl_key
+from eval.metric_cache import metric_store
 
 
 error_types = {
@@ -37,6 +38,36 @@ error_types = {
     9 : "count error"
 }
 
+# metrics of a prediction computed by the error analysis functions and
+# recorded in the metric store
+MATCH_METRICS = ('template', 'arg_free_match', 'str_match')
+
+
+def get_match_metrics(command_gts, command_gt_asts, pred_cmd, cmd_parser):
+    """
+    Get the template of a prediction and whether it matches one of the ground
+    truths, ignoring argument values (arg_free_match) or not (str_match).
+
+    The metrics of bash predictions are read from the metric store if the
+    prediction has been analyzed before.
+    """
+    use_store = cmd_parser is data_tools.bash_parser
+    if use_store:
+        record = metric_store.get(command_gts, pred_cmd)
+        if metric_cache.has_metrics(record, MATCH_METRICS):
+            return record
+    pred_tree = cmd_parser(pred_cmd)
+    metrics = {
+        'template': data_tools.ast2template(pred_tree, loose_constraints=True),
+        'arg_free_match': bool(tree_dist.one_match(
+            command_gt_asts, pred_tree, ignore_arg_value=True)),
+        'str_match': bool(tree_dist.one_match(
+            command_gt_asts, pred_tree, ignore_arg_value=False))
+    }
+    if use_store:
+        metric_store.update(command_gts, pred_cmd, metrics)
+    return metrics
+
 
 def gen_manual_evaluation_csv_single_model(dataset, FLAGS):
     """
@@ -148,6 +179,7 @@ def gen_manual_evaluation_csv(dataset, FLAGS, num_examples=100):
     eval_bash = FLAGS.dataset.startswith("bash")
     cmd_parser = data_tools.bash_parser if eval_bash \
         else data_tools.paren_parser
+    metric_cache.enable_disk_cache_from_flags(FLAGS)
 
     output_path = os.path.join(FLAGS.data_dir, 'manual.evaluations.csv')
     with open(output_path, 'w') as o_f:
@@ -167,12 +199,11 @@ def gen_manual_evaluation_csv(dataset, FLAGS, num_examples=100):
                     else:
                         output_str = ',,'
                     pred_cmd = predictions[i]
-                    pred_tree = cmd_parser(pred_cmd)
-                    pred_temp = data_tools.ast2template(pred_tree, loose_constraints=True)
-                    temp_match = tree_dist.one_match(
-                        command_gt_asts, pred_tree, ignore_arg_value=True)
-                    str_match = tree_dist.one_match(
-                        command_gt_asts, pred_tree, ignore_arg_value=False)
+                    metrics = get_match_metrics(
+                        command_gts, command_gt_asts, pred_cmd, cmd_parser)
+                    pred_temp = metrics['template']
+                    temp_match = metrics['arg_free_match']
+                    str_match = metrics['str_match']
                     if (model_id * min(3, len(predictions)) + i) < len(command_gts):
                         output_str += '"{}",'.format(
                             command_gts[model_id * min(
@@ -224,6 +255,7 @@ def tabulate_example_predictions(dataset, FLAGS, num_examples=100):
     eval_bash = FLAGS.dataset.startswith("bash")
     cmd_parser = data_tools.bash_parser if eval_bash \
         else data_tools.paren_parser
+    metric_cache.enable_disk_cache_from_flags(FLAGS)
 
     model_name_pt = {
         'token-seq2seq': 'T-Seq2Seq',
@@ -247,12 +279,11 @@ def tabulate_example_predictions(dataset, FLAGS, num_examples=100):
             predictions = model_predictions[model_id][example_id]
             for i in xrange(min(3, len(predictions))):
                 pred_cmd = predictions[i]
-                pred_tree = cmd_parser(pred_cmd)
-                pred_temp = data_tools.ast2template(pred_tree, loose_constraints=True)
-                temp_match = tree_dist.one_match(
-                    command_gt_asts, pred_tree, ignore_arg_value=True)
-                str_match = tree_dist.one_match(
-                    command_gt_asts, pred_tree, ignore_arg_value=False)
+                metrics = get_match_metrics(
+                    command_gts, command_gt_asts, pred_cmd, cmd_parser)
+                pred_temp = metrics['template']
+                temp_match = metrics['arg_free_match']
+                str_match = metrics['str_match']
                 
                 output_str = '& \\<{}> & {}'.format(pred_cmd.replace('__SP__', '')
                                                            .replace('_', '\\_')
@@ -321,6 +352,7 @@ def print_error_analysis_csv(grouped_dataset, prediction_list, FLAGS,
     eval_bash = FLAGS.dataset.startswith("bash")
     cmd_parser = data_tools.bash_parser if eval_bash \
         else data_tools.paren_parser
+    metric_cache.enable_disk_cache_from_flags(FLAGS)
     if group_by_utility:
         utility_index = {}
         for line in bash.utility_stats.split('\n'):
@@ -353,13 +385,11 @@ def print_error_analysis_csv(grouped_dataset, prediction_list, FLAGS,
             else:
                 output_str = ',,'
             pred_cmd = predictions[i]
-            tree = cmd_parser(pred_cmd)
 
             # evaluation ignoring flag orders
-            temp_match = tree_dist.one_match(
-                gt_trees, tree, ignore_arg_value=True)
-            str_match = tree_dist.one_match(
-                gt_trees, tree, ignore_arg_value=False)
+            metrics = get_match_metrics(tg_strs, gt_trees, pred_cmd, cmd_parser)
+            temp_match = metrics['arg_free_match']
+            str_match = metrics['str_match']
             if i < len(tg_strs):
                 output_str += '"{}",'.format(
                     tg_strs[i].strip().replace('"', '""'))
@@ -7,7 +7,7 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
-import csv
+import multiprocessing
 import nltk
 import numpy as np
 import os, sys
@@ -16,10 +16,13 @@ import random
 if sys.version_info > (3, 0):
     from six.moves import xrange
 
-from bashlint import data_tools
+from bashlint import data_tools, parse_cache
 from encoder_decoder import data_utils, graph_utils
-from eval import token_based, tree_dist
-from nlp_tools import constants, tokenizer
+from eval import judgement_store, metric_cache, token_based, tree_dist
+from eval.judgement_store import get_example_cm_key, get_example_nl_key, \
+    normalize_judgement
+from eval.metric_cache import metric_store
+from nlp_tools import constants
 import utils.ops
 
 
@@ -34,29 +37,6 @@ def gen_evaluation_table(dataset, FLAGS, num_examples=-1, interactive=True):
           Otherwise, count all predictions that does not match any of the
           groundtruths as wrong.
     """
-    def add_judgement(data_dir, nl, command, correct_template='', correct_command=''):
-        """
-        Append a new judgement
-        """
-        data_dir = os.path.join(data_dir, 'manual_judgements')
-        manual_judgement_path = os.path.join(
-            data_dir, 'manual.evaluations.additional')
-        if not os.path.exists(manual_judgement_path):
-            with open(manual_judgement_path, 'w') as o_f:
-                o_f.write(
-                    'description,prediction,template,correct template,correct command\n')
-        with open(manual_judgement_path, 'a') as o_f:
-            temp = data_tools.cmd2template(command, loose_constraints=True)
-            if not correct_template:
-                correct_template = 'n'
-            if not correct_command:
-                correct_command = 'n'
-            o_f.write('"{}","{}","{}","{}","{}"\n'.format(
-                nl.replace('"', '""'), command.replace('"', '""'),
-                temp.replace('"', '""'), correct_template.replace('"', '""'),
-                correct_command.replace('"', '""')))
-        print('new judgement added to {}'.format(manual_judgement_path))
-
     # Group dataset
     grouped_dataset = data_utils.group_parallel_data(dataset, use_bucket=True)
 
@@ -84,9 +64,10 @@ def gen_evaluation_table(dataset, FLAGS, num_examples=-1, interactive=True):
         sample_ids = example_ids
 
     # Load cached evaluation results
+    judgement_dir = os.path.join(FLAGS.data_dir, 'manual_judgements')
+    store = judgement_store.get_judgement_store(judgement_dir)
     structure_eval_cache, command_eval_cache = \
-        load_cached_evaluations(
-            os.path.join(FLAGS.data_dir, 'manual_judgements'))
+        load_cached_evaluations(judgement_dir)
 
     eval_bash = FLAGS.dataset.startswith("bash")
     cmd_parser = data_tools.bash_parser if eval_bash \
@@ -138,8 +119,8 @@ def gen_evaluation_table(dataset, FLAGS, num_examples=-1, interactive=True):
                             print('> {}'.format(pred_cmd))
                             command_eval = input(
                                 'CORRECT COMMAND? [y/reason] ')
-                            add_judgement(FLAGS.data_dir, sc_key, pred_cmd,
-                                          structure_eval, command_eval)
+                            store.add_judgement(sc_key, pred_cmd, structure_eval,
+                                                command_eval)
                             print()
                     else:
                         if not structure_eval and interactive:
@@ -152,8 +133,8 @@ def gen_evaluation_table(dataset, FLAGS, num_examples=-1, interactive=True):
                             if structure_eval == 'y':
                                 command_eval = input(
                                     'CORRECT COMMAND? [y/reason] ')
-                            add_judgement(FLAGS.data_dir, sc_key, pred_cmd,
-                                          structure_eval, command_eval)
+                            store.add_judgement(sc_key, pred_cmd, structure_eval,
+                                                command_eval)
                             print()
                     structure_eval_cache[structure_example_key] = structure_eval
                     command_eval_cache[command_example_key] = command_eval
@@ -247,10 +228,94 @@ def automatic_eval(model_dir, decode_sig, dataset, FLAGS, top_k,
     return M
 
 
+# metrics of a prediction computed by get_automatic_evaluation_metrics and
+# recorded in the metric store
+AUTOMATIC_METRICS = ('template', 'temp_match', 'str_match', 'cms', 'bleu')
+
+
+def serialized_ast(cmd):
+    return parse_cache.serialize_tree(data_tools.bash_parser(cmd))
+
+
+def prepare_example(item):
+    """
+    Parse and templatize the ground truths and predictions of an example, and
+    compute the BLEU score of every prediction. Run in worker processes by
+    get_automatic_evaluation_metrics.
+
+    The ASTs are returned in the flat_nast binary format, which is much
+    cheaper to send back from a worker than pickled nast.Node objects; see
+    load_prepared_example.
+
+    :param item: (ground truth commands, predicted commands)
+    :return (serialized ground truth ASTs, serialized ground truth template
+        ASTs, serialized prediction ASTs, prediction templates, BLEU scores)
+    """
+    command_gts, predictions = item
+    command_gt_asts = [serialized_ast(cmd) for cmd in command_gts]
+    template_gts = [data_tools.cmd2template(cmd, loose_constraints=True)
+                    for cmd in command_gts]
+    template_gt_asts = [serialized_ast(temp) for temp in template_gts]
+    pred_asts = [serialized_ast(pred_cmd) for pred_cmd in predictions]
+    pred_temps = [data_tools.cmd2template(pred_cmd, loose_constraints=True)
+                  for pred_cmd in predictions]
+    bleus = [nltk.translate.bleu_score.sentence_bleu(command_gts, pred_cmd)
+             for pred_cmd in predictions]
+    return command_gt_asts, template_gt_asts, pred_asts, pred_temps, bleus
+
+
+def load_prepared_example(prepared):
+    """
+    Deserialize the ASTs returned by prepare_example.
+    """
+    command_gt_asts, template_gt_asts, pred_asts, pred_temps, bleus = prepared
+    return ([parse_cache.deserialize_tree(data) for data in command_gt_asts],
+            [parse_cache.deserialize_tree(data) for data in template_gt_asts],
+            [parse_cache.deserialize_tree(data) for data in pred_asts],
+            pred_temps, bleus)
+
+
+def prepare_examples(items, num_processes=1, chunk_size=16):
+    """
+    Run prepare_example over all examples, in a pool of worker processes
+    unless num_processes is 1.
+
+    :param num_processes: number of worker processes (None: one per CPU).
+    """
+    if num_processes == 1 or not items:
+        prepared = [prepare_example(item) for item in items]
+    else:
+        pool = multiprocessing.Pool(num_processes)
+        try:
+            prepared = list(pool.imap(prepare_example, items,
+                                      chunksize=chunk_size))
+        finally:
+            pool.terminate()
+    return [load_prepared_example(p) for p in prepared]
+
+
 def get_automatic_evaluation_metrics(grouped_dataset, prediction_list, vocabs, FLAGS, top_k,
-                                     num_samples=-1, verbose=False):
-    cmd_parser = data_tools.bash_parser
+                                     num_samples=-1, verbose=False,
+                                     num_processes=None):
+    """
+    The metrics of predictions which have been evaluated before are read
+    from the metric store (see metric_cache). The other predictions are
+    evaluated in two stages:
+        1. their commands are parsed and templatized in a process pool
+           (see prepare_example),
+        2. their template and string matches and CMS are computed in batches
+           and added to the metric store.
+    Finally, the metrics are combined with the manual judgements and
+    aggregated.
+
+    :param num_processes: number of worker processes of the first stage
+        (defaults to --num_eval_processes, 0 meaning one per CPU); set to 1
+        to run serially.
+    """
+    if num_processes is None:
+        num_processes = getattr(FLAGS, 'num_eval_processes', 1)
     rev_sc_vocab = vocabs.rev_sc_vocab
+    metric_cache.enable_disk_cache_from_flags(FLAGS)
 
     # Load cached evaluation results
     structure_eval_cache, command_eval_cache = \
@@ -267,6 +332,55 @@ def get_automatic_evaluation_metrics(grouped_dataset, prediction_list, vocabs, F
         grouped_dataset = [grouped_dataset[i] for i in sample_ids]
         prediction_list = [prediction_list[i] for i in sample_ids]
 
+    # Look up the metrics computed by earlier evaluations
+    command_gts_list = [[dp.tg_txt.strip() for dp in data_group]
+                        for _, data_group in grouped_dataset]
+    records_list = [[metric_store.get(command_gts, pred_cmd)
+                     for pred_cmd in predictions]
+                    for command_gts, predictions
+                    in zip(command_gts_list, prediction_list)]
+    new_ids = [[i for i, record in enumerate(records)
+                if not metric_cache.has_metrics(record, AUTOMATIC_METRICS)]
+               for records in records_list]
+    data_ids = [data_id for data_id in xrange(len(grouped_dataset))
+                if new_ids[data_id]]
+
+    # Stage 1: parse
+    prepared = prepare_examples(
+        [(command_gts_list[data_id],
+          [prediction_list[data_id][i] for i in new_ids[data_id]])
+         for data_id in data_ids], num_processes or None)
+
+    # Stage 2: matches and CMS
+    temp_matches_list, str_matches_list = [], []
+    cms_gts, cms_preds = [], []
+    for (command_gt_asts, template_gt_asts, pred_asts, _, _) in prepared:
+        # evaluation ignoring flag orders
+        temp_matches_list.append(tree_dist.one_matches(
+            template_gt_asts, pred_asts, ignore_arg_value=True))
+        str_matches_list.append(tree_dist.one_matches(
+            command_gt_asts, pred_asts, ignore_arg_value=False))
+        cms_gts.extend([template_gt_asts] * len(pred_asts))
+        cms_preds.extend(pred_asts)
+    cms_scores = token_based.batch_command_match_score(cms_gts, cms_preds)
+
+    cms_start = 0
+    for j, data_id in enumerate(data_ids):
+        command_gts = command_gts_list[data_id]
+        _, _, _, pred_temps, bleus = prepared[j]
+        for k, i in enumerate(new_ids[data_id]):
+            pred_cmd = prediction_list[data_id][i]
+            metric_store.update(command_gts, pred_cmd, {
+                'template': pred_temps[k],
+                'temp_match': bool(temp_matches_list[j][k]),
+                'str_match': bool(str_matches_list[j][k]),
+                'cms': float(cms_scores[cms_start + k]),
+                'bleu': float(bleus[k])
+            })
+            records_list[data_id][i] = metric_store.get(command_gts, pred_cmd)
+        cms_start += len(bleus)
+
+    # Stage 3: aggregate
     num_eval = 0
     top_k_temp_correct = np.zeros([len(grouped_dataset), top_k])
     top_k_str_correct = np.zeros([len(grouped_dataset), top_k])
@@ -283,10 +397,7 @@ def get_automatic_evaluation_metrics(grouped_dataset, prediction_list, vocabs, F
             sc_features = sc_features.replace(constants._SPACE, ' ')
         else:
             sc_features = ' '.join(sc_tokens)
-        command_gts = [dp.tg_txt.strip() for dp in data_group]
-        command_gt_asts = [data_tools.bash_parser(cmd) for cmd in command_gts]
-        template_gts = [data_tools.cmd2template(cmd, loose_constraints=True) for cmd in command_gts]
-        template_gt_asts = [data_tools.bash_parser(temp) for temp in template_gts]
+        command_gts = command_gts_list[data_id]
         if verbose:
             print("Example {}".format(data_id))
             print("Original Source: {}".format(sc_str))
@@ -297,16 +408,13 @@ def get_automatic_evaluation_metrics(grouped_dataset, prediction_list, vocabs, F
         predictions = prediction_list[data_id]
         for i in xrange(len(predictions)):
             pred_cmd = predictions[i]
-            pred_ast = cmd_parser(pred_cmd)
-            pred_temp = data_tools.cmd2template(pred_cmd, loose_constraints=True)
+            record = records_list[data_id][i]
+            pred_temp = record['template']
             # Match ground truths & exisitng judgements
             command_example_key = '{}<NL_PREDICTION>{}'.format(sc_key, pred_cmd)
             structure_example_key = '{}<NL_PREDICTION>{}'.format(sc_key, pred_temp)
-            # evaluation ignoring flag orders
-            temp_match = tree_dist.one_match(
-                template_gt_asts, pred_ast, ignore_arg_value=True)
-            str_match = tree_dist.one_match(
-                command_gt_asts, pred_ast, ignore_arg_value=False)
+            temp_match = record['temp_match']
+            str_match = record['str_match']
             if command_eval_cache and command_example_key in command_eval_cache:
                 str_match = normalize_judgement(command_eval_cache[command_example_key]) == 'y'
             if structure_eval_cache and structure_example_key in structure_eval_cache:
@@ -315,8 +423,8 @@ def get_automatic_evaluation_metrics(grouped_dataset, prediction_list, vocabs, F
                 top_k_temp_correct[data_id, i] = 1
             if str_match:
                 top_k_str_correct[data_id, i] = 1
-            cms = token_based.command_match_score(template_gt_asts, pred_ast)
-            bleu = nltk.translate.bleu_score.sentence_bleu(command_gts, pred_cmd)
+            cms = record['cms']
+            bleu = record['bleu']
             top_k_cms[data_id, i] = cms
             top_k_bleu[data_id, i] = bleu
             if verbose:
@@ -533,38 +641,11 @@ def load_cached_correct_translations(data_dir, treat_empty_as_correct=False, ver
 
     :return: nl -> template translation map, nl -> command translation map
     """
-    command_translations = collections.defaultdict(set)
-    template_translations = collections.defaultdict(set)
-    eval_files = []
-    for file_name in os.listdir(data_dir):
-        if 'evaluations' in file_name and not file_name.endswith('base'):
-            eval_files.append(file_name)
-    for file_name in sorted(eval_files):
-        manual_judgement_path = os.path.join(data_dir, file_name)
-        with open(manual_judgement_path) as f:
-            if verbose:
-                print('reading cached evaluations from {}'.format(
-                    manual_judgement_path))
-            reader = csv.DictReader(f)
-            current_nl_key = ''
-            for row in reader:
-                if row['description']:
-                    current_nl_key = get_example_nl_key(row['description'])
-                pred_cmd = row['prediction']
-                if 'template' in row:
-                    pred_temp = row['template']
-                else:
-                    pred_temp = data_tools.cmd2template(pred_cmd, loose_constraints=True)
-                structure_eval = row['correct template']
-                if treat_empty_as_correct:
-                    structure_eval = normalize_judgement(structure_eval)
-                command_eval = row['correct command']
-                if treat_empty_as_correct:
-                    command_eval = normalize_judgement(command_eval)
-                if structure_eval == 'y':
-                    template_translations[current_nl_key].add(pred_temp)
-                if command_eval == 'y':
-                    command_translations[current_nl_key].add(pred_cmd)
+    store = judgement_store.get_judgement_store(data_dir)
+    template_translations = judgement_store.TranslationDict(
+        store, structure=True, treat_empty_as_correct=treat_empty_as_correct)
+    command_translations = judgement_store.TranslationDict(
+        store, structure=False, treat_empty_as_correct=treat_empty_as_correct)
     print('{} template translations loaded'.format(len(template_translations)))
     print('{} command translations loaded'.format(len(command_translations)))
 
@@ -576,22 +657,12 @@ def load_cached_evaluations(model_dir, verbose=True):
     Load cached evaluation results from disk.
 
     :param model_dir: Directory where the evaluation result file is stored.
-    :param decode_sig: The decoding signature of the model being evaluated.
-    :return: dictionaries storing the evaluation results.
+    :return: dictionaries storing the evaluation results, backed by the
+        judgement store of model_dir.
     """
-    structure_eval_results = {}
-    command_eval_results = {}
-    eval_files = []
-    for file_name in os.listdir(model_dir):
-        if 'evaluations' in file_name and not file_name.endswith('base'):
-            eval_files.append(file_name)
-    for file_name in sorted(eval_files):
-        manual_judgement_path = os.path.join(model_dir, file_name)
-        ser, cer = load_cached_evaluations_from_file(manual_judgement_path, verbose=verbose)
-        for key in ser:
-            structure_eval_results[key] = ser[key]
-        for key in cer:
-            command_eval_results[key] = cer[key]
+    store = judgement_store.get_judgement_store(model_dir)
+    structure_eval_results = judgement_store.JudgementDict(store, structure=True)
+    command_eval_results = judgement_store.JudgementDict(store, structure=False)
     if verbose:
         print('{} structure evaluation results loaded'.format(len(structure_eval_results)))
         print('{} command evaluation results loaded'.format(len(command_eval_results)))
@@ -601,54 +672,19 @@ def load_cached_evaluations(model_dir, verbose=True):
 def load_cached_evaluations_from_file(input_file, treat_empty_as_correct=False, verbose=True):
     structure_eval_results = {}
     command_eval_results = {}
-    with open(input_file) as f:
-        if verbose:
-            print('reading cached evaluations from {}'.format(input_file))
-        reader = csv.DictReader(f)
-        current_nl_key = ''
-        for row in reader:
-            if row['description']:
-                current_nl_key = get_example_nl_key(row['description'])
-            pred_cmd = row['prediction']
-            if 'template' in row:
-                pred_temp = row['template']
-            else:
-                pred_temp = data_tools.cmd2template(pred_cmd, loose_constraints=True)
-            command_eval = row['correct command']
-            if treat_empty_as_correct:
-                command_eval = normalize_judgement(command_eval)
-            command_example_key = '{}<NL_PREDICTION>{}'.format(current_nl_key, pred_cmd)
-            if command_eval:
-                command_eval_results[command_example_key] = command_eval
-            structure_eval = row['correct template']
-            if treat_empty_as_correct:
-                structure_eval = normalize_judgement(structure_eval)
-            structure_example_key = '{}<NL_PREDICTION>{}'.format(current_nl_key, pred_temp)
-            if structure_eval:
-                structure_eval_results[structure_example_key] = structure_eval
+    if verbose:
+        print('reading cached evaluations from {}'.format(input_file))
+    store = judgement_store.get_judgement_store(os.path.dirname(input_file))
+    for current_nl_key, pred_cmd, pred_temp, structure_eval, command_eval in \
+            store.file_judgements(os.path.basename(input_file)):
+        if treat_empty_as_correct:
+            command_eval = normalize_judgement(command_eval)
+        command_example_key = '{}<NL_PREDICTION>{}'.format(current_nl_key, pred_cmd)
+        if command_eval:
+            command_eval_results[command_example_key] = command_eval
+        if treat_empty_as_correct:
+            structure_eval = normalize_judgement(structure_eval)
+        structure_example_key = '{}<NL_PREDICTION>{}'.format(current_nl_key, pred_temp)
+        if structure_eval:
+            structure_eval_results[structure_example_key] = structure_eval
     return structure_eval_results, command_eval_results
-
-
-def get_example_nl_key(nl):
-    """
-    Get the natural language description in an example with nuances removed.
-    """
-    tokens, _ = tokenizer.basic_tokenizer(nl)
-    return ' '.join(tokens)
-
-
-def get_example_cm_key(cm):
-    """
-    TODO: implement command normalization
-        1. flag order normalization
-        2. flag format normalization (long flag vs. short flag)
-        3. remove flags whose effect does not matter
-    """
-    return cm
-
-
-def normalize_judgement(x):
-    if not x or x.lower() == 'y':
-        return 'y'
-    else:
-        return 'n'
@@ -0,0 +1,350 @@
+"""
+Indexed store of the manual judgements of model predictions.
+
+The judgements are kept in the .csv files of a judgement directory (every file
+whose name contains 'evaluations' and does not end with 'base'). Each file is
+parsed once into an SQLite index stored next to it, keyed by the natural
+language key (get_example_nl_key) and the command key (get_example_cm_key)
+or the template of the prediction. A file is re-indexed only when its size or
+modification time changes, and add_judgement appends a judgement to both the
+.csv file and the index, hence looking up a judgement does not depend on the
+number of judgements recorded.
+
+When a prediction has been judged several times, the last non-empty
+judgement wins, the files being ordered by name.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import csv
+import os
+import sqlite3
+import threading
+
+from bashlint import data_tools
+from nlp_tools import tokenizer
+
+INDEX_FILE = 'judgements.index.sqlite'
+ADDITIONAL_JUDGEMENT_FILE = 'manual.evaluations.additional'
+# separates the two parts of the keys of the judgement dictionaries
+KEY_SEPARATOR = '<NL_PREDICTION>'
+
+CSV_HEADER = 'description,prediction,template,correct template,correct command\n'
+
+
+def get_example_nl_key(nl):
+    """
+    Get the natural language description in an example with nuances removed.
+    """
+    tokens, _ = tokenizer.basic_tokenizer(nl)
+    return ' '.join(tokens)
+
+
+def get_example_cm_key(cm):
+    """
+    TODO: implement command normalization
+        1. flag order normalization
+        2. flag format normalization (long flag vs. short flag)
+        3. remove flags whose effect does not matter
+    """
+    return cm
+
+
+def normalize_judgement(x):
+    if not x or x.lower() == 'y':
+        return 'y'
+    else:
+        return 'n'
+
+
+def is_judgement_file(file_name):
+    return 'evaluations' in file_name and not file_name.endswith('base')
+
+
+def read_judgement_file(path):
+    """
+    :return: list of (nl key, prediction, template, structure judgement,
+        command judgement) tuples, one per row of the file.
+    """
+    rows = []
+    with open(path) as f:
+        reader = csv.DictReader(f)
+        current_nl_key = ''
+        for row in reader:
+            if row['description']:
+                current_nl_key = get_example_nl_key(row['description'])
+            pred_cmd = row['prediction']
+            if 'template' in row:
+                pred_temp = row['template']
+            else:
+                pred_temp = data_tools.cmd2template(pred_cmd, loose_constraints=True)
+            rows.append((current_nl_key, pred_cmd, pred_temp,
+                         row['correct template'], row['correct command']))
+    return rows
+
+
+class JudgementStore(object):
+    """
+    SQLite index of the judgement files of a directory.
+    """
+    def __init__(self, judgement_dir, index_path=None):
+        self.judgement_dir = judgement_dir
+        self.index_path = index_path or os.path.join(judgement_dir, INDEX_FILE)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.index_path, timeout=60,
+                                    check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                          'name TEXT PRIMARY KEY, mtime REAL, size INTEGER)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS judgements ('
+                          'file TEXT, row INTEGER, nl_key TEXT, cm_key TEXT, '
+                          'template TEXT, structure_eval TEXT, '
+                          'command_eval TEXT, PRIMARY KEY (file, row))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS command_index '
+                          'ON judgements (nl_key, cm_key)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS template_index '
+                          'ON judgements (nl_key, template)')
+        self.conn.commit()
+        self.sync()
+
+    def sync(self):
+        """
+        Re-index the judgement files which have been modified, added or
+        removed since they were last indexed.
+        """
+        with self.lock:
+            file_names = set(
+                file_name for file_name in os.listdir(self.judgement_dir)
+                if is_judgement_file(file_name))
+            for file_name in sorted(file_names):
+                self.sync_file(file_name)
+            for (file_name,) in self.conn.execute(
+                    'SELECT name FROM files').fetchall():
+                if file_name not in file_names:
+                    self.remove_file(file_name)
+            self.conn.commit()
+
+    def sync_file(self, file_name):
+        stat = os.stat(os.path.join(self.judgement_dir, file_name))
+        row = self.conn.execute('SELECT mtime, size FROM files WHERE name = ?',
+                                (file_name,)).fetchone()
+        if row == (stat.st_mtime, stat.st_size):
+            return
+        self.remove_file(file_name)
+        rows = read_judgement_file(os.path.join(self.judgement_dir, file_name))
+        self.conn.executemany(
+            'INSERT INTO judgements VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(file_name, i, nl_key, get_example_cm_key(pred_cmd), pred_temp,
+              structure_eval, command_eval)
+             for i, (nl_key, pred_cmd, pred_temp, structure_eval, command_eval)
+             in enumerate(rows)])
+        self.conn.execute('INSERT INTO files VALUES (?, ?, ?)',
+                          (file_name, stat.st_mtime, stat.st_size))
+
+    def remove_file(self, file_name):
+        self.conn.execute('DELETE FROM judgements WHERE file = ?', (file_name,))
+        self.conn.execute('DELETE FROM files WHERE name = ?', (file_name,))
+
+    def add_judgement(self, nl, command, correct_template='', correct_command='',
+                      file_name=ADDITIONAL_JUDGEMENT_FILE):
+        """
+        Append a new judgement to a judgement file and to the index.
+        """
+        path = os.path.join(self.judgement_dir, file_name)
+        temp = data_tools.cmd2template(command, loose_constraints=True)
+        if not correct_template:
+            correct_template = 'n'
+        if not correct_command:
+            correct_command = 'n'
+        with self.lock:
+            # bring the index up to date before appending, so that only the
+            # new row needs to be indexed
+            if not os.path.exists(path):
+                with open(path, 'w') as o_f:
+                    o_f.write(CSV_HEADER)
+            self.sync_file(file_name)
+            with open(path, 'a') as o_f:
+                o_f.write('"{}","{}","{}","{}","{}"\n'.format(
+                    nl.replace('"', '""'), command.replace('"', '""'),
+                    temp.replace('"', '""'), correct_template.replace('"', '""'),
+                    correct_command.replace('"', '""')))
+            num_rows = self.conn.execute(
+                'SELECT COUNT(*) FROM judgements WHERE file = ?',
+                (file_name,)).fetchone()[0]
+            self.conn.execute(
+                'INSERT INTO judgements VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (file_name, num_rows, get_example_nl_key(nl),
+                 get_example_cm_key(command), temp, correct_template,
+                 correct_command))
+            stat = os.stat(path)
+            self.conn.execute('UPDATE files SET mtime = ?, size = ? WHERE name = ?',
+                              (stat.st_mtime, stat.st_size, file_name))
+            self.conn.commit()
+        print('new judgement added to {}'.format(path))
+
+    def get_command_eval(self, nl_key, pred_cmd):
+        """
+        :return: the last judgement of the correctness of pred_cmd as a
+            translation of nl_key, or None if it has not been judged.
+        """
+        return self.get_last('command_eval', 'cm_key', nl_key,
+                             get_example_cm_key(pred_cmd))
+
+    def get_structure_eval(self, nl_key, pred_temp):
+        """
+        :return: the last judgement of the correctness of pred_temp as a
+            template of the translation of nl_key, or None if it has not been
+            judged.
+        """
+        return self.get_last('structure_eval', 'template', nl_key, pred_temp)
+
+    def get_last(self, column, key_column, nl_key, key):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT {0} FROM judgements WHERE nl_key = ? AND {1} = ? '
+                'AND {0} != \'\' ORDER BY file DESC, row DESC LIMIT 1'
+                .format(column, key_column), (nl_key, key)).fetchone()
+        return row[0] if row else None
+
+    def get_correct_translations(self, column, nl_key,
+                                 treat_empty_as_correct=False):
+        """
+        :return: the set of predictions (cm_key) or templates (template)
+            judged correct translations of nl_key.
+        """
+        eval_column = 'command_eval' if column == 'cm_key' else 'structure_eval'
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT DISTINCT {} FROM judgements WHERE nl_key = ? AND {} IN {}'
+                .format(column, eval_column, correct_values(treat_empty_as_correct)),
+                (nl_key,)).fetchall()
+        return set(row[0] for row in rows)
+
+    def count(self, column, treat_empty_as_correct=None):
+        """
+        Count the distinct judged (nl_key, column) pairs, or the nl_keys with
+        a correct translation if treat_empty_as_correct is not None.
+        """
+        eval_column = 'command_eval' if column == 'cm_key' else 'structure_eval'
+        with self.lock:
+            if treat_empty_as_correct is None:
+                query = 'SELECT COUNT(*) FROM (SELECT DISTINCT nl_key, {} ' \
+                        'FROM judgements WHERE {} != \'\')'.format(column, eval_column)
+            else:
+                query = 'SELECT COUNT(DISTINCT nl_key) FROM judgements ' \
+                        'WHERE {} IN {}'.format(
+                            eval_column, correct_values(treat_empty_as_correct))
+            return self.conn.execute(query).fetchone()[0]
+
+    def has_judgements(self):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT 1 FROM judgements LIMIT 1').fetchone() is not None
+
+    def file_judgements(self, file_name):
+        """
+        :return: the (nl key, prediction, template, structure judgement,
+            command judgement) rows of a file in file order.
+        """
+        with self.lock:
+            self.sync_file(file_name)
+            self.conn.commit()
+            return self.conn.execute(
+                'SELECT nl_key, cm_key, template, structure_eval, command_eval '
+                'FROM judgements WHERE file = ? ORDER BY row',
+                (file_name,)).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def correct_values(treat_empty_as_correct):
+    return "('', 'y', 'Y')" if treat_empty_as_correct else "('y')"
+
+
+class JudgementDict(object):
+    """
+    Dictionary view of a judgement store mapping
+    '<nl key><NL_PREDICTION><prediction or template>' keys to the last
+    judgement of the prediction or template.
+
+    Values assigned to the view are kept in memory only; use
+    JudgementStore.add_judgement to record a judgement.
+    """
+    def __init__(self, store, structure):
+        self.store = store
+        self.structure = structure
+        self.overrides = {}
+
+    def get(self, key, default=None):
+        if key in self.overrides:
+            return self.overrides[key]
+        nl_key, _, pred = key.partition(KEY_SEPARATOR)
+        if self.structure:
+            value = self.store.get_structure_eval(nl_key, pred)
+        else:
+            value = self.store.get_command_eval(nl_key, pred)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.overrides[key] = value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self.store.count('template' if self.structure else 'cm_key') + \
+            len(self.overrides)
+
+    def __bool__(self):
+        return bool(self.overrides) or self.store.has_judgements()
+
+    __nonzero__ = __bool__
+
+
+class TranslationDict(object):
+    """
+    Dictionary view of a judgement store mapping natural language keys to the
+    set of commands or templates judged correct translations.
+    """
+    def __init__(self, store, structure, treat_empty_as_correct=False):
+        self.store = store
+        self.column = 'template' if structure else 'cm_key'
+        self.treat_empty_as_correct = treat_empty_as_correct
+
+    def __getitem__(self, nl_key):
+        return self.store.get_correct_translations(
+            self.column, nl_key, self.treat_empty_as_correct)
+
+    def __contains__(self, nl_key):
+        return len(self[nl_key]) > 0
+
+    def __len__(self):
+        return self.store.count(self.column, self.treat_empty_as_correct)
+
+
+stores = {}
+stores_lock = threading.Lock()
+
+
+def get_judgement_store(judgement_dir):
+    """
+    Get the store of a judgement directory, shared by all callers in the
+    process and brought up to date with the files of the directory.
+    """
+    judgement_dir = os.path.abspath(judgement_dir)
+    with stores_lock:
+        if judgement_dir not in stores:
+            stores[judgement_dir] = JudgementStore(judgement_dir)
+            return stores[judgement_dir]
+        store = stores[judgement_dir]
+    store.sync()
+    return store
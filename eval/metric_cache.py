@@ -0,0 +1,232 @@
+"""
+Persistent store of the automatic metrics of individual predictions.
+
+The metrics of a prediction only depend on the set of ground truth commands of
+its example and on the prediction string, so they are recorded per
+(ground truth set, prediction) pair and reused by every later evaluation of
+the same pair: re-evaluating a model after a small decoding change only
+computes the metrics of the predictions that changed.
+
+Each record is a dictionary of metric values (see get_automatic_evaluation_metrics
+in eval_tools and the error analysis functions); callers add the metrics they
+compute to the record of a pair. Manual judgements are not part of the
+records, they are applied on top of the automatic metrics by the callers.
+
+METRIC_VERSION and the grammar file hash are part of every key, hence records
+are recomputed when a metric definition or the grammar changes; stale rows are
+dropped when the on-disk store is opened.
+
+Records are kept in a bounded in-memory LRU and in an SQLite store on disk,
+shared by all processes and later runs. The evaluation and error analysis
+entry points open the store with enable_disk_cache_from_flags(): its path is
+given by the --metric_cache flag and defaults to
+<model_root_dir>/metric_cache.sqlite; "--metric_cache none" keeps the records
+in memory only. The environment variable NL2BASH_METRIC_CACHE overrides the
+flag. enable_disk_cache() opens a store at an arbitrary path.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import atexit
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from bashlint import grammar
+
+# Increase when the definition of a cached metric changes.
+METRIC_VERSION = 1
+
+DEFAULT_MEMORY_SIZE = 100000
+
+# file name of the on-disk store in the model root directory
+DEFAULT_FILE_NAME = 'metric_cache.sqlite'
+
+
+def gold_key(command_gts):
+    """
+    The ground truth set of an example, independent of the order and the
+    repetitions of the ground truth commands.
+    """
+    return '\n'.join(sorted(set(command_gts)))
+
+
+class DiskStore(object):
+    """
+    SQLite table mapping (ground truth set, prediction) keys to metric records.
+    """
+    commit_every = 1024
+
+    def __init__(self, path, version):
+        self.path = path
+        self.num_pending = 0
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS metrics ('
+                          'key TEXT PRIMARY KEY, version TEXT, record TEXT)')
+        # drop records computed with other metric definitions or grammars
+        self.conn.execute('DELETE FROM metrics WHERE version != ?', (version,))
+        self.conn.commit()
+        self.version = version
+
+    def get(self, key):
+        row = self.conn.execute(
+            'SELECT record FROM metrics WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, record):
+        self.conn.execute('INSERT OR REPLACE INTO metrics VALUES (?, ?, ?)',
+                          (key, self.version, json.dumps(record)))
+        self.num_pending += 1
+        if self.num_pending >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        if self.num_pending == 0:
+            return
+        self.conn.commit()
+        self.num_pending = 0
+
+    def clear(self):
+        self.conn.execute('DELETE FROM metrics')
+        self.conn.commit()
+        self.num_pending = 0
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+class MetricStore(object):
+    """
+    Two-level (memory, disk) store of per-prediction metric records. The
+    memory level is an LRU of at most max_size records.
+
+    :member hits: Number of lookups answered from memory.
+    :member disk_hits: Number of lookups answered from the on-disk store.
+    :member misses: Number of lookups of pairs without a record.
+    """
+    def __init__(self, grammar_file=grammar.GRAMMAR_FILE,
+                 max_size=DEFAULT_MEMORY_SIZE):
+        self.version = '{}-{}'.format(
+            METRIC_VERSION, grammar.file_hash(grammar_file))
+        self.max_size = max_size
+        self.memory = collections.OrderedDict()
+        self.disk = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def make_key(self, command_gts, pred_cmd):
+        content = '\t'.join([self.version, gold_key(command_gts), pred_cmd])
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def enable_disk(self, path):
+        with self.lock:
+            if self.disk is not None:
+                if self.disk.path == path:
+                    return
+                self.disk.close()
+            self.disk = DiskStore(path, self.version)
+
+    def get(self, command_gts, pred_cmd):
+        """
+        :return: the metric record of pred_cmd (an empty dictionary if none of
+            its metrics have been computed). The record must not be modified,
+            use update to add metrics.
+        """
+        key = self.make_key(command_gts, pred_cmd)
+        with self.lock:
+            record = self.memory.pop(key, None)
+            if record is not None:
+                self.memory[key] = record
+                self.hits += 1
+                return record
+            if self.disk is not None:
+                record = self.disk.get(key)
+                if record is not None:
+                    self.add_to_memory(key, record)
+                    self.disk_hits += 1
+                    return record
+            self.misses += 1
+        return {}
+
+    def update(self, command_gts, pred_cmd, metrics):
+        """
+        Add metrics (metric name -> JSON-serializable value) to the record of
+        pred_cmd.
+        """
+        key = self.make_key(command_gts, pred_cmd)
+        with self.lock:
+            record = dict(self.memory.pop(key, None) or
+                          (self.disk is not None and self.disk.get(key)) or {})
+            record.update(metrics)
+            self.add_to_memory(key, record)
+            if self.disk is not None:
+                self.disk.put(key, record)
+
+    def add_to_memory(self, key, record):
+        self.memory[key] = record
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all records from memory and disk.
+        """
+        with self.lock:
+            self.memory.clear()
+            if self.disk is not None:
+                self.disk.clear()
+
+    def flush(self):
+        with self.lock:
+            if self.disk is not None:
+                self.disk.flush()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'size': len(self.memory)
+        }
+
+
+metric_store = MetricStore()
+if os.environ.get('NL2BASH_METRIC_CACHE'):
+    metric_store.enable_disk(os.environ['NL2BASH_METRIC_CACHE'])
+atexit.register(metric_store.flush)
+
+
+def enable_disk_cache(path):
+    metric_store.enable_disk(path)
+
+
+def enable_disk_cache_from_flags(FLAGS):
+    """
+    Open the on-disk store selected by the --metric_cache flag, unless
+    NL2BASH_METRIC_CACHE is set.
+
+    :param FLAGS: experiment hyperparameters; --metric_cache defaults to
+        <model_root_dir>/metric_cache.sqlite, "none" disables the on-disk store.
+    """
+    if os.environ.get('NL2BASH_METRIC_CACHE'):
+        return
+    path = getattr(FLAGS, 'metric_cache', '')
+    if path == 'none':
+        return
+    if not path:
+        if not os.path.isdir(FLAGS.model_root_dir):
+            os.makedirs(FLAGS.model_root_dir)
+        path = os.path.join(FLAGS.model_root_dir, DEFAULT_FILE_NAME)
+    metric_store.enable_disk(path)
+
+
+def has_metrics(record, metric_names):
+    return all(name in record for name in metric_names)
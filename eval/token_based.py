@@ -8,6 +8,7 @@ from __future__ import print_function
 
 import collections
 import numpy as np
+import scipy.sparse as ssp
 
 from bashlint import data_tools, nast
 
@@ -49,6 +50,101 @@ def CMS(ast1, ast2):
 def command_match_score(gts, ast):
     max_cms = 0.0
     for gt in gts:
-        if CMS(ast, gt) > max_cms:
-            max_cms = CMS(ast, gt)
+        cms = CMS(ast, gt)
+        if cms > max_cms:
+            max_cms = cms
+    return max_cms
+
+
+class ContentTokenCache(object):
+    """
+    Content token histograms of ASTs, mapped into a shared vocabulary.
+
+    An AST is identified by the object: the cache holds a reference to every
+    AST it has seen, so that their ids are not reused, and the ASTs must not
+    be modified afterwards.
+    """
+    def __init__(self):
+        self.vocab = {}
+        self.histograms = {}
+
+    def get(self, ast):
+        """
+        :return (token ids, counts) of the content tokens of ast.
+        """
+        key = id(ast)
+        if not key in self.histograms:
+            token_dict = get_content_tokens(ast) if ast else {}
+            ids = [self.vocab.setdefault(t, len(self.vocab))
+                   for t in token_dict]
+            self.histograms[key] = \
+                (ast, ids, [token_dict[t] for t in token_dict])
+        _, ids, counts = self.histograms[key]
+        return ids, counts
+
+    def count_matrix(self, asts):
+        """
+        :return CSR matrix of the token counts, one row per AST.
+        """
+        indptr = [0]
+        indices = []
+        data = []
+        for ast in asts:
+            ids, counts = self.get(ast)
+            indices.extend(ids)
+            data.extend(counts)
+            indptr.append(len(indices))
+        return ssp.csr_matrix((np.array(data, dtype=np.float64),
+                               np.array(indices, dtype=np.int64),
+                               np.array(indptr, dtype=np.int64)),
+                              shape=(len(asts), len(self.vocab)))
+
+
+def batch_CMS(asts1, asts2, cache=None):
+    """
+    CMS of each pair (asts1[i], asts2[i]), computed for all pairs at once
+        from sparse token count matrices.
+    """
+    if cache is None:
+        cache = ContentTokenCache()
+    if not asts1:
+        return np.zeros(0)
+    # extend the vocabulary before building the matrices of the same width
+    for ast in asts1 + asts2:
+        cache.get(ast)
+    counts1 = cache.count_matrix(asts1)
+    counts2 = cache.count_matrix(asts2)
+    num_overlap = np.asarray(counts1.multiply(counts2).sum(axis=1)).ravel()
+    norm1 = np.asarray(counts1.multiply(counts1).sum(axis=1)).ravel()
+    norm2 = np.asarray(counts2.multiply(counts2).sum(axis=1)).ravel()
+    valid = (norm1 != 0) & (norm2 != 0)
+    scores = np.zeros(len(asts1))
+    scores[valid] = num_overlap[valid] / np.sqrt(norm1[valid]) \
+                    / np.sqrt(norm2[valid])
+    return scores
+
+
+def batch_command_match_score(gts_list, asts, cache=None):
+    """
+    command_match_score of every prediction of a prediction set.
+
+    :param gts_list: gts_list[i] is the list of ground truth ASTs of asts[i].
+    :param asts: predicted ASTs.
+    :param cache: ContentTokenCache shared across calls, e.g. to compute the
+        histograms of the ground truths once for all top-k predictions.
+    """
+    # expand to one row per (prediction, ground truth) pair; only these
+    # pairs are scored, rather than all predictions against all ground truths
+    pairs1, pairs2 = [], []
+    for gts, ast in zip(gts_list, asts):
+        pairs1.extend([ast] * len(gts))
+        pairs2.extend(gts)
+    scores = batch_CMS(pairs1, pairs2, cache)
+    sizes = np.array([len(gts) for gts in gts_list], dtype=np.int64)
+    starts = np.cumsum(sizes) - sizes
+    max_cms = np.zeros(len(asts))
+    nonempty = sizes > 0
+    if nonempty.any():
+        max_cms[nonempty] = np.maximum(
+            0.0, np.maximum.reduceat(scores, starts[nonempty]))
     return max_cms
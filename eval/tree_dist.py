@@ -2,22 +2,22 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from bashlint import data_tools, nast
+from bashlint import data_tools
 from eval import zss
 
+score_list = {
+    "FLAG_-ls:::":0,
+    ":::FLAG_-ls":0,
+    "FLAG_-print:::":0,
+    ":::FLAG_-print":0,
+    "FLAG_-print0:::":0,
+    ":::FLAG_-print0":0,
+    "FLAG_-name:::FLAG_-regex":0,
+    "FLAG_-regex:::FLAG_-name":0
+}
 
-def local_dist(s1, s2, skip_argument=False):
-    score_list = {
-        "FLAG_-ls:::":0,
-        ":::FLAG_-ls":0,
-        "FLAG_-print:::":0,
-        ":::FLAG_-print":0,
-        "FLAG_-print0:::":0,
-        ":::FLAG_-print0":0,
-        "FLAG_-name:::FLAG_-regex":0,
-        "FLAG_-regex:::FLAG_-name":0
-    }
 
+def local_dist(s1, s2, skip_argument=False):
     if s1 == s2:
         return 0
     if s1.startswith("ARGUMENT_") and s2.startswith("ARGUMENT_") \
@@ -39,14 +39,116 @@ def str_local_dist(s1, s2):
 def temp_local_dist(s1, s2):
     return local_dist(s1, s2, skip_argument=True)
 
+# called through the node so that any tree backend (nast.Node,
+# flat_nast.FlatNode) can be compared
+def get_children(node):
+    return node.get_children()
+
+def get_label(node):
+    return node.get_label()
+
 def str_dist(ast1, ast2):
-    return zss.simple_distance(ast1, ast2, nast.Node.get_children,
-                               nast.Node.get_label, str_local_dist)
+    return zss.fast_simple_distance(ast1, ast2, get_children, get_label,
+                                    str_local_dist)
 
 def temp_dist(ast1, ast2):
-    return zss.simple_distance(ast1, ast2, nast.Node.get_children,
-                               nast.Node.get_label, temp_local_dist)
+    return zss.fast_simple_distance(ast1, ast2, get_children, get_label,
+                                    temp_local_dist)
+
+
+def dist_matrix(asts, asts2, ignore_arg_value=False, stop_at_zero=False):
+    """
+    Compute the tree edit distances between a set of ground truth ASTs and a
+        set of predicted ASTs, annotating each AST once.
+    :param asts: set of gold ASTs.
+    :param asts2: predicted ASTs.
+    :param ignore_arg_value: set to true if ignore literal values in the ASTs.
+    :param stop_at_zero: set to true if the remaining gold ASTs need not be
+        compared with a prediction once one of them is at distance 0.
+    :return: matrix[i][j] is the distance between asts[i] and asts2[j] (None
+        if skipped).
+    """
+    label_dist = temp_local_dist if ignore_arg_value else str_local_dist
+    return zss.distance_matrix(asts, asts2, get_children, get_label,
+                               label_dist, stop_at_zero=stop_at_zero)
 
+def bounded_dist(ast1, ast2, max_dist, ignore_arg_value=False):
+    """
+    Compute the tree edit distance between two ASTs if it is at most max_dist,
+        otherwise return a value greater than max_dist.
+    """
+    if ignore_arg_value:
+        return zss.bounded_distance(ast1, ast2, max_dist, get_children,
+                                    get_label, temp_local_dist,
+                                    temp_min_label_cost, utility_lower_bound)
+    return zss.bounded_distance(ast1, ast2, max_dist, get_children, get_label,
+                                str_local_dist, str_min_label_cost,
+                                utility_lower_bound)
+
+def utility_lower_bound(A, B):
+    """
+    Lower bound of the distance between two zss.LabeledTree of ASTs: a
+        utility costs nothing only if it is mapped to the same utility, and
+        the mapped nodes keep their post-order, hence at most as many
+        utilities as the longest common subsequence of the utility sequences
+        are free.
+    """
+    A_utilities = [l for l in A.labels if l.startswith('UTILITY_')]
+    B_utilities = [l for l in B.labels if l.startswith('UTILITY_')]
+    if not A_utilities or not B_utilities:
+        return max(len(A_utilities), len(B_utilities))
+    lcs = [0] * (len(B_utilities) + 1)
+    for a in A_utilities:
+        prev_diag = 0
+        for j, b in enumerate(B_utilities):
+            prev_diag, lcs[j+1] = lcs[j+1], prev_diag + 1 if a == b \
+                else max(lcs[j+1], lcs[j])
+    return max(len(A_utilities), len(B_utilities)) - lcs[-1]
+
+# labels which can be removed, inserted or changed at no cost
+zero_cost_labels = set(label for key, score in score_list.items()
+                       for label in key.split(":::") if label and score == 0)
+
+def str_min_label_cost(label):
+    return 0 if label in zero_cost_labels else 1
+
+def temp_min_label_cost(label):
+    if label.startswith("ARGUMENT_"):
+        return 0
+    return str_min_label_cost(label)
+
+def temp_canonical_label(label):
+    # all arguments are at distance 0 of each other when ignoring their values
+    return "ARGUMENT_" if label.startswith("ARGUMENT_") else label
+
+def min_dists(asts, asts2, rewrite=False, ignore_arg_value=False,
+              max_dist=None):
+    """
+    Compute the minimum tree edit distance of each prediction to the set of
+        ground truth ASTs; ground truths which cannot be closer than the best
+        match found are skipped.
+    :param asts: set of gold ASTs.
+    :param asts2: predicted ASTs.
+    :param rewrite: set to true if rewrite ground truths with templates.
+    :param ignore_arg_value: set to true if ignore literal values in the ASTs.
+    :param max_dist: if set, distances greater than max_dist are not computed
+        exactly, only reported as some value greater than max_dist.
+    """
+    if rewrite:
+        raise NotImplementedError
+    # tolerate ungrammatical predictions
+    asts2 = [ast2 if ast2 else data_tools.bash_parser("find")
+             for ast2 in asts2]
+    if not asts:
+        return [1e8 for _ in asts2]
+    if ignore_arg_value:
+        return zss.min_distances(asts, asts2, get_children, get_label,
+                                 temp_local_dist, temp_min_label_cost,
+                                 utility_lower_bound, temp_canonical_label,
+                                 max_dist)
+    return zss.min_distances(asts, asts2, get_children, get_label,
+                             str_local_dist, str_min_label_cost,
+                             utility_lower_bound, max_dist=max_dist)
 
 def min_dist(asts, ast2, rewrite=False, ignore_arg_value=False):
     """
@@ -57,39 +159,26 @@ def min_dist(asts, ast2, rewrite=False, ignore_arg_value=False):
     :param rewrite: set to true if rewrite ground truths with templates.
     :param ignore_arg_value: set to true if ignore literal values in the ASTs.
     """
-    # tolerate ungrammatical predictions
-    if not ast2:
-        ast2 = data_tools.bash_parser("find")
+    return min_dists(asts, [ast2], rewrite, ignore_arg_value)[0]
 
+def one_matches(asts, asts2, rewrite=False, ignore_arg_value=False):
+    """
+    Check for each prediction if it matches one of the ground truth ASTs; the
+        templates of the ground truths are computed once.
+    """
     if rewrite:
         raise NotImplementedError
     else:
         ast_rewrites = asts
-
-    min_dist = 1e8
-    for ast1 in ast_rewrites:
-        if ignore_arg_value:
-            dist = temp_dist(ast1, ast2)
-        else:
-            dist = str_dist(ast1, ast2)
-        if dist < min_dist:
-            min_dist = dist
-
-    return min_dist
+    cmds = set(data_tools.ast2template(ast1, loose_constraints=True,
+                                       arg_type_only=ignore_arg_value)
+               for ast1 in ast_rewrites)
+    return [data_tools.ast2template(ast2, loose_constraints=True,
+                                    arg_type_only=ignore_arg_value) in cmds
+            for ast2 in asts2]
 
 def one_match(asts, ast2, rewrite=False, ignore_arg_value=False):
-    if rewrite:
-        raise NotImplementedError
-    else:
-        ast_rewrites = asts
-    cmd2 = data_tools.ast2template(ast2, loose_constraints=True,
-                                   arg_type_only=ignore_arg_value)
-    for ast1 in ast_rewrites:
-        cmd1 = data_tools.ast2template(ast1, loose_constraints=True,
-                                       arg_type_only=ignore_arg_value)
-        if cmd1 == cmd2:
-            return True
-    return False
+    return one_matches(asts, [ast2], rewrite, ignore_arg_value)[0]
 
 def template_match(ast1, ast2):
     temp1 = data_tools.ast2template(ast1, loose_constraints=True)
@@ -4,8 +4,17 @@ from .compare import (
     distance,
     simple_distance,
 )
+from .fast import (
+    bounded_distance,
+    distance_matrix,
+    fast_distance,
+    fast_simple_distance,
+    min_distances,
+)
 from .simple_tree import Node
 
-__all__ = ['distance', 'simple_distance', 'Node']
+__all__ = ['distance', 'simple_distance', 'bounded_distance',
+           'distance_matrix', 'fast_distance', 'fast_simple_distance',
+           'min_distances', 'Node']
 __version__ = '1.1.4'
 
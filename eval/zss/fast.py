@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#For licensing see the LICENSE file in the top level directory.
+
+"""
+Zhang-Shasha tree edit distance on precomputed costs.
+
+Computes the same distances as :py:func:`zss.distance` and
+:py:func:`zss.simple_distance`, but every cost is evaluated once per tree pair
+instead of once per table cell: the remove and insert costs become arrays and
+the update costs a matrix indexed by the post-order positions of the nodes.
+With :py:func:`fast_simple_distance` and :py:func:`distance_matrix`,
+``label_dist`` is called once per pair of distinct labels, and the latter
+annotates each tree once however many trees it is compared with.
+
+The forest-distance tables of large tree pairs are filled with NumPy row
+operations; the insertion recurrence along a row
+(``fd[x][y] = min(c[y], fd[x][y-1] + insert(y))``) is resolved with a running
+minimum over the cumulative insertion costs. Below NUMPY_MIN_CELLS the
+overhead of the array operations exceeds their gain and the tables are filled
+with plain loops.
+
+:py:func:`min_distances` and :py:func:`bounded_distance` skip the pairs which
+cannot matter: trees with the same canonical form are at distance 0 without
+any table, and pairs whose lower bound (size, label multisets, or a bound
+given by the caller) exceeds the threshold or the best distance found are not
+compared.
+
+Results are identical to :py:func:`zss.distance` for integer costs; for
+floating point costs they may differ by rounding errors.
+"""
+
+from __future__ import absolute_import
+from six.moves import range
+
+import collections
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from eval.zss.compare import AnnotatedTree, strdist
+from eval.zss.simple_tree import Node
+
+# minimum number of node pairs for which the NumPy tables are used
+NUMPY_MIN_CELLS = 4096
+
+
+def fast_simple_distance(A, B, get_children=Node.get_children,
+        get_label=Node.get_label, label_dist=strdist):
+    """Computes the exact tree edit distance between trees A and B, with the
+    arguments of :py:func:`zss.simple_distance`.
+    """
+    return distance_matrix([A], [B], get_children, get_label, label_dist)[0][0]
+
+
+def distance_matrix(As, Bs, get_children=Node.get_children,
+        get_label=Node.get_label, label_dist=strdist, stop_at_zero=False):
+    """Computes the tree edit distances between every tree of As and every
+    tree of Bs, with the arguments of :py:func:`zss.simple_distance`.
+
+    Every tree is annotated once, and label_dist is called once per pair of
+    distinct labels in the whole batch.
+
+    :param stop_at_zero: If set, the trees of As which follow the first tree
+        at distance 0 of a tree of Bs are not compared with it. Used to find
+        the minimum distance of each tree of Bs.
+
+    :return: ``matrix[i][j]`` is the distance between As[i] and Bs[j], or None
+        if it was skipped.
+    """
+    As = [LabeledTree(A, get_children, get_label) for A in As]
+    Bs = [LabeledTree(B, get_children, get_label) for B in Bs]
+    costs = LabelCosts(label_dist)
+    matrix = [[None] * len(Bs) for _ in As]
+    for j, B in enumerate(Bs):
+        for i, A in enumerate(As):
+            matrix[i][j] = costs.distance(A, B)
+            if stop_at_zero and matrix[i][j] == 0:
+                break
+    return matrix
+
+
+def min_distances(As, Bs, get_children=Node.get_children,
+        get_label=Node.get_label, label_dist=strdist, min_label_cost=None,
+        lower_bound=None, canonical_label=None, max_dist=None):
+    """Computes the minimum tree edit distance of each tree of Bs to the trees
+    of As, with the arguments of :py:func:`zss.simple_distance`.
+
+    Most pairs are never compared: a tree of Bs with the same canonical form
+    (see :py:meth:`LabeledTree.canonical_key`) as a tree of As is at distance
+    0, and the trees of As are otherwise compared in increasing order of
+    their lower bound (see :py:func:`size_lower_bound` and
+    :py:func:`label_lower_bound`), stopping at the first one whose bound is
+    not below the smallest distance found.
+
+    :param min_label_cost: Optional function of a label which returns a lower
+        bound of the cost to remove or insert a node with that label or to
+        change it into a different label; enables the label bound.
+    :param lower_bound: Optional function ``lower_bound(A, B)`` of two
+        :py:class:`LabeledTree` which returns a lower bound of their distance
+        under label_dist.
+    :param canonical_label: Optional function mapping labels to canonical
+        labels; labels with the same canonical label must be at distance 0.
+    :param max_dist: If set, only distances up to max_dist are computed
+        exactly; trees of As whose lower bound exceeds it are not compared.
+
+    :return: list of the minimum distances (values greater than max_dist
+        stand for any distance greater than max_dist), None for every tree if
+        As is empty.
+    """
+    As = [LabeledTree(A, get_children, get_label) for A in As]
+    Bs = [LabeledTree(B, get_children, get_label) for B in Bs]
+    costs = LabelCosts(label_dist, min_label_cost, lower_bound)
+    A_keys = set(A.canonical_key(canonical_label) for A in As)
+    dists = []
+    for B in Bs:
+        if B.canonical_key(canonical_label) in A_keys and \
+                costs.is_identity_free(B):
+            dists.append(0)
+            continue
+        min_dist = None
+        bounds = [(costs.lower_bound(A, B), i) for i, A in enumerate(As)]
+        for bound, i in sorted(bounds, key=lambda x: x[0]):
+            if min_dist is not None and bound >= min_dist:
+                break
+            if max_dist is not None and bound > max_dist:
+                if min_dist is None:
+                    min_dist = bound
+                break
+            dist = costs.distance(As[i], B)
+            if min_dist is None or dist < min_dist:
+                min_dist = dist
+                if min_dist == 0:
+                    break
+        dists.append(min_dist)
+    return dists
+
+
+def bounded_distance(A, B, max_dist, get_children=Node.get_children,
+        get_label=Node.get_label, label_dist=strdist, min_label_cost=None,
+        lower_bound=None):
+    """Computes the tree edit distance between trees A and B if it is at most
+    max_dist, with the arguments of :py:func:`zss.min_distances`.
+
+    :return: the distance if it is at most max_dist, otherwise a value
+        greater than max_dist (a lower bound of the distance).
+    """
+    A = LabeledTree(A, get_children, get_label)
+    B = LabeledTree(B, get_children, get_label)
+    costs = LabelCosts(label_dist, min_label_cost, lower_bound)
+    bound = costs.lower_bound(A, B)
+    if bound > max_dist:
+        return bound
+    return costs.distance(A, B)
+
+
+def size_lower_bound(A_costs, B_costs):
+    """Lower bound of the distance between two trees from their sizes: the
+    nodes in excess in the larger tree are removed (or inserted).
+
+    :param A_costs: sorted costs to remove the nodes of A.
+    :param B_costs: sorted costs to insert the nodes of B.
+    """
+    if len(A_costs) > len(B_costs):
+        return sum(A_costs[:len(A_costs) - len(B_costs)])
+    return sum(B_costs[:len(B_costs) - len(A_costs)])
+
+
+def label_lower_bound(A, B, min_label_cost):
+    """Lower bound of the distance between two :py:class:`LabeledTree`
+    from their label multisets.
+
+    Only as many nodes of A with a label as B holds can be mapped to nodes
+    with the same label; every other node of A is removed or changed, at a
+    cost of at least min_label_cost(label). The same holds with A and B
+    swapped.
+    """
+    def side_bound(A_counts, B_counts):
+        bound = 0
+        for label, count in A_counts.items():
+            excess = count - B_counts.get(label, 0)
+            if excess > 0:
+                bound += excess * min_label_cost(label)
+        return bound
+
+    A_counts, B_counts = A.label_counts(), B.label_counts()
+    return max(side_bound(A_counts, B_counts), side_bound(B_counts, A_counts))
+
+
+def fast_distance(A, B, get_children, insert_cost, remove_cost, update_cost):
+    """Computes the exact tree edit distance between trees A and B, with the
+    arguments of :py:func:`zss.distance`.
+
+    update_cost is called once per pair of nodes.
+    """
+    A, B = AnnotatedTree(A, get_children), AnnotatedTree(B, get_children)
+    return annotated_distance(
+        A, B,
+        [remove_cost(a) for a in A.nodes],
+        [insert_cost(b) for b in B.nodes],
+        [[update_cost(a, b) for b in B.nodes] for a in A.nodes])
+
+
+def annotated_distance(A, B, remove_costs, insert_costs, update_costs):
+    """Computes the tree edit distance between two annotated trees.
+
+    :param A: :py:class:`AnnotatedTree` of the first tree.
+    :param B: :py:class:`AnnotatedTree` of the second tree.
+    :param remove_costs: the cost to remove each node of A, in post-order.
+    :param insert_costs: the cost to insert each node of B, in post-order.
+    :param update_costs: ``update_costs[a][b]`` is the cost to change the
+        a-th node of A into the b-th node of B.
+    """
+    if np is not None and len(A.nodes) * len(B.nodes) >= NUMPY_MIN_CELLS:
+        return _numpy_distance(A, B, remove_costs, insert_costs, update_costs)
+    return _python_distance(A, B, remove_costs, insert_costs, update_costs)
+
+
+class LabeledTree(AnnotatedTree):
+    """
+    :py:class:`AnnotatedTree` which also holds the labels of the nodes, in
+    post-order, so that a tree compared with many others is annotated once.
+    """
+    def __init__(self, root, get_children, get_label):
+        super(LabeledTree, self).__init__(root, get_children)
+        self.labels = [get_label(n) for n in self.nodes]
+        self._label_counts = None
+
+    def label_counts(self):
+        if self._label_counts is None:
+            self._label_counts = collections.Counter(self.labels)
+        return self._label_counts
+
+    def canonical_key(self, canonical_label=None):
+        """
+        Hashable form of the tree: equal keys mean equal trees (up to
+        canonical_label). A post-order sequence of labels and subtree sizes
+        determines the tree.
+        """
+        labels = self.labels if canonical_label is None else \
+            [canonical_label(label) for label in self.labels]
+        return tuple(zip(labels, [i - lmd for i, lmd in enumerate(self.lmds)]))
+
+
+class LabelCosts(object):
+    """
+    Cache of label_dist over the label pairs of a batch of trees, and of the
+    per-tree data of the lower bounds.
+    """
+    def __init__(self, label_dist, min_label_cost=None, lower_bound=None):
+        self.label_dist = label_dist
+        self.min_label_cost = min_label_cost
+        self.extra_lower_bound = lower_bound
+        self.costs = {}
+        self.sorted_costs = {}
+
+    def cost(self, a, b):
+        key = (a, b)
+        if not key in self.costs:
+            self.costs[key] = self.label_dist(a, b)
+        return self.costs[key]
+
+    def distance(self, A, B):
+        cost = self.cost
+        # the update costs of a label of A to the nodes of B, shared by all
+        # rows with that label
+        update_rows = {}
+        update_costs = []
+        for a in A.labels:
+            if not a in update_rows:
+                update_rows[a] = [cost(a, b) for b in B.labels]
+            update_costs.append(update_rows[a])
+        return annotated_distance(
+            A, B,
+            [cost(a, '') for a in A.labels],
+            [cost('', b) for b in B.labels],
+            update_costs)
+
+    def get_sorted_costs(self, A, remove):
+        key = (id(A), remove)
+        if not key in self.sorted_costs:
+            self.sorted_costs[key] = sorted(
+                self.cost(a, '') if remove else self.cost('', a)
+                for a in A.labels)
+        return self.sorted_costs[key]
+
+    def lower_bound(self, A, B):
+        bound = size_lower_bound(self.get_sorted_costs(A, True),
+                                 self.get_sorted_costs(B, False))
+        if self.min_label_cost is not None:
+            bound = max(bound, label_lower_bound(A, B, self.min_label_cost))
+        if self.extra_lower_bound is not None:
+            bound = max(bound, self.extra_lower_bound(A, B))
+        return bound
+
+    def is_identity_free(self, A):
+        """
+        Whether changing any label of A into itself costs nothing.
+        """
+        return all(self.cost(a, a) == 0 for a in A.label_counts())
+
+
+def _python_distance(A, B, remove_costs, insert_costs, update_costs):
+    Al, Bl = A.lmds, B.lmds
+    treedists = [[0] * len(B.nodes) for _ in A.nodes]
+    # per keyroot j of B: (y, node, insert cost, whether the node is on the
+    # leftmost path of j, column of its left forest) of each column y
+    B_columns = []
+    for j in B.keyroots:
+        joff = Bl[j] - 1
+        B_columns.append([(b - joff, b, insert_costs[b], Bl[b] == Bl[j],
+                           Bl[b] - 1 - joff) for b in range(Bl[j], j + 1)])
+    for i in A.keyroots:
+        ioff = Al[i] - 1
+        m = i - Al[i] + 2
+        for columns in B_columns:
+            n = len(columns) + 1
+            fd = [[0] * n for _ in range(m)]
+            for x in range(1, m):
+                fd[x][0] = fd[x-1][0] + remove_costs[x+ioff]
+            row = fd[0]
+            for y, _, insert_cost, _, _ in columns:
+                row[y] = row[y-1] + insert_cost
+            for x in range(1, m):
+                a = x + ioff
+                prev, row = fd[x-1], fd[x]
+                remove_cost = remove_costs[a]
+                a_is_tree = Al[a] == Al[i]
+                treedists_a = treedists[a]
+                update_costs_a = update_costs[a]
+                fd_p = fd[Al[a]-1-ioff]
+                for y, b, insert_cost, b_is_tree, q in columns:
+                    if a_is_tree and b_is_tree:
+                        row[y] = treedists_a[b] = min(
+                            prev[y] + remove_cost,
+                            row[y-1] + insert_cost,
+                            prev[y-1] + update_costs_a[b])
+                    else:
+                        row[y] = min(prev[y] + remove_cost,
+                                     row[y-1] + insert_cost,
+                                     fd_p[q] + treedists_a[b])
+    return treedists[-1][-1]
+
+
+def _numpy_distance(A, B, remove_costs, insert_costs, update_costs):
+    remove_costs = np.asarray(remove_costs)
+    insert_costs = np.asarray(insert_costs)
+    update_costs = np.asarray(update_costs)
+    dtype = np.result_type(remove_costs, insert_costs, update_costs)
+    Al = np.array(A.lmds)
+    Bl = np.array(B.lmds)
+    treedists = np.zeros((len(A.nodes), len(B.nodes)), dtype)
+
+    for j in B.keyroots:
+        # the columns of the forest-distance tables of keyroot j do not depend
+        # on i
+        joff = Bl[j] - 1
+        n = j - Bl[j] + 2
+        B_range = slice(joff + 1, joff + n)
+        B_is_tree = Bl[B_range] == Bl[j]
+        q = Bl[B_range] - 1 - joff
+        insert_sums = np.zeros(n, dtype)
+        np.cumsum(insert_costs[B_range], out=insert_sums[1:])
+
+        for i in A.keyroots:
+            ioff = Al[i] - 1
+            m = i - Al[i] + 2
+            fd = np.zeros((m, n), dtype)
+            fd[0] = insert_sums
+            for x in range(1, m):
+                a = x + ioff
+                prev = fd[x-1]
+                row = prev + remove_costs[a]
+                a_is_tree = Al[a] == Al[i]
+                if a_is_tree:
+                    diag = np.where(B_is_tree,
+                                    prev[:-1] + update_costs[a, B_range],
+                                    fd[0, q] + treedists[a, B_range])
+                else:
+                    diag = fd[Al[a]-1-ioff, q] + treedists[a, B_range]
+                np.minimum(row[1:], diag, out=row[1:])
+                fd[x] = insert_sums + np.minimum.accumulate(row - insert_sums)
+                if a_is_tree:
+                    treedists[a, B_range][B_is_tree] = fd[x, 1:][B_is_tree]
+
+    return treedists[-1][-1]
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#For licensing see the LICENSE file in the top level directory.
+
+"""
+Benchmark of zss.fast_simple_distance against zss.simple_distance.
+
+Usage: python bench_fast.py [num_pairs]
+    (run from the eval directory with PYTHONPATH including eval and the
+    repository root)
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from six.moves import range
+
+import random
+import sys
+import time
+
+from zss import (
+    distance_matrix,
+    fast,
+    fast_simple_distance,
+    min_distances,
+    simple_distance,
+)
+
+from zss.tests.test_fast import random_tree
+
+
+def bench(name, pairs):
+    start = time.time()
+    expected = [simple_distance(A, B) for A, B in pairs]
+    compare_time = time.time() - start
+    results = []
+    for num_cells, backend in [(sys.maxsize, 'loops'), (0, 'numpy')]:
+        fast.NUMPY_MIN_CELLS = num_cells
+        start = time.time()
+        dists = [fast_simple_distance(A, B) for A, B in pairs]
+        results.append((backend, time.time() - start))
+        assert dists == expected
+    print('{:<24}{:>10.3f}'.format(name, compare_time) + ''.join(
+        '{:>10.3f} ({:4.1f}x)'.format(t, compare_time / t)
+        for _, t in results))
+
+
+def main():
+    num_pairs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    num_cells = fast.NUMPY_MIN_CELLS
+    random.seed(0)
+    print('{:<24}{:>10}{:>17}{:>17}'.format(
+        'trees', 'compare', 'fast (loops)', 'fast (numpy)'))
+    for size in [10, 40]:
+        bench('random, {} nodes'.format(size),
+              [(random_tree(size), random_tree(size))
+               for _ in range(num_pairs // size * 10)])
+    for size in [40, 120]:
+        bench('deep, {} nodes'.format(size),
+              [(random_tree(size, window=3), random_tree(size, window=3))
+               for _ in range(max(1, num_pairs // size))])
+    fast.NUMPY_MIN_CELLS = num_cells
+
+    # top-10 evaluation: min distance of 10 predictions to 2 gold trees
+    groups = [([random_tree(10) for _ in range(2)],
+               [random_tree(10) for _ in range(10)])
+              for _ in range(num_pairs // 20)]
+    start = time.time()
+    expected = [[min(fast_simple_distance(A, B) for A in As) for B in Bs]
+                for As, Bs in groups]
+    pairs_time = time.time() - start
+    start = time.time()
+    dists = [[min(d for d in column if d is not None)
+              for column in zip(*distance_matrix(As, Bs, stop_at_zero=True))]
+             for As, Bs in groups]
+    matrix_time = time.time() - start
+    assert dists == expected
+    print('top-10 min distance: {:.3f}s per pair, {:.3f}s distance_matrix'
+          .format(pairs_time, matrix_time))
+
+    # match check: which of 100 predictions are within distance 1 of a gold
+    groups = [([random_tree(10) for _ in range(3)],
+               [random_tree(random.randint(5, 15)) for _ in range(100)])
+              for _ in range(max(1, num_pairs // 100))]
+    start = time.time()
+    for As, Bs in groups:
+        [min(d for d in column) for column in zip(*distance_matrix(As, Bs))]
+    matrix_time = time.time() - start
+    start = time.time()
+    for As, Bs in groups:
+        min_distances(As, Bs, min_label_cost=lambda label: 1, max_dist=1)
+    bounded_time = time.time() - start
+    print('match check: {:.3f}s distance_matrix, {:.3f}s min_distances'
+          .format(matrix_time, bounded_time))
+
+
+if __name__ == '__main__':
+    main()
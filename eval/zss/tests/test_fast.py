@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#For licensing see the LICENSE file in the top level directory.
+
+from __future__ import absolute_import
+from six.moves import range
+
+import random
+
+from zss import (
+    bounded_distance,
+    distance,
+    distance_matrix,
+    fast_distance,
+    fast_simple_distance,
+    min_distances,
+    simple_distance,
+    Node,
+)
+from zss import fast
+
+
+def random_tree(size, labels='abcde', window=None):
+    """
+    Build a tree by attaching each new node to a random earlier node, or to
+    one of the last window nodes (which gives deep trees).
+    """
+    nodes = [Node(random.choice(labels))]
+    for _ in range(size - 1):
+        parent = random.choice(nodes[-window:] if window else nodes)
+        child = Node(random.choice(labels))
+        parent.addkid(child)
+        nodes.append(child)
+    return nodes[0]
+
+
+def insert_cost(node):
+    return ord(node.label[0])
+
+def remove_cost(node):
+    return 2 * ord(node.label[0])
+
+def update_cost(a, b):
+    return 0 if a.label == b.label else 150
+
+
+def check_random_pairs(num_pairs, max_size):
+    random.seed(num_pairs)
+    for _ in range(num_pairs):
+        A = random_tree(random.randint(1, max_size),
+                        window=random.choice([None, 2]))
+        B = random_tree(random.randint(1, max_size))
+        assert fast_simple_distance(A, B) == simple_distance(A, B)
+        assert fast_distance(A, B, Node.get_children, insert_cost,
+                             remove_cost, update_cost) == \
+            distance(A, B, Node.get_children, insert_cost, remove_cost,
+                     update_cost)
+
+
+def test_paper_tree():
+    A = (
+      Node("f")
+        .addkid(Node("d")
+          .addkid(Node("a"))
+          .addkid(Node("c")
+            .addkid(Node("b"))
+          )
+        )
+        .addkid(Node("e"))
+    )
+    B = (
+      Node("f")
+        .addkid(Node("c")
+          .addkid(Node("d")
+            .addkid(Node("a"))
+            .addkid(Node("b"))
+          )
+        )
+        .addkid(Node("e"))
+    )
+    assert fast_simple_distance(A, B) == 2
+
+
+def test_empty_tree_distance():
+    assert fast_simple_distance(Node(''), Node('')) == 0
+    assert fast_simple_distance(Node('a'), Node('')) == 1
+    assert fast_simple_distance(Node(''), Node('b')) == 1
+
+
+def test_same_as_compare():
+    check_random_pairs(300, 15)
+
+
+def test_numpy_tables_same_as_compare():
+    num_cells = fast.NUMPY_MIN_CELLS
+    fast.NUMPY_MIN_CELLS = 0
+    try:
+        check_random_pairs(300, 15)
+    finally:
+        fast.NUMPY_MIN_CELLS = num_cells
+
+
+def test_distance_matrix():
+    random.seed(1)
+    As = [random_tree(random.randint(1, 12)) for _ in range(6)]
+    Bs = [random_tree(random.randint(1, 12)) for _ in range(5)] + [As[2]]
+    matrix = distance_matrix(As, Bs)
+    for i, A in enumerate(As):
+        for j, B in enumerate(Bs):
+            assert matrix[i][j] == simple_distance(A, B)
+
+
+def test_distance_matrix_stop_at_zero():
+    A = Node('a').addkid(Node('b'))
+    B = Node('a').addkid(Node('c'))
+    matrix = distance_matrix([B, A, B], [A, B], stop_at_zero=True)
+    assert [row[0] for row in matrix] == [1, 0, None]
+    assert [row[1] for row in matrix] == [0, None, None]
+
+
+def unit_cost(label):
+    return 1
+
+
+def test_min_distances():
+    random.seed(2)
+    for _ in range(30):
+        As = [random_tree(random.randint(1, 10)) for _ in range(4)]
+        Bs = [random_tree(random.randint(1, 10)) for _ in range(6)] + [As[3]]
+        expected = [min(simple_distance(A, B) for A in As) for B in Bs]
+        assert min_distances(As, Bs) == expected
+        assert min_distances(As, Bs, min_label_cost=unit_cost) == expected
+        for max_dist in [0, 2]:
+            dists = min_distances(As, Bs, min_label_cost=unit_cost,
+                                  max_dist=max_dist)
+            for dist, expected_dist in zip(dists, expected):
+                if expected_dist <= max_dist:
+                    assert dist == expected_dist
+                else:
+                    assert dist > max_dist
+
+
+def test_bounded_distance():
+    random.seed(3)
+    for _ in range(100):
+        A = random_tree(random.randint(1, 10))
+        B = random_tree(random.randint(1, 10))
+        dist = simple_distance(A, B)
+        for max_dist in [0, 1, 3]:
+            bounded = bounded_distance(A, B, max_dist,
+                                       min_label_cost=unit_cost)
+            if dist <= max_dist:
+                assert bounded == dist
+            else:
+                assert bounded > max_dist
+
+
+def test_canonical_label():
+    A = Node('a').addkid(Node('x1')).addkid(Node('b'))
+    B = Node('a').addkid(Node('x2')).addkid(Node('b'))
+    ignore_x = lambda label: 'x' if label.startswith('x') else label
+    label_dist = lambda a, b: 0 if ignore_x(a) == ignore_x(b) else 1
+    assert min_distances([A], [B], label_dist=label_dist,
+                         canonical_label=ignore_x) == [0]
+    assert min_distances([A], [B]) == [1]